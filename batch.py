@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#solves a batch of independent CoinJoins for a coordinator, reading one job per line of JSON from a file (or stdin)
+#and writing one result per line of JSON to stdout in the order the jobs finish.
+#a job holds the CoinJoinProblem arguments (see coinjoin.py) with the tuples as lists, for example:
+# {"id": "round-1", "variant": "maker-taker", "inputs": [[1, 100000000], [2, 130000000], [3, 70000000], [3, 70000000]],
+#  "txfees": [[1, 0], [2, 17], [3, 0]], "cjfee": [[1, 0], [2, 28], [3, 5]], "taker": 1, "deadline": 30000}
+#"variant" defaults to "maker-taker". "deadline" (in milliseconds, default --deadline) is the job's time budget, after
+#which the best solution found so far is used. a job still running --grace milliseconds past its deadline is killed,
+#and reports the best solution its worker had sent back by then.
+#"options" can override the solve() options given on the command line, e.g. {"strategy": "galloping"}.
+#every job runs in a worker process of its own, at most --workers at a time, so a hard job only ever holds up its
+#own worker. the prototypes are loaded once in this process, and the workers inherit them when they are forked.
+#with --cache, jobs that repeat an already solved config (up to party IDs and input order) skip the solver.
+#with --metrics, every job appends the records of its encodings and solver calls (see instrumentation.py) to a file,
+#tagged with the job's "id" (not to stdout, which holds the results). with --export-smtlib, every job writes its solver calls as SMT-LIB2 files to a directory
+#named after its "id", see SmtLibExporter.
+from contextlib import redirect_stdout
+import argparse
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import time
+
+from coinjoin import load_variant, improving_solutions, make_problem
+from instrumentation import JsonLinesWriter, SmtLibExporter
+from solution_cache import SolutionCache
+
+#the fields of a result line for a solution as yielded by improving_solutions():
+def solution_fields(problem, solution):
+  (selected_inputs, outputs, metrics) = solution
+  fields = {"inputs": selected_inputs, "outputs": outputs}
+  for k in ["num_outputs", "num_unique_outputs", "anonymity_score", "txfee"]:
+    if k in metrics["model"]:
+      fields[k] = metrics["model"][k]
+  return fields
+
+#solves problem in a worker process. every improving solution is sent back as it is found, as ("solution", fields,
+#None) with the fields from solution_fields() and the timings so far, and the result line at the end as
+#("done", result, solved). the status of the result line is one of:
+# -"optimal" if the solution is proven optimal
+# -"feasible" if a solution was found, but not proven optimal before the deadline
+# -"infeasible" if the solver proved that there is no solution
+# -"unknown" if the solver gave up before finding any solution
+#along with it goes the (min_outputs, objective, model, optimal) to cache, as from coinjoin.solve().
+#if metrics is set to a path, the job's metrics are appended to that file, see JsonLinesWriter.
+#if export_smtlib is set to a directory, the job's solver calls are written to a subdirectory for the job, see SmtLibExporter.
+def run_job(connection, job_id, problem, options, metrics, export_smtlib = None):
+  start = time.monotonic()
+  best = None
+  first_solution_time = None
+  num_solutions = 0
+  instrument = JsonLinesWriter(metrics, id = job_id) if metrics is not None else None
+  if export_smtlib is not None:
+    tactic = load_variant(problem.variant).bitvector_tactic if options.get("amounts") == "bitvector" else None
+    instrument = SmtLibExporter(os.path.join(export_smtlib, str(job_id)), instrument, id = job_id, tactic = tactic)
+  if instrument is not None:
+    options = dict(options, instrument = instrument)
+  with open(os.devnull, "w") as devnull, redirect_stdout(devnull): #the prototypes print their progress
+    solutions = improving_solutions(problem, **options)
+    while True:
+      try:
+        best = next(solutions)
+      except StopIteration as done:
+        optimal = done.value
+        break
+      num_solutions += 1
+      if first_solution_time is None:
+        first_solution_time = time.monotonic() - start
+      connection.send(("solution", dict(solution_fields(problem, best), solve_time = time.monotonic() - start,
+                                        first_solution_time = first_solution_time, solutions = num_solutions), None))
+  result = {"solve_time": time.monotonic() - start, "first_solution_time": first_solution_time,
+            "solutions": num_solutions}
+  if best is None:
+    result["status"] = "infeasible" if optimal else "unknown"
+    solved = (None, None, None, optimal)
+  else:
+    result.update(solution_fields(problem, best))
+    result["status"] = "optimal" if optimal else "feasible"
+    objective = result["num_unique_outputs"] if problem.variant == "maker-taker" else result["anonymity_score"]
+    solved = (result["num_outputs"], objective, best[2]["model"], optimal)
+  connection.send(("done", result, solved))
+  connection.close()
+
+#a job running in a worker process of its own, see run_job().
+class Job:
+  def __init__(self, job_id, problem, options, deadline, grace, metrics = None, export_smtlib = None):
+    self.job_id = job_id
+    self.problem = problem
+    self.options = options
+    self.solved = None #what run_job() solved, if it finished
+    self.best = None #the last solution run_job() sent back, see run_job()
+    self.done = None #the result line from run_job(), once it finished
+    self.started = time.monotonic()
+    self.kill_at = self.started + (deadline + grace) / 1000
+    (self.connection, child_connection) = multiprocessing.Pipe(duplex = False)
+    self.process = multiprocessing.Process(target = run_job, args = (child_connection, job_id, problem, options, metrics,
+                                                                     export_smtlib),
+                                           daemon = True)
+    self.process.start()
+    child_connection.close()
+
+  #takes in everything the worker has sent so far, once its connection is ready. returns whether the job is finished.
+  def receive(self):
+    try:
+      while self.done is None and self.connection.poll():
+        (kind, fields, solved) = self.connection.recv()
+        if kind == "solution":
+          self.best = fields
+        else:
+          (self.done, self.solved) = (fields, solved)
+    except EOFError:
+      self.done = {"status": "error", "error": "the worker process died"}
+    return self.done is not None
+
+  #returns the result line for the job, once it is finished or past its kill time. a job that did not finish
+  #reports the last solution it sent back, if any, as "feasible" along with the error.
+  def result(self):
+    self.receive()
+    result = self.done
+    if result is None:
+      result = {"status": "killed", "error": "still running past the deadline"}
+    if result["status"] in ["killed", "error"] and self.best is not None:
+      result = dict(self.best, status = "feasible", error = result["error"])
+    self.close()
+    return dict({"id": self.job_id, "wall_time": time.monotonic() - self.started}, **result)
+
+  def close(self):
+    self.process.terminate()
+    self.process.join()
+    self.connection.close()
+
+#returns the result line for a solution from the cache, like run_job() does:
+def cached_result(job_id, problem, cached):
+  (num_outputs, objective, model, _) = cached
+  if model is None:
+    return {"id": job_id, "status": "infeasible", "cached": True}
+  (selected_inputs, outputs) = load_variant(problem.variant).recover_cj_config_from_model(model)
+  objective_name = "num_unique_outputs" if problem.variant == "maker-taker" else "anonymity_score"
+  return {"id": job_id, "status": "optimal", "cached": True, "inputs": selected_inputs, "outputs": outputs,
+          "num_outputs": num_outputs, objective_name: objective, "txfee": model["txfee"]}
+
+#reads the jobs from a file or stream a chunk at a time, so that the main loop can wait for the next job and for the
+#workers at once with multiprocessing.connection.wait() rather than block on a line that has not arrived yet.
+class JobReader:
+  def __init__(self, f):
+    self.file = f
+    self.buffer = b"" #the start of a line still arriving
+    self.exhausted = False
+
+  def fileno(self):
+    return self.file.fileno()
+
+  #reads what has arrived, once wait() finds it ready, and returns the lines completed by it:
+  def read_lines(self):
+    data = os.read(self.fileno(), 65536)
+    if data == b"":
+      self.exhausted = True
+      (lines, self.buffer) = ([self.buffer] if self.buffer != b"" else [], b"")
+    else:
+      lines = (self.buffer + data).split(b"\n")
+      self.buffer = lines.pop()
+    return [line.decode() for line in lines]
+
+def write_result(result):
+  sys.stdout.write(json.dumps(result) + "\n")
+  sys.stdout.flush()
+
+def main():
+  parser = argparse.ArgumentParser(description = "Solve a batch of CoinJoin configs given as JSON lines.")
+  parser.add_argument("jobs", nargs = "?", default = "-", help = "file with one job per line (default: stdin)")
+  parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "jobs to solve at once")
+  parser.add_argument("--deadline", type = int, default = 60000, metavar = "MS",
+                      help = "time budget of jobs that do not set their own deadline")
+  parser.add_argument("--grace", type = int, default = 5000, metavar = "MS",
+                      help = "how long past its deadline a job may run before it is killed")
+  parser.add_argument("--cache", default = None, metavar = "DIR",
+                      help = "keep proven optimal solutions in this directory and reuse them for repeat configs")
+  parser.add_argument("--search", choices = ["linear", "binary", "galloping"], default = "binary",
+                      help = "how to tighten the objective bounds between solver calls")
+  parser.add_argument("--symmetry-breaking", action = "store_true",
+                      help = "impose a canonical order on the interchangeable output slots")
+  parser.add_argument("--encoding", choices = ["pairwise", "classes"], default = "pairwise",
+                      help = "compare all pairs of output slots, or count outputs per amount class")
+  parser.add_argument("--amounts", choices = ["int", "bounded", "bitvector"], default = "int",
+                      help = "encode amounts as unbounded integers, bounded integers, or bit-blasted bit-vectors")
+  parser.add_argument("--heuristic", action = "store_true",
+                      help = "start from (or fall back on) a solution built by the pure-Python heuristic engine")
+  parser.add_argument("--metrics", default = None, metavar = "FILE",
+                      help = "append metrics for every encoding and solver call to FILE as JSON lines, tagged with the job ID "
+                           "(a file, not stdout)")
+  parser.add_argument("--export-smtlib", default = None, metavar = "DIR",
+                      help = "write every solver call of a job to DIR/<job ID> as an SMT-LIB2 file, with a manifest")
+  args = parser.parse_args()
+  if args.metrics == "-":
+    parser.error("--metrics - would mix the metrics into the results on stdout, give a file instead")
+
+  defaults = {"strategy": args.search, "symmetry_breaking": args.symmetry_breaking, "encoding": args.encoding,
+              "amounts": args.amounts, "heuristic": args.heuristic}
+  cache = SolutionCache(path = args.cache) if args.cache is not None else None
+  reader = JobReader(sys.stdin if args.jobs == "-" else open(args.jobs, "rb"))
+  lines = list() #lines read but not started yet
+  running = list()
+  line_number = 0
+  while not reader.exhausted or len(lines) > 0 or len(running) > 0:
+    #fill the free workers, reading jobs only as they can be started so that the input can be a live stream:
+    while len(lines) > 0 and len(running) < args.workers:
+      line = lines.pop(0)
+      line_number += 1
+      if line.strip() == "":
+        continue
+      job_id = line_number
+      try:
+        config = json.loads(line)
+        job_id = config.get("id", line_number)
+        problem = make_problem(config)
+        load_variant(problem.variant) #before forking, so that every worker inherits the loaded prototype
+      except (ValueError, TypeError, AttributeError) as e:
+        write_result({"id": job_id, "status": "error", "error": str(e)})
+        continue
+      options = dict(defaults, **config.get("options", dict()))
+      if cache is not None and options.get("num_amount_classes") is None:
+        cached = cache.lookup(problem)
+        if cached is not None:
+          write_result(cached_result(job_id, problem, cached))
+          continue
+      deadline = config.get("deadline", args.deadline)
+      options["time_budget"] = deadline
+      running.append(Job(job_id, problem, options, deadline, args.grace, metrics = args.metrics,
+                           export_smtlib = args.export_smtlib))
+
+    #wait for the next job if a worker is free, and for the running jobs to finish or run out of time:
+    waiting = [job.connection for job in running]
+    if not reader.exhausted and len(lines) == 0 and len(running) < args.workers:
+      waiting.append(reader)
+    if len(waiting) == 0:
+      continue
+    timeout = max(0, min(job.kill_at for job in running) - time.monotonic()) if len(running) > 0 else None
+    ready = multiprocessing.connection.wait(waiting, timeout = timeout)
+    if reader in ready:
+      lines.extend(reader.read_lines())
+    now = time.monotonic()
+    for job in list(running):
+      if (job.connection in ready and job.receive()) or now >= job.kill_at:
+        running.remove(job)
+        write_result(job.result())
+        if cache is not None and job.solved is not None and job.options.get("num_amount_classes") is None:
+          cache.store(job.problem, job.solved)
+  if reader.file is not sys.stdin:
+    reader.file.close()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#times solver steps with the amounts encoded as unbounded integers, bounded integers and bit-blasted bit-vectors
+#(see the amounts option of build_smt_encoding() in the prototypes), on configs with a growing number of parties.
+#no optimum is known for the bigger configs, so the steps are placed around the solution from the heuristic engine:
+# -first: the first, most relaxed step of the optimization loop (usually SAT)
+# -phase 1: one step past the heuristic's objective with all 3 * len(parties) slots
+# -phase 2: one output fewer than the heuristic's solution at the heuristic's objective
+#each check runs in a fresh SolverSession, so nothing learned in one measurement helps the next.
+import argparse
+import time
+
+from pysmt.exceptions import SolverReturnedUnknownResultError
+
+from coinjoin import CoinJoinProblem, load_variant
+from engine import SolverSession
+from heuristic import heuristic_solution
+
+AMOUNTS = ["int", "bounded", "bitvector"]
+
+#variant name -> (the bound of the first step, the objective one step past a given one) for len(parties) parties
+VARIANTS = {
+  "maker-taker": (lambda num_parties: num_parties - 1, lambda x: x - 1 if x > 0 else None),
+  "perfect": (lambda num_parties: 0, lambda x: x + 1),
+}
+
+#a config like the example config of the variant, with num_parties parties: party p brings an input of
+#(5 + p) * 10000000 satoshis, and every even party a second input of 2 * p * 10000000 satoshis.
+#party 1 is the taker of a maker/taker CoinJoin and sweeps its inputs.
+def scaled_problem(variant, num_parties):
+  inputs = list()
+  for p in range(1, num_parties + 1):
+    inputs.append((p, (5 + p) * 10000000))
+    if p % 2 == 0:
+      inputs.append((p, 2 * p * 10000000))
+  if variant == "perfect":
+    return CoinJoinProblem(variant, inputs, [(p, 400 + 300 * p) for p in range(1, num_parties + 1)])
+  return CoinJoinProblem(variant, inputs, [(p, 0 if p == 1 else 17 * p) for p in range(1, num_parties + 1)],
+                         cjfee = [(p, 0 if p == 1 else 5 * p + 3) for p in range(1, num_parties + 1)], taker = 1)
+
+def time_step(problem, max_outputs, bound, amounts, symmetry_breaking):
+  with SolverSession(problem, 3 * len(problem.parties), amounts = amounts,
+                     symmetry_breaking = symmetry_breaking) as session:
+    start = time.perf_counter()
+    try:
+      status = "sat" if session.solve(max_outputs, bound) is not None else "unsat"
+    except SolverReturnedUnknownResultError:
+      status = "unknown"
+    return (status, time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark the integer, bounded integer and bit-vector amount encodings.")
+  parser.add_argument("--variant", choices = sorted(VARIANTS.keys()), default = "maker-taker")
+  parser.add_argument("--parties", type = int, nargs = "+", default = [2, 3, 4], help = "config sizes to benchmark")
+  parser.add_argument("--amounts", choices = AMOUNTS, nargs = "+", default = AMOUNTS, help = "encodings to compare")
+  parser.add_argument("--repeat", type = int, default = 1, help = "measurements per step and encoding")
+  parser.add_argument("--timeout", type = int, default = 30000, help = "solver timeout per call in milliseconds")
+  parser.add_argument("--symmetry-breaking", action = "store_true",
+                      help = "impose a canonical order on the interchangeable output slots")
+  args = parser.parse_args()
+
+  module = load_variant(args.variant)
+  module.solver_iteration_timeout = args.timeout
+  (first_bound, past) = VARIANTS[args.variant]
+
+  for num_parties in args.parties:
+    problem = scaled_problem(args.variant, num_parties)
+    steps = [("first", None, first_bound(num_parties))]
+    heuristic = heuristic_solution(problem)
+    if heuristic is None:
+      print("%d parties: the heuristic found no solution, only timing the first step" % num_parties)
+    else:
+      ([num_outputs, objective], _) = heuristic
+      print("%d parties: heuristic solution has %d outputs, objective %d" % (num_parties, num_outputs, objective))
+      if past(objective) is not None:
+        steps.append(("phase 1", None, past(objective)))
+      steps.append(("phase 2", num_outputs - 1, objective))
+    for (name, max_outputs, bound) in steps:
+      timings = dict()
+      for amounts in args.amounts:
+        timings[amounts] = list()
+        for _ in range(0, args.repeat):
+          (status, elapsed) = time_step(problem, max_outputs, bound, amounts, args.symmetry_breaking)
+          timings[amounts].append(elapsed if status != "unknown" else None)
+          print("  %s (max_outputs %s, bound %d), amounts %s: %s in %.3fs" %
+                (name, max_outputs, bound, amounts, status, elapsed))
+      #gave-up measurements do not count, so an encoding that always gives up has no best time:
+      best = dict((amounts, min([t for t in ts if t is not None], default = None)) for (amounts, ts) in timings.items())
+      print("  %s best of %d: %s" % (name, args.repeat,
+                                     ", ".join("%s %s" % (amounts, "%.3fs" % t if t is not None else "gave up")
+                                               for (amounts, t) in best.items())))
+
+if __name__ == "__main__":
+  main()
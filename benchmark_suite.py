@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#a reproducible benchmark suite for catching performance regressions before rolling out encoding changes.
+#generates seeded random configs (see generate_problem()) for the maker/taker and perfect CoinJoin variants, solves
+#each with the chosen engine, strategy and solver options under a fixed time budget, and reports per config:
+# -time to the first solution (from the heuristic engine, if it is on) and to the first solution from the solver
+# -time to the optimum: when the last, proven optimal solution was found (None unless it was proven optimal)
+# -the solution's quality (number of outputs and objective) and whether the run timed out before proving it optimal
+#the same --seed always generates the same configs, so the results of two runs (e.g. before and after a change)
+#can be compared config by config with --output and --baseline.
+from contextlib import redirect_stdout
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+from coinjoin import CoinJoinProblem, improving_solutions, load_variant, solve
+
+VARIANTS = ["maker-taker", "perfect"]
+DISTRIBUTIONS = ["uniform", "lognormal", "denominations"]
+
+#the objective each variant optimizes and whether lower is better, as named in its models:
+objectives = {"maker-taker": ("num_unique_outputs", True), "perfect": ("anonymity_score", False)}
+
+#common bitcoin amounts (in satoshis) that the "denominations" distribution picks from:
+denominations = [1000000, 2000000, 5000000, 10000000, 20000000, 50000000, 100000000]
+
+#draws one input amount in satoshis from the given distribution:
+# -"uniform": anywhere from 0.01 to 2 BTC
+# -"lognormal": around 0.5 BTC, with a long tail in both directions (clipped to 0.001 to 10 BTC)
+# -"denominations": a common round amount, give or take up to 20000 satoshis
+def draw_amount(rng, distribution):
+  if distribution == "uniform":
+    return rng.randint(1000000, 200000000)
+  if distribution == "lognormal":
+    return int(min(1000000000, max(100000, math.exp(rng.gauss(math.log(50000000), 1.2)))))
+  return rng.choice(denominations) + rng.randint(-20000, 20000)
+
+#generates config number index of the suite for variant, as a CoinJoinProblem. the config depends only on
+#(seed, variant, index, the ranges and distributions), so the same arguments always give the same config:
+# -the number of parties is drawn from parties and each party's number of inputs from inputs_per_party,
+#  both (min, max) ranges
+# -input amounts come from draw_amount() with a distribution drawn from distributions
+# -the feerates are drawn from common values. maker/taker makers pay up to 500 satoshis towards the txfee and ask
+#  for up to 2000 satoshis of CoinJoin fee, and the taker (the party with the least to join) sweeps its inputs half
+#  of the time and otherwise joins about half of what it has. perfect CoinJoin parties offer their minimum txfee
+#  contribution plus up to 1500 satoshis, and the fragmentation factor is drawn from 1 to 3.
+#returns (problem, distribution).
+def generate_problem(seed, variant, index, parties = (2, 4), inputs_per_party = (1, 2), distributions = DISTRIBUTIONS):
+  rng = random.Random("%d:%s:%d" % (seed, variant, index))
+  num_parties = rng.randint(*parties)
+  distribution = rng.choice(distributions)
+  inputs = list()
+  for p in range(1, num_parties + 1):
+    for _ in range(0, rng.randint(*inputs_per_party)):
+      inputs.append((p, draw_amount(rng, distribution)))
+  min_feerate = rng.choice([1, 2, 5, 10])
+  max_feerate = min_feerate * rng.choice([2, 3]) + 1
+  if variant == "perfect":
+    txfees = [(p, 500 * len([q for (q, _) in inputs if q == p]) + rng.randint(0, 1500)) for p in range(1, num_parties + 1)]
+    return (CoinJoinProblem(variant, inputs, txfees, min_feerate = min_feerate, max_feerate = max_feerate,
+                            max_party_fragmentation_factor = rng.randint(1, 3)), distribution)
+  totals = dict((p, sum(a for (q, a) in inputs if q == p)) for p in range(1, num_parties + 1))
+  taker = min(totals.keys(), key = lambda p: (totals[p], p))
+  txfees = [(p, 0 if p == taker else rng.randint(0, 500)) for p in range(1, num_parties + 1)]
+  cjfee = [(p, 0 if p == taker else rng.randint(0, 2000)) for p in range(1, num_parties + 1)]
+  amt = 0 if rng.random() < 0.5 else (totals[taker] // 2) // 10000 * 10000
+  return (CoinJoinProblem(variant, inputs, txfees, cjfee = cjfee, taker = taker, amt = amt, min_feerate = min_feerate,
+                          max_feerate = max_feerate), distribution)
+
+#solves problem with the given engine and options (passed on to coinjoin.solve() or coinjoin.improving_solutions())
+#within time_budget milliseconds, and returns the measurements for it as a dict.
+def run_instance(problem, engine, time_budget, options):
+  (objective_name, _) = objectives[problem.variant]
+  result = {"first_solution_time": None, "first_solver_solution_time": None, "optimum_time": None,
+            "num_outputs": None, objective_name: None}
+  start = time.monotonic()
+  with open(os.devnull, "w") as devnull, redirect_stdout(devnull): #the prototypes print their progress
+    if engine != "loop":
+      (num_outputs, objective, model, optimal) = solve(problem, engine = engine, time_budget = time_budget, **options)
+      found_time = time.monotonic() - start
+      if model is not None:
+        result.update({"first_solution_time": found_time, "first_solver_solution_time": found_time,
+                       "num_outputs": num_outputs, objective_name: objective})
+    else:
+      solutions = improving_solutions(problem, time_budget = time_budget, **options)
+      found_time = None
+      while True:
+        try:
+          (_, _, metrics) = next(solutions)
+        except StopIteration as done:
+          optimal = done.value
+          break
+        found_time = time.monotonic() - start
+        if result["first_solution_time"] is None:
+          result["first_solution_time"] = found_time
+        if result["first_solver_solution_time"] is None and metrics["phase"] > 0:
+          result["first_solver_solution_time"] = found_time
+        result["num_outputs"] = metrics["num_outputs"]
+        result[objective_name] = metrics[objective_name]
+  result["solve_time"] = time.monotonic() - start
+  if result["num_outputs"] is None:
+    result["status"] = "infeasible" if optimal else "timeout"
+  else:
+    result["status"] = "optimal" if optimal else "timeout"
+    if optimal:
+      result["optimum_time"] = found_time
+  return result
+
+#the median of the given values, leaving out None, or None if there are none:
+def median(values):
+  values = [v for v in values if v is not None]
+  return statistics.median(values) if len(values) > 0 else None
+
+def format_time(t):
+  return "%.3fs" % t if t is not None else "-"
+
+#compares the results of a run to those of a baseline run of the same suite (matched by "instance"), and prints
+#every config whose solution got worse, that timed out where it did not before, or that took more than slowdown
+#times as long to solve. returns the number of regressions found.
+def compare(results, baseline, slowdown):
+  regressions = 0
+  for result in results:
+    before = baseline.get(result["instance"])
+    if before is None:
+      continue
+    (objective_name, minimize) = objectives[result["variant"]]
+    problems = list()
+    if result["status"] == "timeout" and before["status"] != "timeout":
+      problems.append("timed out (was %s)" % before["status"])
+    if result[objective_name] is not None and before[objective_name] is not None:
+      key = lambda r: ((r[objective_name] if minimize else -r[objective_name]), r["num_outputs"])
+      if key(result) > key(before):
+        problems.append("worse solution: %d outputs, %s %d (was %d outputs, %s %d)" %
+                        (result["num_outputs"], objective_name, result[objective_name],
+                         before["num_outputs"], objective_name, before[objective_name]))
+    elif result[objective_name] is None and before[objective_name] is not None:
+      problems.append("no solution (was %d outputs, %s %d)" % (before["num_outputs"], objective_name, before[objective_name]))
+    #times under 0.1 seconds are noise, and a baseline of 0 seconds would not divide:
+    baseline = max(before["solve_time"], 0.1)
+    if result["solve_time"] > slowdown * baseline:
+      problems.append("%.1fx slower (%.3fs, was %.3fs)" % (result["solve_time"] / baseline,
+                                                          result["solve_time"], before["solve_time"]))
+    for problem in problems:
+      print("REGRESSION %s: %s" % (result["instance"], problem))
+    regressions += 1 if len(problems) > 0 else 0
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark the solver on seeded random CoinJoin configs.")
+  parser.add_argument("--variant", choices = VARIANTS, nargs = "+", default = VARIANTS, help = "variants to benchmark")
+  parser.add_argument("--instances", type = int, default = 5, help = "configs per variant")
+  parser.add_argument("--seed", type = int, default = 0, help = "seed of the config generator")
+  parser.add_argument("--parties", type = int, nargs = 2, default = [2, 4], metavar = ("MIN", "MAX"),
+                      help = "range of the number of parties")
+  parser.add_argument("--inputs", type = int, nargs = 2, default = [1, 2], metavar = ("MIN", "MAX"),
+                      help = "range of the number of inputs per party")
+  parser.add_argument("--distribution", choices = DISTRIBUTIONS, nargs = "+", default = DISTRIBUTIONS,
+                      help = "input amount distributions to draw from")
+  parser.add_argument("--timeout", type = int, default = 10000, metavar = "MS", help = "time budget per config")
+  parser.add_argument("--engine", choices = ["loop", "optimize", "decomposed"], default = "loop",
+                      help = "tighten the bounds step by step, hand the lexicographic objective to z3's Optimize, "
+                             "or pick denominations first (maker/taker only)")
+  parser.add_argument("--search", choices = ["linear", "binary", "galloping", "parallel"], default = "linear",
+                      help = "how to tighten the objective bounds between solver calls")
+  parser.add_argument("--symmetry-breaking", action = "store_true",
+                      help = "impose a canonical order on the interchangeable output slots")
+  parser.add_argument("--encoding", choices = ["pairwise", "classes"], default = "pairwise",
+                      help = "compare all pairs of output slots, or count outputs per amount class")
+  parser.add_argument("--amounts", choices = ["int", "bounded", "bitvector"], default = "int",
+                      help = "encode amounts as unbounded integers, bounded integers, or bit-blasted bit-vectors")
+  parser.add_argument("--heuristic", action = "store_true",
+                      help = "start from a solution built by the pure-Python heuristic engine")
+  parser.add_argument("--output", default = None, metavar = "FILE", help = "write the results to FILE as JSON lines")
+  parser.add_argument("--baseline", default = None, metavar = "FILE",
+                      help = "compare the results to those of an earlier run written with --output")
+  parser.add_argument("--slowdown", type = float, default = 2.0,
+                      help = "how many times slower a config may get before --baseline reports it")
+  args = parser.parse_args()
+  if args.engine == "decomposed" and "perfect" in args.variant:
+    parser.error("--engine decomposed only solves maker/taker CoinJoins, pass --variant maker-taker")
+
+  options = {"strategy": args.search, "symmetry_breaking": args.symmetry_breaking, "encoding": args.encoding,
+             "amounts": args.amounts, "heuristic": args.heuristic}
+  results = list()
+  for variant in args.variant:
+    load_variant(variant)
+    (objective_name, _) = objectives[variant]
+    variant_results = list()
+    for index in range(0, args.instances):
+      (problem, distribution) = generate_problem(args.seed, variant, index, args.parties, args.inputs, args.distribution)
+      result = {"instance": "%s-%d-%d" % (variant, args.seed, index), "variant": variant,
+                "num_parties": len(problem.parties), "num_inputs": problem.num_inputs, "distribution": distribution}
+      result.update(run_instance(problem, args.engine, args.timeout, options))
+      variant_results.append(result)
+      print("%s: %d parties, %d inputs (%s): %s in %s, first solution %s, first from the solver %s, optimum %s%s" %
+            (result["instance"], result["num_parties"], result["num_inputs"], distribution, result["status"],
+             format_time(result["solve_time"]), format_time(result["first_solution_time"]),
+             format_time(result["first_solver_solution_time"]), format_time(result["optimum_time"]),
+             "" if result["num_outputs"] is None else
+             ", %d outputs with %s %d" % (result["num_outputs"], objective_name, result[objective_name])))
+    statuses = [r["status"] for r in variant_results]
+    print("%s summary: %d optimal, %d infeasible, %d timed out; median solve time %s, first solution %s, optimum %s" %
+          (variant, statuses.count("optimal"), statuses.count("infeasible"), statuses.count("timeout"),
+           format_time(median([r["solve_time"] for r in variant_results])),
+           format_time(median([r["first_solution_time"] for r in variant_results])),
+           format_time(median([r["optimum_time"] for r in variant_results]))))
+    results += variant_results
+
+  if args.output is not None:
+    with open(args.output, "w") as f:
+      for result in results:
+        f.write(json.dumps(result) + "\n")
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = dict((r["instance"], r) for r in (json.loads(line) for line in f if line.strip() != ""))
+    regressions = compare(results, baseline, args.slowdown)
+    print("%d regression(s) against %s" % (regressions, args.baseline))
+    if regressions > 0:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
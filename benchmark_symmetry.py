@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#times the UNSAT steps of the minimization loops with and without symmetry breaking on the output slots.
+#first finds the optimum of the example config, then re-checks the two bounds just past it:
+# -phase 1: one step past the optimal max_unique (or anonymity score) with all 3 * len(parties) slots
+# -phase 2: one output fewer than the optimum at the optimal max_unique (or anonymity score)
+#each check runs in a fresh SolverSession, so nothing learned in one measurement helps the next.
+from contextlib import redirect_stdout
+import argparse
+import io
+import time
+
+from pysmt.exceptions import SolverReturnedUnknownResultError
+
+from coinjoin import load_variant
+from engine import SolverSession
+
+#variant name -> the objective one step past its optimum, or None if there is none
+VARIANTS = {
+  "maker-taker": lambda x: x - 1 if x > 0 else None,
+  "perfect": lambda x: x + 1,
+}
+
+def time_step(problem, max_outputs, bound, symmetry_breaking):
+  with SolverSession(problem, 3 * len(problem.parties), symmetry_breaking = symmetry_breaking) as session:
+    start = time.perf_counter()
+    try:
+      status = "sat" if session.solve(max_outputs, bound) is not None else "unsat"
+    except SolverReturnedUnknownResultError:
+      status = "unknown"
+    return (status, time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark the UNSAT steps with and without symmetry breaking.")
+  parser.add_argument("--variant", choices = sorted(VARIANTS.keys()), default = "maker-taker")
+  parser.add_argument("--repeat", type = int, default = 3, help = "measurements per step and setting")
+  parser.add_argument("--timeout", type = int, default = None, help = "solver timeout per call in milliseconds")
+  args = parser.parse_args()
+
+  module = load_variant(args.variant)
+  if args.timeout is not None:
+    module.solver_iteration_timeout = args.timeout
+  past_optimum = VARIANTS[args.variant]
+  problem = module.example_problem()
+
+  with redirect_stdout(io.StringIO()):
+    (min_outputs, objective, model, _) = module.optimization_procedure(problem, strategy = "binary", symmetry_breaking = True)
+  if model is None:
+    print("Could not solve the example config, nothing to benchmark")
+    return
+  print("optimum: %d outputs, objective %d" % (min_outputs, objective))
+
+  steps = [("phase 1", None, past_optimum(objective)),
+           ("phase 2", min_outputs - 1, objective)]
+  for (name, max_outputs, bound) in steps:
+    if bound is None:
+      print("%s: the optimum cannot be improved on, skipping" % name)
+      continue
+    timings = dict()
+    for symmetry_breaking in [False, True]:
+      timings[symmetry_breaking] = list()
+      for _ in range(0, args.repeat):
+        (status, elapsed) = time_step(problem, max_outputs, bound, symmetry_breaking)
+        timings[symmetry_breaking].append(elapsed)
+        print("%s (max_outputs %s, bound %d), symmetry breaking %s: %s in %.3fs" %
+              (name, max_outputs, bound, "on" if symmetry_breaking else "off", status, elapsed))
+    best_off = min(timings[False])
+    best_on = min(timings[True])
+    print("%s speedup: %.2fx (best of %d: %.3fs off, %.3fs on)" %
+          (name, best_off / best_on, args.repeat, best_off, best_on))
+
+if __name__ == "__main__":
+  main()
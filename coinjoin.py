@@ -0,0 +1,96 @@
+#library entry point shared by the maker/taker prototype (prototype.py) and the perfect CoinJoin prototype
+#(perfect-coinjoins/prototype.py). a long-lived process can import this once and solve many CoinJoins with
+#solve(), instead of running a prototype script per CoinJoin. importing it does not solve anything, and the
+#prototypes themselves are only loaded (and pysmt and z3 set up) the first time a variant is used.
+import importlib.util
+import os
+import sys
+
+#variant name -> path to its prototype.py, relative to this file
+variant_paths = {
+  "maker-taker": "prototype.py",
+  "perfect": os.path.join("perfect-coinjoins", "prototype.py"),
+}
+
+#a CoinJoin config to solve, replacing the example config globals of the prototypes.
+#variant is "maker-taker" or "perfect" and picks the prototype that solves it.
+#inputs is a list of (party, satoshis) tuples, and txfees a set of (party, satoshis) tuples: how much each party
+#contributes towards the txfee for "maker-taker", or the maximum each party is willing to pay for "perfect".
+#parties are numbered from 1 to len(txfees).
+#cjfee (a set of (party, satoshis) tuples), taker (the party responsible for the bulk of the tx fees) and
+#amt (0 means sweep all) only apply to "maker-taker", and max_party_fragmentation_factor (if a party provides
+#x inputs, allow giving that party up to x times this number of outputs) only to "perfect".
+#the rest are as in the example configs: feerates in sats per vbyte and output amounts in satoshis.
+class CoinJoinProblem:
+  def __init__(self, variant, inputs, txfees, cjfee = None, taker = None, amt = 0, min_feerate = 5, max_feerate = 11,
+               min_output_amt = 30000, min_output_amt_delta = 3000, max_party_fragmentation_factor = 3):
+    if variant not in variant_paths:
+      raise ValueError("unknown CoinJoin variant %r, expected one of %s" % (variant, ", ".join(sorted(variant_paths))))
+    if variant == "maker-taker" and (cjfee is None or taker is None):
+      raise ValueError("a maker-taker CoinJoin needs cjfee and taker")
+    self.variant = variant
+    #tuples rather than lists, so that configs read from JSON can go into sets:
+    self.inputs = [(party, amt) for (party, amt) in inputs]
+    self.txfees = set((party, fee) for (party, fee) in txfees)
+    self.cjfee = set((party, fee) for (party, fee) in cjfee) if cjfee is not None else None
+    self.taker = taker
+    self.amt = amt
+    self.min_feerate = min_feerate
+    self.max_feerate = max_feerate
+    self.min_output_amt = min_output_amt
+    self.min_output_amt_delta = min_output_amt_delta
+    self.max_party_fragmentation_factor = max_party_fragmentation_factor
+    #auto-calculated from the config above:
+    self.parties = range(1, len(self.txfees) + 1)
+    self.num_inputs = len(self.inputs)
+
+#the keys of a CoinJoin config given as JSON (e.g. a job for batch.py) that are passed on to CoinJoinProblem():
+problem_keys = ["inputs", "txfees", "cjfee", "taker", "amt", "min_feerate", "max_feerate", "min_output_amt",
+                "min_output_amt_delta", "max_party_fragmentation_factor"]
+
+#builds the CoinJoinProblem for a config given as JSON, with the tuples as lists and "variant" defaulting to
+#"maker-taker". other keys are ignored.
+def make_problem(config):
+  return CoinJoinProblem(config.get("variant", "maker-taker"), **dict((k, config[k]) for k in problem_keys if k in config))
+
+variants = dict() #variant name -> its loaded prototype module
+
+#loads (once) and returns the prototype module for the given variant.
+def load_variant(variant):
+  if variant not in variants:
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), variant_paths[variant])
+    spec = importlib.util.spec_from_file_location("%s_prototype" % variant.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    #registered under its name, so that its functions can be pickled for worker processes:
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    variants[variant] = module
+  return variants[variant]
+
+#solves problem with the prototype for its variant. strategy and options are as for that prototype's solve().
+#if cache is set to a SolutionCache (see solution_cache.py), a cached solution is returned without solving, and
+#a proven optimum is cached. options that restrict the search space (num_amount_classes) bypass the cache.
+#returns (min_outputs, objective, model, optimal), where objective is the number of uniquely-identifiable outputs
+#for "maker-taker" and the anonymity score for "perfect".
+def solve(problem, strategy = "linear", cache = None, **options):
+  if options.get("num_amount_classes") is not None:
+    cache = None
+  if cache is not None:
+    result = cache.lookup(problem)
+    if result is not None:
+      return result
+  result = load_variant(problem.variant).solve(problem, strategy = strategy, **options)
+  if cache is not None:
+    cache.store(problem, result)
+  return result
+
+#like solve(), but a generator of the improving solutions as they are found, as from improving_solutions().
+def improving_solutions(problem, strategy = "linear", **options):
+  from engine import variant_solutions #only imported once a variant is used, like the prototypes
+  return variant_solutions(problem, strategy = strategy, **options)
+
+#finds every CoinJoin for problem that no other one beats on the number of outputs, the privacy objective and the
+#cost, with the prototype for its variant. options are as for that prototype's pareto_frontier().
+#returns (frontier, proven) as from pareto_frontier().
+def pareto_frontier(problem, **options):
+  return load_variant(problem.variant).pareto_frontier(problem, **options)
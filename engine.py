@@ -0,0 +1,970 @@
+#the solver engine shared by the maker/taker prototype (prototype.py) and the perfect CoinJoin prototype
+#(perfect-coinjoins/prototype.py): solver sessions, hints, unsat cores, z3's Optimize, portfolios, the bound search
+#strategies, the optimization loop and the Pareto frontier. none of it depends on how a variant encodes a CoinJoin,
+#except for build_amount_classes() and bound_domains(), building blocks that both encodings share.
+#the engine finds the prototype for problem.variant with coinjoin.load_variant(), and uses from it:
+# -build_smt_encoding(problem, max_outputs, **encoding_options), returning (constraint_groups, symbols), where
+#  symbols holds exactly the variables read back into models (see read_model())
+# -bound_constraints(symbols, max_outputs, bound, min_outputs, max_txfee), with bound the bound on the objective
+# -objective: the name of the objective in symbols, models and metrics, and objective_bound: the name of the bound
+#  on it in records and unsat cores. maximize_objective tells whether the bound is a lower or an upper one
+# -objective_range(problem, num_outputs): (first, limit), the bound on the objective the search starts from and the
+#  best value the objective could take with num_outputs outputs
+# -fewest_outputs(problem), the fewest outputs any CoinJoin has, and min_txfee(problem, num_outputs), the lowest
+#  txfee any CoinJoin with num_outputs outputs pays
+# -recover_cj_config_from_model(model) and print_solution(result, selected_inputs, outputs), to report solutions
+# -improving_solutions(problem, **options), if the variant wraps the one in this module (see variant_solutions())
+# -solver_iteration_timeout, the default timeout of every solver call in milliseconds
+#the bound on the objective is called bound here, and max_unique or min_anonymity_score in the prototypes.
+from pysmt.shortcuts import Symbol, And, Implies, Ite, GE, LT, LE, Plus, Equals, Int, Solver
+from pysmt.exceptions import SolverReturnedUnknownResultError
+from pysmt.typing import BOOL, INT
+import z3
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+from coinjoin import load_variant
+from heuristic import heuristic_solution
+from instrumentation import group_sizes, z3_statistics
+
+#the prototype module for the variant of problem:
+def variant_of(problem):
+  return load_variant(problem.variant)
+
+#whether value of the objective of problem's variant meets bound (at most bound when minimizing, at least when maximizing):
+def meets_bound(problem, value, bound):
+  return value >= bound if variant_of(problem).maximize_objective else value <= bound
+
+#orders results ([num_outputs, objective], model) of problem's variant from best to worst: the best objective, then
+#the fewest outputs.
+def result_key(problem, result):
+  return (-result[0][1] if variant_of(problem).maximize_objective else result[0][1], result[0][0])
+
+#introduces num_classes amount class (denomination) variables and assigns every used output slot to one of them,
+#so that uniqueness, the anonymity score and the min delta rule can be expressed via class cardinalities
+#instead of comparing all pairs of output slots. class amounts are kept in decreasing order, at least
+#min_output_amt_delta apart, which enforces the min delta rule and makes outputs share a class exactly
+#when they share an amount.
+#returns (in_class, class_count), where in_class[i][c] is the condition that output i is in class c
+#and class_count[c] is the number of outputs in class c.
+def build_amount_classes(problem, output_party, output_amt, num_classes, constraints):
+  output_class = dict() #index into outputs -> amount class of that output, or -1 if it is unused
+  class_amt = dict() #amount class -> satoshis sent to each output in that class
+  class_count = dict() #amount class -> number of outputs in that class
+  in_class = dict()
+  for c in range(0, num_classes):
+    class_amt[c] = Symbol("class_amt[%d]" % c, INT)
+    class_count[c] = Symbol("class_count[%d]" % c, INT)
+  for (i, amt) in output_amt.items():
+    output_class[i] = Symbol("output_class[%d]" % i, INT)
+    constraints.add(Ite(Equals(output_party[i],
+                               Int(-1)),
+                        Equals(output_class[i],
+                               Int(-1)),
+                        And(GE(output_class[i],
+                               Int(0)),
+                            LT(output_class[i],
+                               Int(num_classes)))))
+    in_class[i] = dict()
+    for c in range(0, num_classes):
+      in_class[i][c] = Equals(output_class[i],
+                              Int(c))
+      constraints.add(Implies(in_class[i][c],
+                              Equals(amt,
+                                     class_amt[c])))
+  for c in range(0, num_classes):
+    if c + 1 < num_classes:
+      constraints.add(GE(class_amt[c],
+                         Plus(class_amt[c + 1],
+                              Int(problem.min_output_amt_delta))))
+      #the used classes come first, so which classes are used is not another symmetry to explore:
+      constraints.add(Implies(Equals(class_count[c],
+                                     Int(0)),
+                              Equals(class_count[c + 1],
+                                     Int(0))))
+    constraints.add(Equals(class_count[c],
+                           Plus([Ite(in_class[i][c], Int(1), Int(0)) for i in output_amt.keys()])))
+  return (in_class, class_count)
+
+#a bound on the absolute value of every integer variable in a valid CoinJoin for problem: amounts and fees cannot
+#exceed what the inputs and the configured fees add up to, and anything balancing them (like the cjfees the taker of
+#a maker/taker CoinJoin pays) stays within a few times that. counts and party IDs are far smaller. this is much
+#tighter than the 21e14 satoshis there can ever be, which keeps the bit-vectors of the "bitvector" amounts encoding
+#narrow.
+def amount_bound(problem, max_outputs):
+  fees = list(problem.txfees) + (list(problem.cjfee) if problem.cjfee is not None else [])
+  return 4 * (sum(a for (_, a) in problem.inputs) + sum(abs(f) for (_, f) in fees)) + max_outputs
+
+#bounds every integer variable in the constraints of groups (lists or sets of constraints of an encoding with
+#max_outputs output slots) to amount_bound(), for the "bounded" and "bitvector" amounts encodings.
+#returns the list of bounds, one per variable.
+def bound_domains(problem, max_outputs, groups):
+  bound = amount_bound(problem, max_outputs)
+  variables = set(v for group in groups for c in group for v in c.get_free_variables() if v.symbol_type() == INT)
+  return [And(GE(v, Int(-bound)), LE(v, Int(bound))) for v in sorted(variables, key = lambda v: v.symbol_name())]
+
+#reads the symbols straight out of a z3 model as python ints, with a list per input or output slot variable.
+#this skips printing and re-parsing the whole model, including all the intermediate variables.
+def read_model(z3_model, symbols, converter):
+  def value(var):
+    return z3_model.eval(converter.convert(var), model_completion = True).as_long()
+  model = dict()
+  for (name, var) in symbols.items():
+    if isinstance(var, dict):
+      model[name] = [value(var[i]) for i in range(0, len(var))]
+    else:
+      model[name] = value(var)
+  return model
+
+def extract_result(problem, s, symbols):
+  model = read_model(s.z3.model(), symbols, s.converter)
+  return ([model["num_outputs"], model[variant_of(problem).objective]], model)
+
+#returns the (variable, value) pairs that a hint (a model as from read_model(), e.g. an earlier solution or a
+#heuristic one) assigns to the input and output slots of symbols, or None if its outputs do not fit in the slots.
+#the used outputs go first, sorted like symmetry breaking would sort them.
+def hint_assignments(symbols, hint):
+  slots = len(symbols["output_party"])
+  outputs = [(p, a) for (p, a) in zip(hint["output_party"], hint["output_amt"]) if p != -1]
+  if len(outputs) > slots or len(hint["input_party"]) != len(symbols["input_party"]):
+    return None
+  outputs = sorted(outputs, key = lambda x: (x[1], x[0]), reverse = True) + [(-1, 0)] * (slots - len(outputs))
+  assignments = list()
+  for i in range(0, len(hint["input_party"])):
+    assignments.append((symbols["input_party"][i], hint["input_party"][i]))
+    assignments.append((symbols["input_amt"][i], hint["input_amt"][i]))
+  for (i, (party, amt)) in enumerate(outputs):
+    assignments.append((symbols["output_party"][i], party))
+    assignments.append((symbols["output_amt"][i], amt))
+  return assignments
+
+#warm-starts solver (a pysmt z3 solver, with the bounds asserted) from hint, see hint_assignments().
+#if the hint's own counts meet the bounds, first checks whether the hint itself is a solution, which needs no search
+#since it fixes every slot, and returns that solution as from extract_result() if so.
+#otherwise, gives z3 the hint as the initial values to search from and returns None.
+def apply_hint(problem, solver, symbols, hint, max_outputs, bound):
+  assignments = hint_assignments(symbols, hint)
+  if assignments is None:
+    return None
+  if (max_outputs is None or hint["num_outputs"] <= max_outputs) and \
+     (bound is None or meets_bound(problem, hint[variant_of(problem).objective], bound)):
+    solver.push()
+    try:
+      for (var, value) in assignments:
+        solver.add_assertion(Equals(var, Int(value)))
+      if solver.solve():
+        return extract_result(problem, solver, symbols)
+    except SolverReturnedUnknownResultError:
+      pass #just search as usual
+    finally:
+      solver.pop()
+  for (var, value) in assignments:
+    solver.z3.set_initial_value(solver.converter.convert(var), value)
+  return None
+
+#the tactic chain for the "bitvector" amounts encoding: nla2bv turns the bounded integer variables into bit-vectors
+#just wide enough for their bounds, and qfbv solves those by bit-blasting them to SAT.
+bitvector_tactic = "simplify,nla2bv,qfbv"
+
+#builds a z3 solver in ctx from a comma-separated chain of z3 tactic names, or z3's default solver if tactic is None:
+def make_z3_solver(ctx, tactic = None):
+  if tactic is None:
+    return z3.Solver(ctx = ctx)
+  tactics = [z3.Tactic(name, ctx = ctx) for name in tactic.split(",")]
+  return (tactics[0] if len(tactics) == 1 else z3.Then(*tactics, ctx = ctx)).solver()
+
+#returns a pysmt z3 solver with the given timeout for an encoding built with amounts (see build_smt_encoding()).
+#for "bitvector" amounts, the z3 solver underneath is swapped for one running bitvector_tactic before anything is
+#asserted, so that pysmt still converts and asserts everything as usual.
+def make_solver(timeout, amounts = "int"):
+  s = Solver(name='z3', solver_options={'timeout': timeout})
+  if amounts == "bitvector":
+    s.z3 = make_z3_solver(s.z3.ctx, bitvector_tactic)
+    s.z3.set(timeout = timeout)
+  return s
+
+#builds the encoding with build_smt_encoding(), and if instrument is set (see instrumentation.py) gives it an
+#"encode" record of how long that took and how big every constraint group is.
+def instrumented_encoding(problem, max_outputs, instrument = None, **encoding_options):
+  start = time.perf_counter()
+  (constraint_groups, symbols) = variant_of(problem).build_smt_encoding(problem, max_outputs, **encoding_options)
+  if instrument is not None:
+    instrument({"event": "encode", "variant": problem.variant, "num_parties": len(problem.parties),
+                "num_inputs": problem.num_inputs, "slots": max_outputs,
+                "encoding_time": time.perf_counter() - start, "groups": group_sizes(constraint_groups)})
+  return (constraint_groups, symbols)
+
+#checks solver (a pysmt z3 solver with the encoding and the bounds asserted), warm-started from hint if set
+#(see apply_hint()), and returns and raises like solve_smt_problem().
+#if instrument is set, it gets a "solve" record of the check (see instrumentation.py). its SMT-LIB2 script is the
+#formula the solver checks without the hint, so a check the hint answered takes longer when it is replayed.
+def check_bounds(problem, solver, symbols, max_outputs, bound, hint = None, instrument = None):
+  #a SolverSession checks the same solver again and again, and z3 keeps counting across its checks:
+  statistics = z3_statistics(solver.z3) if instrument is not None else None
+  start = time.perf_counter()
+  status = "unknown"
+  model_time = None
+  hinted = False
+  try:
+    result = apply_hint(problem, solver, symbols, hint, max_outputs, bound) if hint is not None else None
+    hinted = result is not None
+    if result is None:
+      if not solver.solve():
+        status = "unsat"
+        return None
+      model_start = time.perf_counter()
+      result = extract_result(problem, solver, symbols)
+      model_time = time.perf_counter() - model_start
+    status = "sat"
+    return result
+  finally:
+    if instrument is not None:
+      instrument({"event": "solve", "max_outputs": max_outputs, variant_of(problem).objective_bound: bound, "result": status,
+                  "solve_time": time.perf_counter() - start - (model_time or 0), "model_time": model_time,
+                  "statistics": z3_statistics(solver.z3, statistics), "hinted": hinted, "smtlib": solver.z3.to_smt2})
+
+#encoding_options are passed on to build_smt_encoding().
+#if hint is set, the solver is warm-started from it, see apply_hint().
+#if instrument is set, it gets the records of the encoding and the check, see instrumentation.py.
+#returns ([num_outputs, objective], model), or None if the problem is unsatisfiable.
+#raises SolverReturnedUnknownResultError if the solver gives up, e.g. after timeout milliseconds.
+def solve_smt_problem(problem, max_outputs, bound = None, timeout = None, hint = None, instrument = None, **encoding_options):
+  variant = variant_of(problem)
+  (constraint_groups, symbols) = instrumented_encoding(problem, max_outputs, instrument, **encoding_options)
+  constraints = list()
+  for group in constraint_groups.values():
+    for c in group:
+      constraints.append(c)
+  for c in variant.bound_constraints(symbols, None, bound):
+    constraints.append(c)
+  formula = And(constraints)
+
+  if timeout is None:
+    timeout = variant.solver_iteration_timeout
+  with make_solver(timeout, encoding_options.get("amounts", "int")) as s:
+    s.add_assertion(formula)
+    return check_bounds(problem, s, symbols, max_outputs, bound, hint = hint, instrument = instrument)
+
+#finds out why there is no CoinJoin within the given bounds: every constraint group from build_smt_encoding()
+#(built with encoding_options) and every bound is switched on by an assumption of its own, and on UNSAT the groups
+#z3 blames are shrunk to a minimal core, by dropping each in turn and leaving it out if the rest is still UNSAT.
+#every check gets timeout milliseconds.
+#returns (core, minimal), where core is the sorted list of group names (with "max_outputs" and the variant's
+#objective_bound for the bounds), or (None, False) if the bounds are satisfiable. minimal is False if a check gave
+#up while shrinking, in which case the core may hold more than it needs to.
+#raises SolverReturnedUnknownResultError if the solver gives up on the first check.
+def unsat_core(problem, max_outputs = None, bound = None, timeout = None, **encoding_options):
+  variant = variant_of(problem)
+  slots = 3 * len(problem.parties)
+  if max_outputs is not None and max_outputs >= slots:
+    max_outputs = None
+  (constraint_groups, symbols) = variant.build_smt_encoding(problem, slots, **encoding_options)
+  groups = dict(constraint_groups)
+  groups["max_outputs"] = variant.bound_constraints(symbols, max_outputs, None)
+  groups[variant.objective_bound] = variant.bound_constraints(symbols, None, bound)
+  if timeout is None:
+    timeout = variant.solver_iteration_timeout
+  with make_solver(timeout, encoding_options.get("amounts", "int")) as s:
+    assumptions = dict() #group name -> the literal switching it on
+    for (name, group) in groups.items():
+      if len(group) == 0:
+        continue
+      assumptions[name] = Symbol("assume[%s]" % name, BOOL)
+      for c in group:
+        s.add_assertion(Implies(assumptions[name], c))
+    if s.solve(list(assumptions.values())):
+      return (None, False)
+    blamed = set(str(x) for x in s.z3.unsat_core())
+    core = sorted(name for (name, literal) in assumptions.items() if str(s.converter.convert(literal)) in blamed)
+    minimal = True
+    for name in list(core):
+      try:
+        if not s.solve([assumptions[n] for n in core if n != name]):
+          core.remove(name)
+      except SolverReturnedUnknownResultError:
+        minimal = False
+    return (core, minimal)
+
+#prints and returns the core from unsat_core() for bounds that turned out UNSAT, or returns None if there is none.
+def explain_unsat(problem, max_outputs = None, bound = None, timeout = None, **encoding_options):
+  try:
+    (core, minimal) = unsat_core(problem, max_outputs, bound, timeout = timeout, **encoding_options)
+  except SolverReturnedUnknownResultError:
+    print("Could not find out why, the solver gave up")
+    return None
+  if core is None:
+    return None
+  print("These constraints cannot all hold at once%s: %s" % ("" if minimal else " (maybe not all of them are needed)",
+                                                             ", ".join(core)))
+  return core
+
+#a persistent solver that asserts the base encoding once, with room for up to max_outputs outputs.
+#each call to solve() only pushes the bounds for that optimization step and pops them afterward
+#(it returns and raises like solve_smt_problem()),
+#so the z3 instance keeps the lemmas it learned on the base encoding across steps.
+#using fewer outputs is expressed as a bound on num_outputs rather than by rebuilding with fewer slots.
+#if instrument is set, it gets the records of the encoding and of every check, see instrumentation.py.
+class SolverSession:
+  def __init__(self, problem, max_outputs, instrument = None, **encoding_options):
+    self.problem = problem
+    self.max_outputs = max_outputs
+    self.instrument = instrument
+    (self.constraint_groups, self.symbols) = instrumented_encoding(problem, max_outputs, instrument, **encoding_options)
+    self.solver = make_solver(variant_of(problem).solver_iteration_timeout, encoding_options.get("amounts", "int"))
+    for group in self.constraint_groups.values():
+      for c in group:
+        self.solver.add_assertion(c)
+
+  def solve(self, max_outputs = None, bound = None, timeout = None, hint = None, min_outputs = None, max_txfee = None):
+    variant = variant_of(self.problem)
+    if max_outputs is not None and max_outputs >= self.max_outputs:
+      max_outputs = None #already implied by the number of output slots
+    self.solver.z3.set(timeout = timeout if timeout is not None else variant.solver_iteration_timeout)
+    self.solver.push()
+    try:
+      for c in variant.bound_constraints(self.symbols, max_outputs, bound, min_outputs, max_txfee):
+        self.solver.add_assertion(c)
+      return check_bounds(self.problem, self.solver, self.symbols, max_outputs, bound, hint = hint,
+                          instrument = self.instrument)
+    finally:
+      self.solver.pop()
+
+  #rules out the inputs at indices (into problem.inputs) for good, e.g. once their parties have dropped out.
+  #this only adds to the base encoding, so the solver keeps everything it learned so far.
+  def exclude_inputs(self, indices):
+    for i in indices:
+      self.solver.add_assertion(Equals(self.symbols["input_party"][i],
+                                       Int(-1)))
+
+  def close(self):
+    self.solver.exit()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+#solves the same lexicographic objective as optimization_procedure() (the best objective, then fewest outputs) in a
+#single call to z3's Optimize on the encoding from build_smt_encoding().
+#returns the same ([num_outputs, objective], model) as solve_smt_problem(), or None if the problem is unsatisfiable.
+#raises SolverReturnedUnknownResultError if z3 gives up before proving the optimum.
+#if instrument is set, it gets the records of the encoding and of the call to Optimize, see instrumentation.py.
+def optimize_smt_problem(problem, max_outputs, timeout = None, instrument = None, **encoding_options):
+  variant = variant_of(problem)
+  (constraint_groups, symbols) = instrumented_encoding(problem, max_outputs, instrument, **encoding_options)
+  constraints = list()
+  for group in constraint_groups.values():
+    for c in group:
+      constraints.append(c)
+
+  #borrow the pysmt z3 backend only for its converter, so the encoding is shared with the loop.
+  #Optimize cannot run a tactic, so "bitvector" amounts are only bounded here:
+  with Solver(name='z3') as s:
+    opt = z3.Optimize(ctx = s.z3.ctx)
+    opt.set(priority = 'lex', timeout = timeout if timeout is not None else variant.solver_iteration_timeout)
+    for c in constraints:
+      opt.add(s.converter.convert(c))
+    #lexicographic: the best objective first, then fewest outputs
+    objective = s.converter.convert(symbols[variant.objective])
+    if variant.maximize_objective:
+      opt.maximize(objective)
+    else:
+      opt.minimize(objective)
+    opt.minimize(s.converter.convert(symbols["num_outputs"]))
+    start = time.perf_counter()
+    res = opt.check()
+    solve_time = time.perf_counter() - start
+    result = None
+    if res == z3.sat:
+      model = read_model(opt.model(), symbols, s.converter)
+      result = ([model["num_outputs"], model[variant.objective]], model)
+    if instrument is not None:
+      instrument({"event": "solve", "engine": "optimize", "max_outputs": max_outputs, variant.objective_bound: None,
+                  "result": str(res), "solve_time": solve_time,
+                  "model_time": time.perf_counter() - start - solve_time if result is not None else None,
+                  "statistics": z3_statistics(opt), "smtlib": opt.sexpr})
+    if res == z3.unsat:
+      return None
+    elif res != z3.sat:
+      raise SolverReturnedUnknownResultError
+    return result
+
+#the configurations raced by default: z3's default solver and its QF_LIA tactic on integer amounts, and
+#bitvector_tactic on bit-vector amounts, each with and without symmetry breaking and on both encodings, then the
+#same again with further random seeds.
+def default_portfolio(size):
+  variants = [(tactic, amounts, symmetry_breaking, encoding)\
+              for encoding in ["pairwise", "classes"]\
+              for symmetry_breaking in [True, False]\
+              for (tactic, amounts) in [(None, "int"), ("qflia", "int"), (None, "bitvector")]]
+  configs = list()
+  for k in range(0, size):
+    (tactic, amounts, symmetry_breaking, encoding) = variants[k % len(variants)]
+    configs.append({"random_seed": k // len(variants),
+                    "tactic": tactic,
+                    "amounts": amounts,
+                    "symmetry_breaking": symmetry_breaking,
+                    "encoding": encoding})
+  return configs
+
+#solves one portfolio configuration in a worker process. config maps:
+# -"random_seed" to the seed for z3's SMT and SAT cores
+# -"tactic" to a tactic chain for make_z3_solver() (by default bitvector_tactic for "bitvector" amounts)
+# -anything else to options for build_smt_encoding()
+#the bounds are applied to an encoding with slots output slots, as in SolverSession.solve().
+#returns (status, result), where status is "sat", "unsat" or "unknown" and result is as from solve_smt_problem().
+def portfolio_worker(problem, config, slots, max_outputs, bound, timeout):
+  variant = variant_of(problem)
+  encoding_options = dict((k, v) for (k, v) in config.items() if k not in ["random_seed", "tactic"])
+  (constraint_groups, symbols) = variant.build_smt_encoding(problem, slots, **encoding_options)
+  constraints = list()
+  for group in constraint_groups.values():
+    for c in group:
+      constraints.append(c)
+  if max_outputs is not None and max_outputs >= slots:
+    max_outputs = None
+  for c in variant.bound_constraints(symbols, max_outputs, bound):
+    constraints.append(c)
+  if config.get("random_seed") is not None:
+    z3.set_param("smt.random_seed", config["random_seed"])
+    z3.set_param("sat.random_seed", config["random_seed"])
+
+  with Solver(name='z3') as s:
+    tactic = config.get("tactic")
+    if tactic is None and encoding_options.get("amounts") == "bitvector":
+      tactic = bitvector_tactic
+    solver = make_z3_solver(s.z3.ctx, tactic)
+    solver.set(timeout = timeout)
+    for c in constraints:
+      solver.add(s.converter.convert(c))
+    res = solver.check()
+    if res == z3.sat:
+      model = read_model(solver.model(), symbols, s.converter)
+      return ("sat", ([model["num_outputs"], model[variant.objective]], model))
+    return ("unsat" if res == z3.unsat else "unknown", None)
+
+def format_portfolio_config(config):
+  return " ".join("%s=%s" % (k, v) for (k, v) in sorted(config.items()))
+
+#races the portfolio configurations in configs on the same bounds in up to workers worker processes at once
+#(one per configuration by default), each a WorkerCall, and takes the first definitive (sat or unsat) answer.
+#returns (result, winner), where result is as from solve_smt_problem() and winner is the configuration that
+#answered first, or None if every configuration gave up.
+def portfolio_solve(problem, configs, slots, max_outputs = None, bound = None, timeout = None, workers = None):
+  if timeout is None:
+    timeout = variant_of(problem).solver_iteration_timeout
+  if workers is None:
+    workers = len(configs)
+  pending = list(configs)
+  running = dict() #WorkerCall -> its configuration
+  try:
+    while len(pending) > 0 or len(running) > 0:
+      while len(pending) > 0 and len(running) < workers:
+        config = pending.pop(0)
+        running[WorkerCall(portfolio_worker, problem, config, slots, max_outputs, bound, timeout)] = config
+      ready = multiprocessing.connection.wait([c.connection for c in running])
+      for c in list(running):
+        if c.connection not in ready:
+          continue
+        config = running.pop(c)
+        (status, result) = c.result()
+        if status != "unknown":
+          return (result, config)
+    return (None, None)
+  finally:
+    #stop the losing workers:
+    for c in running:
+      c.cancel()
+
+#searches for the tightest bound on an objective, given a solution that already achieves best.
+#limit is the best value the objective could possibly take: below best when minimizing, above it when maximizing.
+#try_bound(bound, retry) is a generator that returns (result, status) for "at least as good as bound", with status
+#as from portfolio_worker() and result None unless it is "sat". value(result) is the objective value that result
+#actually achieves, which may beat the bound we asked for.
+#everything try_bound() yields is passed on, so that callers can stream solutions as they are found.
+#strategy picks the next bound to try:
+# -"linear" tries one step past the best solution found so far
+# -"binary" bisects between the best solution found so far and the best bound not yet refuted
+# -"galloping" tries exponentially growing steps past the best solution until a bound is refuted, then bisects
+#every strategy jumps straight to the value the last model actually achieved.
+#a bound the solver gave up on ("unknown") is neither satisfied nor refuted: the search goes on with the looser
+#bounds, and once those are settled, tries it once more with retry set to True if retry is set (e.g. because the caller
+#can give it more time then), or stops there otherwise.
+#a generator that returns (best, best_result, settled), where best_result is None if nothing better than the initial
+#solution was found, and settled tells whether every bound up to limit was satisfied or refuted.
+def search_bound(try_bound, value, best, limit, strategy = "linear", retry = False):
+  direction = 1 if limit > best else -1
+  best_result = None
+  refuted = False
+  step = 1
+  gave_up = None #the bound the solver last gave up on, if it is still open
+  while (limit - best) * direction > 0:
+    ceiling = limit if gave_up is None else gave_up - direction
+    if (ceiling - best) * direction <= 0:
+      if not retry:
+        return (best, best_result, False)
+      (bound, retry) = (gave_up, False) #only once
+      (result, status) = yield from try_bound(bound, True)
+    else:
+      if strategy == "binary" or (strategy == "galloping" and refuted):
+        bound = best + direction * ((abs(ceiling - best) + 1) // 2)
+      elif strategy == "galloping":
+        bound = best + direction * min(step, abs(ceiling - best))
+      else:
+        bound = best + direction
+      (result, status) = yield from try_bound(bound, False)
+    if status == "unknown":
+      gave_up = bound
+    elif result is None:
+      limit = bound - direction
+      refuted = True
+    else:
+      best = value(result)
+      best_result = result
+      step *= 2
+    #a bound is settled once the best solution meets it or a looser one is refuted:
+    if gave_up is not None and ((gave_up - best) * direction <= 0 or (gave_up - limit) * direction > 0):
+      gave_up = None
+  return (best, best_result, True)
+
+def worker_call_main(connection, function, *args):
+  connection.send(function(*args))
+  connection.close()
+
+#runs function(*args) in a process of its own, so that each call can be cancelled individually
+#(calls submitted to a ProcessPoolExecutor cannot be stopped once they are running).
+#function returns (status, result) like portfolio_worker(), e.g. portfolio_worker itself.
+class WorkerCall:
+  def __init__(self, function, *args):
+    (self.connection, child_connection) = multiprocessing.Pipe(duplex = False)
+    self.process = multiprocessing.Process(target = worker_call_main, args = (child_connection, function) + args,
+                                           daemon = True)
+    self.process.start()
+    child_connection.close()
+
+  #blocks until the call is done and returns function's (status, result):
+  def result(self):
+    try:
+      return self.connection.recv()
+    except EOFError:
+      return ("unknown", None) #the worker died without answering
+    finally:
+      self.close()
+
+  def cancel(self):
+    self.process.terminate()
+    self.close()
+
+  def close(self):
+    self.process.join()
+    self.connection.close()
+
+#picks up to k of candidates, evenly spaced so that they split the candidates into k + 1 similar parts:
+def spread(candidates, k):
+  if k >= len(candidates):
+    return candidates
+  return [candidates[((i + 1) * len(candidates)) // (k + 1)] for i in range(0, k)]
+
+#like search_bound(), but keeps up to window candidate bounds between the best solution found so far and the
+#best bound not yet refuted in flight at once. call(bound, retry) starts a WorkerCall of portfolio_worker() checking
+#bound.
+#a satisfied bound makes every looser candidate pointless and a refuted one every tighter one, so calls on those are
+#cancelled straight away and the freed workers move on to the bounds still open. a timeout cancels the calls on
+#the tighter bounds too, but only until the looser ones are settled: then the bound is tried once more if retry is
+#set, as in search_bound().
+#report(result, status) is a generator run on every answer as it arrives, with status as from portfolio_worker(),
+#and everything it yields is passed on.
+#returns (best, best_result, settled) like search_bound().
+def parallel_search_bound(call, value, best, limit, window, report, retry = False):
+  direction = 1 if limit > best else -1
+  best_result = None
+  gave_up = None #the tightest bound the solver gave up on, if it is still open
+  running = dict() #bound -> WorkerCall
+  try:
+    while True:
+      ceiling = limit if gave_up is None else gave_up - direction
+      for bound in list(running.keys()):
+        if (bound - best) * direction <= 0 or ((bound - ceiling) * direction > 0 and bound != gave_up):
+          running.pop(bound).cancel()
+      candidates = [bound for bound in range(best + direction, ceiling + direction, direction) if bound not in running]
+      for bound in spread(candidates, window - len(running)):
+        running[bound] = call(bound, False)
+      if len(running) == 0:
+        if gave_up is None or not retry:
+          return (best, best_result, gave_up is None)
+        retry = False #only once
+        running[gave_up] = call(gave_up, True)
+
+      ready = multiprocessing.connection.wait([c.connection for c in running.values()])
+      for (bound, c) in list(running.items()):
+        if c.connection not in ready:
+          continue
+        del running[bound]
+        (status, result) = c.result()
+        yield from report(result, status)
+        if status == "sat":
+          if (value(result) - best) * direction > 0:
+            best = value(result)
+            best_result = result
+          limit = best if (best - limit) * direction > 0 else limit
+        elif (bound - best) * direction > 0 and (bound - limit) * direction <= 0:
+          if status == "unsat":
+            limit = bound - direction
+          elif gave_up is None or (bound - gave_up) * direction <= 0:
+            gave_up = bound
+      #a bound is settled once the best solution meets it or a looser one is refuted:
+      if gave_up is not None and ((gave_up - best) * direction <= 0 or (gave_up - limit) * direction > 0):
+        gave_up = None
+  finally:
+    for c in running.values():
+      c.cancel()
+
+class TimeBudgetExhausted(Exception):
+  pass
+
+#roughly how many solver calls the given search strategy needs to close a gap between the best solution and the limit:
+def expected_steps(strategy, gap):
+  if gap <= 0:
+    return 0
+  if strategy == "linear":
+    return gap
+  return gap.bit_length()
+
+#the optimization loop: first finds the best objective with all 3 * len(parties) output slots, starting from the
+#variant's objective_range(), then the fewest outputs (down to the variant's fewest_outputs()) at that objective.
+#if incremental is set, every step is solved in one SolverSession instead of re-encoding from scratch.
+#strategy is passed to search_bound() for both the objective and the output count phases.
+#encoding_options are passed on to build_smt_encoding().
+#if portfolio is set to a list of configurations (see portfolio_worker()), every step races all of them
+#with portfolio_solve() instead, and the configurations that answered first are reported at the end.
+#strategy "parallel" uses parallel_search_bound() with window worker processes instead of search_bound().
+#if time_budget (in milliseconds) is set, the first step gets half of it and every later step an equal share of
+#what is left of it among the steps expected to be left (but never more than solver_iteration_timeout), and once
+#the budget is used up the search stops with the best solution found so far. such a share can be too short for a
+#step that is merely hard, so a bound the solver gave up on is tried once more with all that is left (again up to
+#solver_iteration_timeout) once the looser bounds are settled, see search_bound().
+#if hint is set to a candidate model (as from read_model()), the first step checks it and otherwise starts from it,
+#see apply_hint(). if warm_start is set, every later step starts from the best solution found so far.
+#if session is set to a SolverSession for problem with 3 * len(parties) output slots, every step is solved in it
+#(whatever incremental is), and it is left open for more searches afterward.
+#if explain is set and no CoinJoin exists at all, the constraints that conflict are reported, see explain_unsat().
+#if instrument is set, it gets a record (see instrumentation.py) for the heuristic engine, for every encoding and
+#solver call with the phase it belongs to, and for the end of the search. steps of the parallel strategy run in
+#worker processes of their own and are not recorded, and portfolio steps only by their wall time and winner.
+#if heuristic is set, a solution is first built in pure Python with heuristic_solution() (see heuristic.py) and
+#yielded with phase 0, and the first step checks it as its hint (unless hint is set), so that the search starts
+#from its objective and it is still there to fall back on if the solver finds nothing better.
+#a generator that yields (selected_inputs, outputs, metrics) as from recover_cj_config_from_model() every time
+#a solution improves on the best one found so far, where metrics maps "num_outputs", the variant's objective,
+#"phase" and "elapsed" (seconds since the start) to the numbers for that solution, and "model" to its raw model.
+#closing the generator early stops the search, along with any worker processes.
+#returns whether every bound searched was satisfied or refuted in the end, i.e. whether the last solution yielded
+#is proven optimal for 3 * len(parties) output slots.
+def improving_solutions(problem, incremental = True, strategy = "linear", portfolio = None, window = None, time_budget = None,
+                        hint = None, warm_start = False, heuristic = False, explain = False, instrument = None, session = None,
+                        **encoding_options):
+  variant = variant_of(problem)
+  start = time.monotonic()
+  max_outputs = 3 * len(problem.parties)
+  (first_bound, objective_limit) = variant.objective_range(problem, max_outputs)
+  fewest_outputs = variant.fewest_outputs(problem)
+  if window is None:
+    window = os.cpu_count()
+  phase = 1
+  #the records of the steps also say which phase they belong to:
+  step_instrument = None
+  if instrument is not None:
+    step_instrument = lambda record: instrument(dict(record, phase = phase))
+  own_session = session is None
+  if own_session and incremental and portfolio is None and strategy != "parallel":
+    session = SolverSession(problem, max_outputs, instrument = step_instrument, **encoding_options)
+  if portfolio is not None:
+    portfolio = [dict(encoding_options, **config) for config in portfolio]
+  portfolio_wins = dict()
+  best_result = None #the best ([num_outputs, objective], model) found so far
+  optimal = True
+
+  def steps_left():
+    if best_result is None:
+      return 1 + expected_steps(strategy, abs(objective_limit - first_bound)) + \
+             expected_steps(strategy, max_outputs - fewest_outputs)
+    ([num_outputs, objective], _) = best_result
+    steps = expected_steps(strategy, num_outputs - fewest_outputs)
+    if phase == 1:
+      steps += expected_steps(strategy, abs(objective_limit - objective))
+    return steps
+
+  #retry is set for a bound the solver gave up on before:
+  def step_timeout(retry = False):
+    if time_budget is None:
+      return variant.solver_iteration_timeout
+    remaining = time_budget - (time.monotonic() - start) * 1000
+    if remaining < 1:
+      raise TimeBudgetExhausted
+    #an answer to anything beats a proof of optimality, so the first step gets half of the budget:
+    share = remaining / 2 if best_result is None else remaining / max(1, steps_left())
+    if retry:
+      share = remaining
+    return int(max(1, min(variant.solver_iteration_timeout, share)))
+
+  def step_hint():
+    nonlocal hint
+    (first, hint) = (hint, None) #only the first step gets the hint
+    if first is None and warm_start and best_result is not None:
+      return best_result[1]
+    return first
+
+  #returns (result, status) with status as from portfolio_worker():
+  def solve_step(max_outputs, bound, retry = False):
+    timeout = step_timeout(retry)
+    if portfolio is not None:
+      portfolio_start = time.perf_counter()
+      (result, winner) = portfolio_solve(problem, portfolio, 3 * len(problem.parties), max_outputs, bound, timeout = timeout)
+      status = "unknown" if winner is None else "sat" if result is not None else "unsat"
+      if step_instrument is not None:
+        step_instrument({"event": "solve", "engine": "portfolio", "max_outputs": max_outputs, variant.objective_bound: bound,
+                         "result": status, "solve_time": time.perf_counter() - portfolio_start,
+                         "winner": format_portfolio_config(winner) if winner is not None else None})
+      if winner is None:
+        return (None, "unknown")
+      name = format_portfolio_config(winner)
+      portfolio_wins[name] = portfolio_wins.get(name, 0) + 1
+      print("(answered first by %s)" % name)
+      return (result, "sat" if result is not None else "unsat")
+    try:
+      if session is not None:
+        result = session.solve(max_outputs, bound, timeout = timeout, hint = step_hint())
+      else:
+        result = solve_smt_problem(problem, max_outputs, bound, timeout = timeout, hint = step_hint(),
+                                   instrument = step_instrument, **encoding_options)
+    except SolverReturnedUnknownResultError:
+      return (None, "unknown")
+    return (result, "sat" if result is not None else "unsat")
+
+  #yields the solution if result improves on the best one so far, and returns (result, status):
+  def report(result, status):
+    nonlocal best_result
+    print("------------------")
+    if result is None:
+      if status == "unknown":
+        print("No solution found before the solver gave up")
+      else:
+        print("No solution found")
+    else:
+      (selected_inputs, outputs) = variant.recover_cj_config_from_model(result[1])
+      variant.print_solution(result, selected_inputs, outputs)
+      #with parallel search, answers can arrive out of order:
+      if best_result is None or result_key(problem, result) < result_key(problem, best_result):
+        best_result = result
+        yield (selected_inputs, outputs, {"num_outputs": result[0][0], variant.objective: result[0][1], "phase": phase,
+                                          "elapsed": time.monotonic() - start, "model": result[1]})
+    return (result, status)
+
+  #solve_args(bound) gives the arguments to solve_step() for the bound being searched.
+  #a retry only gets more time than a first try out of a time budget:
+  def search(solve_args, value, best, limit):
+    nonlocal optimal
+    if strategy == "parallel":
+      (_, _, settled) = yield from parallel_search_bound(lambda bound, retry: WorkerCall(portfolio_worker, problem, encoding_options,
+                                                                                         max_outputs, *solve_args(bound),
+                                                                                         step_timeout(retry)),
+                                                         value, best, limit, window, report, retry = time_budget is not None)
+    else:
+      (_, _, settled) = yield from search_bound(lambda bound, retry: report(*solve_step(*solve_args(bound), retry = retry)),
+                                                value, best, limit, strategy, retry = time_budget is not None)
+    optimal = optimal and settled
+
+  try:
+    if heuristic:
+      phase = 0
+      heuristic_start = time.perf_counter()
+      result = heuristic_solution(problem)
+      if step_instrument is not None:
+        step_instrument({"event": "heuristic", "heuristic_time": time.perf_counter() - heuristic_start,
+                         "result": "sat" if result is not None else "none"})
+      if result is not None:
+        yield from report(result, "sat")
+        print("(built by the heuristic engine)")
+        if hint is None:
+          hint = result[1]
+      phase = 1
+
+    (result, status) = yield from report(*solve_step(max_outputs, first_bound))
+    if result is None:
+      optimal = status != "unknown"
+      if explain and optimal:
+        explain_unsat(problem, bound = first_bound, **encoding_options)
+      return optimal #we couldn't even solve the initial, most relaxed constraint. bail out.
+
+    yield from search(lambda bound: (max_outputs, bound),
+                      lambda result: result[0][1],
+                      best_result[0][1], objective_limit)
+
+    phase = 2
+    bound = best_result[0][1]
+    print("Now constraining %s to %s %d and attempting to minimize transaction size" %
+          (variant.objective, ">=" if variant.maximize_objective else "<=", bound))
+    yield from search(lambda max_outputs: (max_outputs, bound),
+                      lambda result: result[0][0],
+                      best_result[0][0], fewest_outputs)
+  except TimeBudgetExhausted:
+    optimal = False
+    print("------------------")
+    print("Used up the time budget of %d ms, stopping with the best solution found so far" % time_budget)
+  finally:
+    if session is not None and own_session:
+      session.close()
+    for (name, wins) in sorted(portfolio_wins.items(), key = lambda x: x[1], reverse = True):
+      print("portfolio configuration %s answered first %d time(s)" % (name, wins))
+    if instrument is not None:
+      instrument({"event": "done", "optimal": optimal, "elapsed": time.monotonic() - start,
+                  "num_outputs": best_result[0][0] if best_result is not None else None,
+                  variant.objective: best_result[0][1] if best_result is not None else None})
+
+  return optimal
+
+#improving_solutions() for problem with options: the variant's own if it wraps the one in this module, or else this one.
+def variant_solutions(problem, **options):
+  return getattr(variant_of(problem), "improving_solutions", improving_solutions)(problem, **options)
+
+#runs variant_solutions() with options to the end, printing the solutions as it goes.
+#returns (min_outputs, objective, model, optimal), where optimal tells whether every step got a definitive answer,
+#i.e. whether the solution is proven optimal for 3 * len(parties) output slots.
+def optimization_procedure(problem, **options):
+  variant = variant_of(problem)
+  solutions = variant_solutions(problem, **options)
+  best = None
+  while True:
+    try:
+      best = next(solutions)
+    except StopIteration as done:
+      optimal = done.value
+      break
+  if best is None:
+    return (None, None, None, optimal)
+  (_, _, metrics) = best
+  return (metrics["num_outputs"], metrics[variant.objective], metrics["model"], optimal)
+
+#runs optimize_smt_problem() on the same 3 * len(parties) output slots as optimization_procedure(),
+#falling back to optimization_procedure() with the given arguments if z3 reports unknown.
+#hint and warm_start only apply to the fallback, since Optimize searches on its own.
+#z3 runs on all of the offered inputs, so shortlist (for the variants that take one) only applies to the fallback.
+#z3 only gets half of time_budget, so that the fallback still has time to find some solution.
+#returns the same as optimization_procedure().
+def native_optimization_procedure(problem, incremental = True, strategy = "linear", portfolio = None, window = None,
+                                  time_budget = None, hint = None, warm_start = False, heuristic = False, explain = False,
+                                  instrument = None, shortlist = None, **encoding_options):
+  start = time.monotonic()
+  solver_iteration_timeout = variant_of(problem).solver_iteration_timeout
+  timeout = solver_iteration_timeout if time_budget is None else min(solver_iteration_timeout, time_budget // 2)
+  try:
+    result = optimize_smt_problem(problem, 3 * len(problem.parties), timeout = timeout, instrument = instrument,
+                                  **encoding_options)
+  except SolverReturnedUnknownResultError:
+    print("------------------")
+    print("z3 Optimize could not prove an optimum, falling back to the optimization loop")
+    if time_budget is not None:
+      time_budget = max(0, time_budget - int((time.monotonic() - start) * 1000))
+    if shortlist is not None:
+      encoding_options = dict(encoding_options, shortlist = shortlist)
+    return optimization_procedure(problem, incremental = incremental, strategy = strategy, portfolio = portfolio,
+                                  window = window, time_budget = time_budget, hint = hint, warm_start = warm_start, heuristic = heuristic,
+                                  explain = explain, instrument = instrument, **encoding_options)
+  if result is None:
+    return (None, None, None, True)
+  return (result[0][0], result[0][1], result[1], True)
+
+#bisects between the value that result achieves and limit for the best result of solve(bound), which returns a
+#result at least as good as bound, or None if there is none (or the solver gave up). returns the best result found.
+def bisect_bound(solve, value, result, limit):
+  best = value(result)
+  direction = 1 if limit > best else -1
+  while (limit - best) * direction > 0:
+    bound = best + direction * ((abs(limit - best) + 1) // 2)
+    better = solve(bound)
+    if better is None:
+      limit = bound - direction
+    else:
+      result = better
+      best = value(better)
+  return result
+
+#finds the frontier points with exactly num_outputs outputs with session (a SolverSession): the best objective at any
+#txfee and the lowest txfee for it, then the same again below that txfee, and so on until no CoinJoin is left.
+#every solver call gets timeout milliseconds.
+#returns (points, proven), where points is a list of ([num_outputs, objective], model) by decreasing txfee,
+#and proven tells whether every solver call got a definitive answer.
+def pareto_slice(problem, session, num_outputs, timeout = None):
+  variant = variant_of(problem)
+  proven = True
+  def solve(bound = None, max_txfee = None):
+    nonlocal proven
+    try:
+      return session.solve(num_outputs, bound, timeout = timeout, min_outputs = num_outputs, max_txfee = max_txfee)
+    except SolverReturnedUnknownResultError:
+      proven = False
+      return None
+
+  (_, objective_limit) = variant.objective_range(problem, num_outputs)
+  min_txfee = variant.min_txfee(problem, num_outputs)
+  points = list()
+  max_txfee = None
+  while True:
+    result = solve(max_txfee = max_txfee)
+    if result is None:
+      break
+    result = bisect_bound(lambda bound: solve(bound, max_txfee), lambda r: r[0][1], result, objective_limit)
+    objective = result[0][1]
+    result = bisect_bound(lambda bound: solve(objective, bound), lambda r: r[1]["txfee"], result, min_txfee)
+    points.append(result)
+    max_txfee = result[1]["txfee"] - 1
+  return (points, proven)
+
+#runs pareto_slice() for each of the numbers of outputs in output_counts, sharing one SolverSession (built with
+#encoding_options) between them. pareto_frontier() runs it in its worker processes.
+#returns (points, proven) like pareto_slice().
+def pareto_worker(problem, encoding_options, output_counts, timeout):
+  points = list()
+  proven = True
+  with SolverSession(problem, 3 * len(problem.parties), **encoding_options) as session:
+    for num_outputs in output_counts:
+      (slice_points, slice_proven) = pareto_slice(problem, session, num_outputs, timeout)
+      points.extend(slice_points)
+      proven = proven and slice_proven
+  return (points, proven)
+
+#the optimization loop picks a single trade-off: the best objective at all costs, then the fewest outputs.
+#pareto_frontier() instead finds every CoinJoin that no other one beats on all of the number of outputs, the
+#objective and the txfee, so that a coordinator can pick a point on the frontier whenever its policy changes,
+#without solving again.
+#returns (frontier, proven), where frontier is a list of the Pareto-optimal CoinJoins by increasing number of
+#outputs, each a dict with its "num_outputs", objective and "txfee" and its "model", and proven tells whether every
+#solver call got a definitive answer (otherwise points may be missing, or beaten by CoinJoins that were not found).
+#every number of outputs from the variant's fewest_outputs() to 3 * len(parties) is searched with pareto_slice().
+#they are dealt out round-robin to workers worker processes (one per core by default), each with one SolverSession
+#for all of its numbers of outputs, or all searched in this process if workers is 1. encoding_options are passed on
+#to build_smt_encoding(), and every solver call gets timeout milliseconds (solver_iteration_timeout by default).
+def pareto_frontier(problem, workers = None, timeout = None, **encoding_options):
+  variant = variant_of(problem)
+  output_counts = list(range(variant.fewest_outputs(problem), 3 * len(problem.parties) + 1))
+  workers = max(1, min(workers if workers is not None else os.cpu_count(), len(output_counts)))
+  if workers == 1:
+    results = [pareto_worker(problem, encoding_options, output_counts, timeout)]
+  else:
+    shares = [output_counts[i::workers] for i in range(0, workers)]
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+      results = list(executor.map(pareto_worker, [problem] * workers, [encoding_options] * workers, shares,
+                                  [timeout] * workers))
+  points = list()
+  for (slice_points, _) in results:
+    for ([num_outputs, objective], model) in slice_points:
+      points.append({"num_outputs": num_outputs, variant.objective: objective, "txfee": model["txfee"], "model": model})
+  key = lambda point: (point["num_outputs"], -point[variant.objective] if variant.maximize_objective else point[variant.objective],
+                       point["txfee"])
+  dominates = lambda a, b: key(a) != key(b) and all(x <= y for (x, y) in zip(key(a), key(b)))
+  frontier = [point for point in points if not any(dominates(other, point) for other in points)]
+  return (sorted(frontier, key = key), all(proven for (_, proven) in results))
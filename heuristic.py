@@ -0,0 +1,190 @@
+#a pure-Python heuristic engine that builds valid (not necessarily optimal) CoinJoins directly, in milliseconds and
+#without pysmt or z3. its solution is a starting point for the optimization loop (see the hint argument of
+#improving_solutions() in engine.py), which then only has to improve on it or prove it optimal, and a
+#low-latency fallback for when the solver times out.
+#every party first gets its share of the biggest anonymity set: the main CoinJoin amount for maker/taker
+#CoinJoins, and nothing for perfect CoinJoins. the rest (the change) is split up by split_change().
+from itertools import combinations
+
+from verifier import amounts_spaced, output_scores, violations
+
+#the objective each variant optimizes, as named in its models:
+objective_names = {"maker-taker": "num_unique_outputs", "perfect": "anonymity_score"}
+
+def txsize(num_used_inputs, num_outputs):
+  return 11 + 68 * num_used_inputs + 31 * num_outputs
+
+#splits each party's change into outputs that share their amounts with outputs of other parties where possible:
+#the smallest change left is paid out to every party that can afford it without leaving less than min_output_amt,
+#and the rest continue with what they have left. an amount r that nobody else can match is given up as extra fees
+#where slack allows, or else matched by splitting an amount v that several parties already share into r and v - r
+#for all of them (so that both stay shared), or else becomes a party's (single) uniquely-identifiable output if
+#unique_allowed.
+#change and slack map parties to satoshis, and fee_room bounds the extra fees of all parties together.
+#returns (outputs, absorbed), where outputs is a list of (party, satoshis) tuples and absorbed maps parties to
+#the extra fees they give up, or None if some change cannot be paid out.
+def split_change(change, slack, fee_room, unique_allowed, min_output_amt):
+  remaining = dict((p, a) for (p, a) in change.items() if a > 0)
+  absorbed = dict((p, 0) for p in change.keys())
+  uniques = set()
+  outputs = list()
+
+  def absorb(party, amt):
+    nonlocal fee_room
+    if amt > min(slack.get(party, 0) - absorbed[party], fee_room):
+      return False
+    absorbed[party] += amt
+    fee_room -= amt
+    return True
+
+  while len(remaining) > 0:
+    (amt, owner) = min((a, p) for (p, a) in remaining.items())
+    if amt < min_output_amt:
+      if not absorb(owner, amt):
+        return None
+      del remaining[owner]
+      continue
+    takers = [p for (p, a) in sorted(remaining.items()) if a == amt or a - amt >= min_output_amt]
+    if len(takers) < 2:
+      if absorb(owner, amt):
+        del remaining[owner]
+        continue
+      holders = dict((v, set(p for (p, a) in outputs if a == v)) for (_, v) in outputs)
+      shared = [v for (v, h) in holders.items() if len(h) >= 2 and v - amt >= min_output_amt]
+      if len(shared) > 0:
+        v = min(shared, key = lambda v: (len([a for (_, a) in outputs if a == v]), -v)) #fewest outputs to split
+        outputs = [x for (p, a) in outputs for x in ([(p, amt), (p, v - amt)] if a == v else [(p, a)])]
+        outputs.append((owner, amt))
+        del remaining[owner]
+        continue
+      if unique_allowed and owner not in uniques:
+        uniques.add(owner)
+        takers = [owner]
+      else:
+        return None
+    for p in takers:
+      outputs.append((p, amt))
+      remaining[p] -= amt
+      if remaining[p] == 0:
+        del remaining[p]
+  return (outputs, absorbed)
+
+#builds a model like read_model() in engine.py, with the outputs in slots slots, sorted by decreasing amount
+#and then party as symmetry breaking would sort them:
+def make_model(problem, used, outputs, txfee, objective, slots):
+  outputs = sorted(outputs, key = lambda x: (x[1], x[0]), reverse = True) + [(-1, 0)] * (slots - len(outputs))
+  model = {"num_outputs": len([p for (p, _) in outputs if p != -1]),
+           objective_names[problem.variant]: objective,
+           "txfee": txfee,
+           "input_party": [problem.inputs[i][0] if i in used else -1 for i in range(0, problem.num_inputs)],
+           "input_amt": [problem.inputs[i][1] if i in used else 0 for i in range(0, problem.num_inputs)],
+           "output_party": [p for (p, _) in outputs],
+           "output_amt": [a for (_, a) in outputs]}
+  return model
+
+#every party gets the main CoinJoin amount (the taker's whole share when sweeping), and each party's change is
+#split up with one uniquely-identifiable output allowed per party. the taker can pay more than the minimum txfee.
+#tries every output count that fits in 3 * len(parties) slots, and returns the candidate with the fewest
+#uniquely-identifiable outputs, then the fewest outputs, as ([num_outputs, num_unique_outputs], model).
+def maker_taker_solution(problem):
+  slots = 3 * len(problem.parties)
+  gives = dict((p, sum(a for (q, a) in problem.inputs if q == p)) for p in problem.parties)
+  txfees = dict(problem.txfees)
+  cjfees = dict(problem.cjfee)
+  others_txfee = sum(f for (p, f) in txfees.items() if p != problem.taker)
+  others_cjfee = sum(f for (p, f) in cjfees.items() if p != problem.taker)
+  best = None
+  for guess in range(len(problem.parties), slots + 1):
+    size = txsize(problem.num_inputs, guess)
+    txfee = problem.min_feerate * size
+    gets = dict((p, gives[p] - txfees.get(p, 0) + cjfees.get(p, 0)) for p in problem.parties)
+    gets[problem.taker] = gives[problem.taker] + others_txfee - others_cjfee - txfee
+    main = problem.amt if problem.amt != 0 else gets[problem.taker]
+    if main < problem.min_output_amt or any(g < main for g in gets.values()):
+      continue
+    change = dict((p, g - main) for (p, g) in gets.items())
+    split = split_change(change, {problem.taker: problem.max_feerate * slots}, problem.max_feerate * size - txfee,
+                         True, problem.min_output_amt)
+    if split is None:
+      continue
+    (outputs, absorbed) = split
+    outputs += [(p, main) for p in problem.parties]
+    fee = sum(gives.values()) - sum(a for (_, a) in outputs)
+    size = txsize(problem.num_inputs, len(outputs))
+    if len(outputs) > slots or not (problem.min_feerate * size <= fee <= problem.max_feerate * size):
+      continue
+    if not amounts_spaced(outputs, problem.min_output_amt_delta):
+      continue
+    unique = [p for (p, score) in zip([p for (p, _) in outputs], output_scores(outputs)) if score == 0]
+    if len(unique) != len(set(unique)):
+      continue
+    if best is None or (len(unique), len(outputs)) < (best[0][1], best[0][0]):
+      best = ([len(outputs), len(unique)],
+              make_model(problem, set(range(0, problem.num_inputs)), outputs, fee, len(unique), slots))
+  return best
+
+#every selected input's owner pays a share of the minimum txfee in proportion to its selected inputs (as far as
+#its maximum contribution allows), and then all of its change is split up with no uniquely-identifiable outputs
+#allowed. tries every subset of inputs (or, with more than max_subset_inputs inputs, all of them and all but one)
+#and every output count, and returns the candidate with the highest anonymity score, then the fewest outputs,
+#as ([num_outputs, anonymity_score], model).
+def perfect_solution(problem, max_subset_inputs = 10):
+  slots = 3 * len(problem.parties)
+  max_txfees = dict(problem.txfees)
+  indices = list(range(0, problem.num_inputs))
+  if problem.num_inputs <= max_subset_inputs:
+    subsets = [set(c) for k in range(problem.num_inputs, 1, -1) for c in combinations(indices, k)]
+  else:
+    subsets = [set(indices)] + [set(indices) - {i} for i in indices]
+  best = None
+  for used in subsets:
+    num_inputs = dict((p, len([i for i in used if problem.inputs[i][0] == p])) for p in problem.parties)
+    gives = dict((p, sum(problem.inputs[i][1] for i in used if problem.inputs[i][0] == p)) for p in problem.parties)
+    for guess in range(2, slots + 1):
+      size = txsize(len(used), guess)
+      required = problem.min_feerate * size
+      fees = dict((p, min(max_txfees.get(p, 0), -(-required * num_inputs[p] // len(used)))) for p in problem.parties)
+      for p in problem.parties: #parties that are short of their share are covered by those with room to spare
+        if num_inputs[p] > 0:
+          fees[p] += max(0, min(max_txfees.get(p, 0) - fees[p], required - sum(fees.values())))
+      if sum(fees.values()) < required:
+        continue
+      change = dict((p, gives[p] - fees[p]) for p in problem.parties)
+      slack = dict((p, max_txfees.get(p, 0) - fees[p] if num_inputs[p] > 0 else 0) for p in problem.parties)
+      split = split_change(change, slack, problem.max_feerate * size - sum(fees.values()), False,
+                           problem.min_output_amt)
+      if split is None:
+        continue
+      (outputs, absorbed) = split
+      fee = sum(gives.values()) - sum(a for (_, a) in outputs)
+      size = txsize(len(used), len(outputs))
+      if len(outputs) > slots or not (problem.min_feerate * size <= fee <= problem.max_feerate * size):
+        continue
+      if not amounts_spaced(outputs, problem.min_output_amt_delta):
+        continue
+      if any(len([q for (q, _) in outputs if q == p]) > problem.max_party_fragmentation_factor * num_inputs[p]
+             for p in problem.parties):
+        continue
+      scores = output_scores(outputs)
+      if len(outputs) == 0 or 0 in scores:
+        continue
+      if best is None or (-sum(scores), len(outputs)) < (-best[0][1], best[0][0]):
+        best = ([len(outputs), sum(scores)], make_model(problem, used, outputs, fee, sum(scores), slots))
+  return best
+
+#returns a heuristic ([num_outputs, objective], model) for problem, as from solve_smt_problem() in engine.py,
+#or None if the heuristic finds no valid CoinJoin. the solution is re-checked with the verifier (see verifier.py),
+#so that a bug here can never hand the optimization loop (or a caller falling back on it) an invalid CoinJoin.
+def heuristic_solution(problem):
+  if problem.variant == "perfect":
+    result = perfect_solution(problem)
+  else:
+    result = maker_taker_solution(problem)
+  if result is None:
+    return None
+  model = result[1]
+  selected_inputs = [(p, a) for (p, a) in zip(model["input_party"], model["input_amt"]) if p != -1]
+  outputs = [(p, a) for (p, a) in zip(model["output_party"], model["output_amt"]) if p != -1]
+  if len(violations(problem, selected_inputs, outputs)) > 0:
+    return None
+  return result
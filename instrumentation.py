@@ -0,0 +1,117 @@
+#structured metrics for the solver calls of the prototypes, so that where the time goes can be graphed across
+#production rounds and pathological configs spotted. the prototypes take an instrument callback (any callable
+#taking one dict, e.g. a JsonLinesWriter) and call it with a record for every event:
+# -"encode": an encoding was built, with its "encoding_time" (seconds) and "groups", which maps every constraint
+#  group (see build_smt_encoding() in the prototypes) to its number of "assertions" and its formula DAG size
+#  ("dag_size", counting shared subformulas once)
+# -"solve": a solver call, with its bounds ("max_outputs" and "max_unique" or "min_anonymity_score", None if
+#  unbounded), its "result" ("sat", "unsat" or "unknown"), its "solve_time" and "model_time" (seconds, the latter
+#  None unless a model was extracted) and z3's "statistics" for that call alone (e.g. "conflicts", "decisions", "memory")
+# -"heuristic": the heuristic engine ran, with its "heuristic_time" and "result" ("sat", or "none" if it found nothing)
+# -"done": the optimization loop finished, with whether it is "optimal" and its total "elapsed" time
+#records from the optimization loop also carry the "phase" they belong to (see improving_solutions()).
+#"solve" records from a single solver call also carry "hinted" (whether the hint answered it, see apply_hint()) and
+#"smtlib", a function returning the SMT-LIB2 script of the call, i.e. the encoding with the bounds of the call
+#asserted. only SmtLibExporter calls it, and JsonLinesWriter leaves it out.
+import json
+import os
+import time
+
+#the formula DAG size of a list of pysmt formulas, counting every distinct subformula once:
+def dag_size(formulas):
+  seen = set()
+  stack = list(formulas)
+  while len(stack) > 0:
+    f = stack.pop()
+    if f not in seen:
+      seen.add(f)
+      stack.extend(f.args())
+  return len(seen)
+
+def group_sizes(constraint_groups):
+  return dict((name, {"assertions": len(group), "dag_size": dag_size(group)})
+              for (name, group) in constraint_groups.items())
+
+#z3's statistics that are levels or peaks (memory, the biggest tableau) rather than counts:
+def is_level(name):
+  return "memory" in name or "max" in name or name == "time"
+
+#z3's statistics from a z3 solver or optimizer, with the spaces in their names replaced. a solver that is checked
+#again (e.g. in a SolverSession) keeps counting from where its last check left off, so if before is set to the
+#statistics taken before a check, the counts are for that check alone. levels and peaks are reported as they are.
+def z3_statistics(solver, before = None):
+  stats = solver.statistics()
+  stats = dict((k.replace(" ", "_"), stats.get_key_value(k)) for k in stats.keys())
+  if before is None:
+    return stats
+  return dict((k, v if is_level(k) else v - before.get(k, 0)) for (k, v) in stats.items())
+
+#an instrument callback that writes every record as a line of JSON to a file (or stdout if path is "-"),
+#with the wall clock "time" and the given fields (e.g. a job ID) added. the file is opened for appending and every
+#line is written and flushed in one go, so several processes can share it.
+class JsonLinesWriter:
+  def __init__(self, path, **fields):
+    self.fields = fields
+    self.file = None if path == "-" else open(path, "a")
+
+  def __call__(self, record):
+    record = dict((k, v) for (k, v) in record.items() if k != "smtlib")
+    line = json.dumps(dict({"time": time.time()}, **self.fields, **record)) + "\n"
+    if self.file is None:
+      print(line, end = "", flush = True)
+    else:
+      self.file.write(line)
+      self.file.flush()
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+#an instrument callback that writes the SMT-LIB2 script of every solver call to a file of its own in directory
+#(step-0001.smt2, step-0002.smt2, ...) and a line of JSON for it to manifest.jsonl there, with the file's name, the
+#"step" number and the given fields (e.g. the z3 "tactic" the solver ran) added to the "solve" record, less its z3
+#statistics. every record is then passed on to instrument, if set. see replay_smtlib.py for re-running the scripts.
+#exporting into a directory that already holds an export adds to it: the steps are numbered on from the last one in
+#its manifest, so no earlier script is overwritten and every manifest line still names its own script.
+#the scripts name no parties or offers, but hold the input amounts, fees and config rules as constants.
+class SmtLibExporter:
+  def __init__(self, directory, instrument = None, **fields):
+    self.directory = directory
+    self.instrument = instrument
+    self.fields = fields
+    self.step = 0
+    os.makedirs(directory, exist_ok = True)
+    path = os.path.join(directory, "manifest.jsonl")
+    if os.path.exists(path):
+      with open(path) as f:
+        self.step = max([json.loads(line)["step"] for line in f if line.strip() != ""], default = 0)
+    self.manifest = open(path, "a")
+
+  def __call__(self, record):
+    if record.get("smtlib") is not None:
+      self.step += 1
+      name = "step-%04d.smt2" % self.step
+      with open(os.path.join(self.directory, name), "w") as f:
+        f.write(record["smtlib"]())
+      entry = dict((k, v) for (k, v) in record.items() if k not in ["smtlib", "statistics"])
+      self.manifest.write(json.dumps(dict({"step": self.step, "file": name}, **self.fields, **entry)) + "\n")
+      self.manifest.flush()
+    if self.instrument is not None:
+      self.instrument(record)
+
+  def close(self):
+    self.manifest.close()
+    if self.instrument is not None and hasattr(self.instrument, "close"):
+      self.instrument.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
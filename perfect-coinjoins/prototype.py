@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
-from pysmt.shortcuts import Symbol, And, Or, Not, Ite, GT, GE, LT, LE, Plus, Minus, Times, Equals, Int, Solver, get_model
-from pysmt.exceptions import SolverReturnedUnknownResultError
+from pysmt.shortcuts import Symbol, And, Or, Not, Implies, Ite, GT, GE, LT, LE, Plus, Minus, Times, Equals, Int, get_model
 from pysmt.logics import QF_UFLIRA
 from pysmt.typing import INT
-from functools import reduce
 from secrets import randbelow
+import argparse
+import os
 import sys
+import time
+
+try:
+  import coinjoin
+except ImportError: #run as a script, so the shared modules one directory up are not on the path yet
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  import coinjoin
+from coinjoin import CoinJoinProblem
+import engine as solver_engine
+from engine import SolverSession, bitvector_tactic, bound_domains, build_amount_classes, default_portfolio, explain_unsat, \
+                   optimization_procedure, native_optimization_procedure, pareto_frontier
+from heuristic import heuristic_solution, make_model, output_scores
+from instrumentation import JsonLinesWriter, SmtLibExporter
+
+#run as a script, this module is __main__, and the engine should solve with it rather than load it again:
+coinjoin.variants.setdefault("perfect", sys.modules[__name__])
+
 
 #Example community CoinJoin config:
 min_feerate = 5 #sats per vbyte target minimum
@@ -20,19 +37,10 @@ example_inputs = [(1, 100000000), (2, 130000000), (3, 70000000), (3, 70000000)]
 #a set of (party, satoshis) tuples, maximum amounts each party is willing to pay
 example_txfees = {(1, 757), (2, 500), (3, 1337)}
 
-#auto-calculated constants given the example configuration above: 
-parties = range(1, len(example_txfees) + 1)
-num_inputs = len(example_inputs)
-
-def parse_model_lines(model_lines):
-  ret = dict()
-  for line in model_lines:
-    split = line.split(' := ')
-    k = split[0]
-    v = split[1]
-    ret[k] = int(v)
-
-  return ret
+def example_problem():
+  return CoinJoinProblem("perfect", example_inputs, example_txfees, min_feerate = min_feerate, max_feerate = max_feerate,
+                         min_output_amt = min_output_amt, min_output_amt_delta = min_output_amt_delta,
+                         max_party_fragmentation_factor = max_party_fragmentation_factor)
 
 def recover_cj_config_from_model(model):
   selected_inputs = list()
@@ -40,18 +48,18 @@ def recover_cj_config_from_model(model):
   input_buf = list()
   output_buf = list()
 
-  for i in range(0, model["max_outputs"]):
-    party = model["output_party[%d]" % i]
-    amt = model["output_amt[%d]" % i]
+  for i in range(0, len(model["output_party"])):
+    party = model["output_party"][i]
+    amt = model["output_amt"][i]
     if party != -1:
       output_buf.append((party, amt))
   while len(output_buf) > 0:
     x = randbelow(len(output_buf))
     outputs.append(output_buf.pop(x))
 
-  for i in range(0, num_inputs):
-    party = model["input_party[%d]" % i]
-    amt = model["input_amt[%d]" % i]
+  for i in range(0, len(model["input_party"])):
+    party = model["input_party"][i]
+    amt = model["input_amt"][i]
     if party != -1:
       input_buf.append((party, amt))
   while len(input_buf) > 0:
@@ -63,13 +71,35 @@ def recover_cj_config_from_model(model):
 def bool_to_int(x):
     return Ite(x, Int(1), Int(0))
 
-def solve_smt_problem(max_outputs, min_anonymity_score = None, timeout = None):
+#builds the base encoding for a CoinJoin with up to max_outputs outputs, without any optimization bounds.
+#returns (constraint_groups, symbols), where constraint_groups maps a group name to its list of constraints
+#and symbols holds the variables that bounds and model extraction need to refer to.
+#besides the groups by kind of constraint, every input (input[i]), every per-party rule (txfee_cap[party], fragmentation[party])
+#and every config rule (no_unique_outputs, min_feerate, max_feerate, min_output_amt_delta) has a group of its own.
+#if symmetry_breaking is set, the interchangeable output slots are additionally forced into a canonical order.
+#encoding picks how the anonymity set and min delta constraints are built:
+# -"pairwise" compares every pair of output slots
+# -"classes" assigns outputs to num_amount_classes amount classes (see build_amount_classes() in engine.py) and counts them.
+#  by default there are just enough classes never to rule out a solution: no output may be uniquely
+#  identifiable, so every class used holds at least two outputs.
+#amounts picks how the integer variables (satoshi amounts, fees, counts and party IDs) are encoded:
+# -"int" leaves them unbounded
+# -"bounded" bounds them all explicitly, see bound_domains() in engine.py
+# -"bitvector" bounds them the same way, and the solvers then bit-blast them as fixed-width bit-vectors
+#  (see bitvector_tactic)
+def build_smt_encoding(problem, max_outputs, symmetry_breaking = False, encoding = "pairwise", num_amount_classes = None,
+                       amounts = "int"):
   #constraints:
   input_constraints = set()
+  symmetry_breaking_constraints = set()
   output_constraints = set()
   anonymityset_constraints = set()
   txfee_constraints = set()
   invariants = set()
+  #constraints on a single input, party or config rule, in groups of their own so that unsat_core() can blame them:
+  named_constraints = dict()
+  def add_named(name, constraint):
+    named_constraints.setdefault(name, list()).append(constraint)
 
   #variables:
   total_in = Symbol("total_in", INT) #total satoshis from inputs
@@ -90,13 +120,13 @@ def solve_smt_problem(max_outputs, min_anonymity_score = None, timeout = None):
   output_amt = dict() #index into outputs -> satoshis sent to that output
   output_score = dict() #index into outputs -> number of other outputs in the same amount not owned by that output's owner
 
-  for (party, _) in example_txfees:
+  for (party, _) in problem.txfees:
     party_gives[party] = Symbol("party_gives[%d]" % party, INT)
     party_gets[party] = Symbol("party_gets[%d]" % party, INT)
     party_txfee[party] = Symbol("party_txfee[%d]" % party, INT)
     party_numinputs[party] = Symbol("party_numinputs[%d]" % party, INT)
     party_numoutputs[party] = Symbol("party_numoutputs[%d]" % party, INT)
-  for i in range(0, num_inputs):
+  for i in range(0, problem.num_inputs):
     input_party[i] = Symbol("input_party[%d]" % i, INT)
     input_amt[i] = Symbol("input_amt[%d]" % i, INT)
   for i in range(0, max_outputs):
@@ -107,20 +137,20 @@ def solve_smt_problem(max_outputs, min_anonymity_score = None, timeout = None):
   #constraint construction:
 
   #party_txfee constraints:
-  for (party, fee_contribution) in example_txfees:
-    txfee_constraints.add(LE(party_txfee[party], Int(fee_contribution)))
+  for (party, fee_contribution) in problem.txfees:
+    add_named("txfee_cap[%d]" % party, LE(party_txfee[party], Int(fee_contribution)))
 
   #input_party and input_amt bindings:
-  for i in range(0, num_inputs):
+  for i in range(0, problem.num_inputs):
     input_used_conditions = And(Equals(input_party[i],
-                                       Int(example_inputs[i][0])),
+                                       Int(problem.inputs[i][0])),
                                 Equals(input_amt[i],
-                                       Int(example_inputs[i][1])))
+                                       Int(problem.inputs[i][1])))
     input_not_used_conditions = And(Equals(input_party[i],
                                            Int(-1)),
                                      Equals(input_amt[i],
                                            Int(0)))
-    input_constraints.add(Or(input_used_conditions, input_not_used_conditions))
+    add_named("input[%d]" % i, Or(input_used_conditions, input_not_used_conditions))
 
   #add constraints on output_party and output_amt:
   # -either output_party[i] == -1 and output_amt[i] == 0
@@ -130,32 +160,47 @@ def solve_smt_problem(max_outputs, min_anonymity_score = None, timeout = None):
     output_is_unused = Equals(output_party[i],
                               Int(-1))
     output_unused.append(output_is_unused)
-    min_delta_satisfied = Or(output_is_unused,
-                             And([Or(Equals(output_amt[i],
-                                            output_amt[j]),
-                                     Or(GE(output_amt[j],
-                                           Plus(output_amt[i],
-                                                Int(min_output_amt_delta))),
-                                        LE(output_amt[j],
-                                           Minus(output_amt[i],
-                                                 Int(min_output_amt_delta)))))\
-                                  for j in filter(lambda j: j != i, range(0, max_outputs))]))
-    output_constraints.add(min_delta_satisfied)
+    if encoding == "pairwise": #the amount classes enforce this themselves
+      min_delta_satisfied = Or(output_is_unused,
+                               And([Or(Equals(output_amt[i],
+                                              output_amt[j]),
+                                       Or(GE(output_amt[j],
+                                             Plus(output_amt[i],
+                                                  Int(problem.min_output_amt_delta))),
+                                          LE(output_amt[j],
+                                             Minus(output_amt[i],
+                                                   Int(problem.min_output_amt_delta)))))\
+                                    for j in filter(lambda j: j != i, range(0, max_outputs))]))
+      add_named("min_output_amt_delta", min_delta_satisfied)
     output_constraints.add(Ite(output_is_unused,
                                Equals(output_amt[i],
                                       Int(0)),
                                GT(output_amt[i],
-                                  Int(min(0, min_output_amt-1)))))
+                                  Int(max(0, problem.min_output_amt-1)))))
+  #output slots are interchangeable (recover_cj_config_from_model() shuffles them anyway), so the solver would
+  #otherwise explore every permutation of each candidate. if requested, sort the slots by decreasing amount
+  #and then by decreasing party, which also puts the unused slots (amount 0, party -1) last:
+  if symmetry_breaking:
+    for i in range(0, max_outputs - 1):
+      symmetry_breaking_constraints.add(Or(GT(output_amt[i],
+                                              output_amt[i + 1]),
+                                           And(Equals(output_amt[i],
+                                                      output_amt[i + 1]),
+                                               GE(output_party[i],
+                                                  output_party[i + 1]))))
   #calculate num_outputs and bind max_outputs:
   output_constraints.add(Equals(num_outputs, Plus([bool_to_int(Not(x)) for x in output_unused])))
   output_constraints.add(Equals(max_outputs_sym, Int(max_outputs)))
+  #a transaction that only pays fees is no CoinJoin. without this rule, inputs too small to fund any output could
+  #all be given away as txfee, which the verifier rejects (rule "outputs") and prune_inputs() already assumes away:
+  output_constraints.add(GE(num_outputs, Int(1)))
 
   #txfee, party_gets, and party_gives calculation/constraints/binding:
-  for party in parties:
+  for party in problem.parties:
     #party_gives and input constraint/invariant
     owned_vec = list()
     amt_vec = list()
-    for i in range(0, num_inputs):
+    for i in range(0, problem.num_inputs):
       owned = Equals(input_party[i],
                      Int(party))
       amt = Ite(owned, input_amt[i], Int(0))
@@ -182,35 +227,66 @@ def solve_smt_problem(max_outputs, min_anonymity_score = None, timeout = None):
     output_constraints.add(Equals(party_numoutputs[party], Plus(owned_vec)))
 
     #build party fragmentation constraints:
-    output_constraints.add(LE(party_numoutputs[party],
-                              Times(Int(max_party_fragmentation_factor),
-                                    party_numinputs[party])))
+    add_named("fragmentation[%d]" % party, LE(party_numoutputs[party],
+                                              Times(Int(problem.max_party_fragmentation_factor),
+                                                    party_numinputs[party])))
 
   #build anonymity set constraints:
-  #each party should not have any uniquely-identifiable output:
-  for (idx, amt) in output_amt.items():
-    not_unique = Or(Equals(output_party[idx],
-                           Int(-1)),
-                    Or([And(Equals(v,
-                                   amt),
-                            Not(Equals(output_party[k],
-                                       output_party[idx])))\
-                        for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]))
-    anonymityset_constraints.add(not_unique)
-
-  #constrain the anonymity score, if set:
-  def score_output(idx):  #how many other outputs in the same amount that do not belong to us?
-    outputs_equal_not_ours = [And(Equals(v,
-                                         output_amt[idx]),
-                                  Not(Equals(output_party[k],
-                                             output_party[idx])))\
-                              for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]
-    score = Plus([bool_to_int(x) for x in outputs_equal_not_ours])
-    anonymityset_constraints.add(Equals(output_score[idx], score))
-    return score
-  anonymityset_constraints.add(Equals(anonymity_score, Plus([score_output(idx) for (idx, _) in output_amt.items()])))
-  if min_anonymity_score is not None:
-    anonymityset_constraints.add(GE(anonymity_score, Int(min_anonymity_score)))
+  if encoding == "classes":
+    if num_amount_classes is None:
+      num_amount_classes = max(1, max_outputs // 2)
+    (in_class, class_count) = build_amount_classes(problem, output_party, output_amt, num_amount_classes, anonymityset_constraints)
+    class_party_count = dict() #amount class -> party ID -> number of outputs in that class belonging to that party
+    for c in range(0, num_amount_classes):
+      class_party_count[c] = dict()
+      for party in problem.parties:
+        class_party_count[c][party] = Symbol("class_party_count[%d][%d]" % (c, party), INT)
+        anonymityset_constraints.add(Equals(class_party_count[c][party],
+                                            Plus([bool_to_int(And(in_class[i][c],
+                                                                  Equals(output_party[i],
+                                                                         Int(party))))\
+                                                  for i in range(0, max_outputs)])))
+        #each party should not have any uniquely-identifiable output:
+        add_named("no_unique_outputs", Or(Equals(class_party_count[c][party],
+                                                 Int(0)),
+                                          LT(class_party_count[c][party],
+                                             class_count[c])))
+
+    #constrain the anonymity score, if set.
+    #an output scores the number of outputs in its class that belong to other parties:
+    for i in range(0, max_outputs):
+      anonymityset_constraints.add(Equals(output_score[i],
+                                          Plus([Ite(And(in_class[i][c],
+                                                        Equals(output_party[i],
+                                                               Int(party))),
+                                                    Minus(class_count[c],
+                                                          class_party_count[c][party]),
+                                                    Int(0))\
+                                                for c in range(0, num_amount_classes) for party in problem.parties])))
+    anonymityset_constraints.add(Equals(anonymity_score, Plus([output_score[i] for i in range(0, max_outputs)])))
+  else:
+    #each party should not have any uniquely-identifiable output:
+    for (idx, amt) in output_amt.items():
+      not_unique = Or(Equals(output_party[idx],
+                             Int(-1)),
+                      Or([And(Equals(v,
+                                     amt),
+                              Not(Equals(output_party[k],
+                                         output_party[idx])))\
+                          for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]))
+      add_named("no_unique_outputs", not_unique)
+
+    #constrain the anonymity score, if set:
+    def score_output(idx):  #how many other outputs in the same amount that do not belong to us?
+      outputs_equal_not_ours = [And(Equals(v,
+                                           output_amt[idx]),
+                                    Not(Equals(output_party[k],
+                                               output_party[idx])))\
+                                for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]
+      score = Plus([bool_to_int(x) for x in outputs_equal_not_ours])
+      anonymityset_constraints.add(Equals(output_score[idx], score))
+      return score
+    anonymityset_constraints.add(Equals(anonymity_score, Plus([score_output(idx) for (idx, _) in output_amt.items()])))
 
   #set transaction invariants:
   invariants.add(Equals(total_in, Plus(total_out, txfee)))
@@ -220,92 +296,533 @@ def solve_smt_problem(max_outputs, min_anonymity_score = None, timeout = None):
   invariants.add(Equals(total_out, Plus([v for (k, v) in party_gets.items()])))
 
   #build txfee calculation constraint: 11 + 68 * num_inputs + 31 * num_outputs
-  num_used_inputs = Plus([party_numinputs[party] for party in parties])
+  num_used_inputs = Plus([party_numinputs[party] for party in problem.parties])
   txfee_constraints.add(Equals(txsize,
                                Plus(Plus(Int(11),
                                          Times(Int(68),
                                                num_used_inputs)),
                                     Times(Int(31),
                                           num_outputs))))
-  txfee_constraints.add(GE(txfee, Times(txsize, Int(min_feerate))))
-  txfee_constraints.add(LE(txfee, Times(txsize, Int(max_feerate))))
-
-  #finish problem construction:
-  constraints = list()
-  for x in [input_constraints, invariants, txfee_constraints,
-            output_constraints, anonymityset_constraints]:
-    for c in x:
-      constraints.append(c)
-  problem = And(constraints)
-
-  with Solver(name='z3', solver_options={'timeout': solver_iteration_timeout}) as s:
-    try:
-      if s.solve([problem]):
-        model_lines = sorted(str(s.get_model()).replace("'", "").split('\n'))
-        result = ([s.get_py_value(num_outputs), s.get_py_value(anonymity_score)], parse_model_lines(model_lines))
-        return result
-      else:
-        return None
-    except SolverReturnedUnknownResultError:
-      return None
+  add_named("min_feerate", GE(txfee, Times(txsize, Int(problem.min_feerate))))
+  add_named("max_feerate", LE(txfee, Times(txsize, Int(problem.max_feerate))))
 
-def optimization_procedure():
-  max_outputs = 3 * len(parties)
-  min_outputs = max_outputs
-  min_anonymity_score = 0
-  anonymity_score_maximized = False
-  best_model = None
+  #bound every integer variable, if requested:
+  domain_constraints = list()
+  if amounts != "int":
+    groups = [input_constraints, invariants, txfee_constraints, output_constraints, anonymityset_constraints,
+              symmetry_breaking_constraints] + list(named_constraints.values())
+    domain_constraints = bound_domains(problem, max_outputs, groups)
 
+  #finish problem construction:
+  constraint_groups = {"input_constraints": list(input_constraints),
+                       "invariants": list(invariants),
+                       "txfee_constraints": list(txfee_constraints),
+                       "output_constraints": list(output_constraints),
+                       "anonymityset_constraints": list(anonymityset_constraints),
+                       "symmetry_breaking_constraints": list(symmetry_breaking_constraints),
+                       "domain_constraints": domain_constraints}
+  constraint_groups.update(named_constraints)
+  symbols = {"num_outputs": num_outputs,
+             "anonymity_score": anonymity_score,
+             "txfee": txfee,
+             "input_party": input_party,
+             "input_amt": input_amt,
+             "output_party": output_party,
+             "output_amt": output_amt}
+  return (constraint_groups, symbols)
+
+#builds the constraints for the bounds tightened by the optimization procedure:
+#min_outputs and max_txfee are only used by the Pareto search, see pareto_frontier().
+def bound_constraints(symbols, max_outputs = None, min_anonymity_score = None, min_outputs = None, max_txfee = None):
+  bounds = list()
+  #constrain (if set) the number of outputs actually used.
+  #slots are interchangeable, so we may as well require the unused ones to be the trailing slots,
+  #which keeps the problem as small as one built with only max_outputs slots:
+  if max_outputs is not None:
+    bounds.append(LE(symbols["num_outputs"],
+                     Int(max_outputs)))
+    for i in range(max_outputs, len(symbols["output_party"])):
+      bounds.append(Equals(symbols["output_party"][i],
+                           Int(-1)))
+  #constrain the anonymity score, if set:
+  if min_anonymity_score is not None:
+    bounds.append(GE(symbols["anonymity_score"],
+                     Int(min_anonymity_score)))
+  if min_outputs is not None:
+    bounds.append(GE(symbols["num_outputs"],
+                     Int(min_outputs)))
+  if max_txfee is not None:
+    bounds.append(LE(symbols["txfee"],
+                     Int(max_txfee)))
+  return bounds
+
+#what the engine (see engine.py) optimizes: first the highest anonymity score, then the fewest outputs.
+#the bound on the objective is called min_anonymity_score in the records of the solver calls and in unsat cores.
+objective = "anonymity_score"
+objective_bound = "min_anonymity_score"
+maximize_objective = True
+
+#the bound on the anonymity score the search starts from, and the highest it could be with num_outputs outputs:
+#every output can at best share its amount with all the other outputs.
+def objective_range(problem, num_outputs):
+  return (0, num_outputs * (num_outputs - 1))
+
+#no output may be uniquely identifiable, so there are at least two:
+def fewest_outputs(problem):
+  return 2
+
+#a CoinJoin spends at least one input:
+def min_txfee(problem, num_outputs):
+  return problem.min_feerate * (11 + 68 + 31 * num_outputs)
+
+def print_solution(result, selected_inputs, outputs):
+  print("%d inputs, %d outputs with anonymity score %d" % (len(selected_inputs), result[0][0], result[0][1]))
+  print("inputs:")
+  print(selected_inputs)
+  print("outputs:")
+  print(outputs)
+
+#drops offered inputs that cannot be in any perfect CoinJoin, until there is nothing more to drop.
+#fees can shift satoshis between parties: a party gets at most what it brings plus the maximum txfee contributions
+#of the other parties with inputs left, and pays at most its own maximum txfee contribution. so:
+# -a party can only get an output if that much reaches min_output_amt. every output needs an output of the same
+#  amount from another party, so if fewer than two parties can get an output, there is no CoinJoin at all
+# -an input is dropped if it is bigger than its party could ever get back plus its maximum txfee contribution.
+#  a party that can get outputs gets at most max_party_fragmentation_factor outputs per input, each no bigger than
+#  what another party that can get outputs could get. a party that cannot get outputs gets nothing back, so it can
+#  only keep inputs it could give away entirely as txfee
+#returns the indices into problem.inputs of the inputs kept. this never drops an input that some CoinJoin the
+#encoding allows could use, so if it drops them all, there is no perfect CoinJoin for problem.
+def prune_inputs(problem):
+  max_txfees = dict(problem.txfees)
+  kept = list(range(0, problem.num_inputs))
   while True:
-    if not anonymity_score_maximized:
-      anonymity_score_threshold = min_anonymity_score + 1 if min_anonymity_score != 0 else 0
-      result = solve_smt_problem(max_outputs, anonymity_score_threshold, timeout = solver_iteration_timeout)
+    totals = dict() #party ID -> satoshis on its inputs kept so far
+    counts = dict() #party ID -> number of its inputs kept so far
+    for i in kept:
+      (party, amt) = problem.inputs[i]
+      totals[party] = totals.get(party, 0) + amt
+      counts[party] = counts.get(party, 0) + 1
+    fee_slack = sum(max_txfees.get(party, 0) for party in totals)
+    max_gets = dict() #party ID -> most satoshis it could get on its outputs, or 0 if it cannot get any output
+    for (party, total) in totals.items():
+      max_gets[party] = total + fee_slack - max_txfees.get(party, 0)
+      if max_gets[party] < problem.min_output_amt:
+        max_gets[party] = 0
+    if len([party for party in max_gets if max_gets[party] > 0]) < 2:
+      return list()
+    def possible(i):
+      (party, amt) = problem.inputs[i]
+      others = [gets for (p, gets) in max_gets.items() if p != party]
+      gets_back = 0
+      if max_gets[party] > 0:
+        gets_back = min(max_gets[party], problem.max_party_fragmentation_factor * counts[party] * max(others))
+      return amt - max_txfees.get(party, 0) <= gets_back
+    still_kept = [i for i in kept if possible(i)]
+    if len(still_kept) == len(kept):
+      return kept
+    kept = still_kept
+
+#groups inputs (indices into problem.inputs) whose amounts are close enough to become equal outputs through fees
+#alone: in order of amount, an input joins the previous input's cluster if it is at most the biggest maximum txfee
+#contribution above it. returns the clusters as lists of indices, by increasing amount.
+def cluster_inputs(problem, indices):
+  tolerance = max(fee for (_, fee) in problem.txfees)
+  clusters = list()
+  for i in sorted(indices, key = lambda i: problem.inputs[i][1]):
+    if len(clusters) > 0 and problem.inputs[i][1] - problem.inputs[clusters[-1][-1]][1] <= tolerance:
+      clusters[-1].append(i)
     else:
-      result = solve_smt_problem(min_outputs - 1, min_anonymity_score, timeout = solver_iteration_timeout)
-
-    if result is None:
-      print("------------------")
-      print("No solution found")
-      if not anonymity_score_maximized:
-        if best_model is None:
-          return (None, None, None) #we couldn't even solve the initial, most relaxed constraint. bail out.
-        else:
-          anonymity_score_maximized = True
-          print("Now constraining anonymity score to >= %d and attempting to minimize transaction size" % min_anonymity_score)
-      else:
-        break
+      clusters.append([i])
+  return clusters
+
+#ranks inputs (indices into problem.inputs) for the shortlist: first those in clusters (see cluster_inputs())
+#spanning more parties, which form anonymity sets without splitting off any change, then bigger amounts first.
+#inputs too small to fund an output on their own come last, however many parties offer the same amount.
+def rank_inputs(problem, indices):
+  cluster_parties = dict() #index into inputs -> number of parties with inputs in its cluster
+  for cluster in cluster_inputs(problem, indices):
+    parties = len(set(problem.inputs[i][0] for i in cluster))
+    for i in cluster:
+      cluster_parties[i] = parties
+  return sorted(indices, key = lambda i: (problem.inputs[i][1] < problem.min_output_amt, -cluster_parties[i],
+                                         -problem.inputs[i][1], i))
+
+#problem with only the inputs at indices (in that order) on offer, for the same parties and fees:
+def restrict_problem(problem, indices):
+  return CoinJoinProblem("perfect", [problem.inputs[i] for i in indices], problem.txfees,
+                         min_feerate = problem.min_feerate, max_feerate = problem.max_feerate,
+                         min_output_amt = problem.min_output_amt, min_output_amt_delta = problem.min_output_amt_delta,
+                         max_party_fragmentation_factor = problem.max_party_fragmentation_factor)
+
+#maps a model for restrict_problem(problem, indices) back to the input slots of problem, leaving out the rest:
+def expand_model(problem, model, indices):
+  expanded = dict(model)
+  expanded["input_party"] = [-1] * problem.num_inputs
+  expanded["input_amt"] = [0] * problem.num_inputs
+  for (j, i) in enumerate(indices):
+    expanded["input_party"][i] = model["input_party"][j]
+    expanded["input_amt"][i] = model["input_amt"][j]
+  return expanded
+
+#solves problem on a shortlist of its offered inputs, for pools of offers too big to search all at once.
+#the inputs that prune_inputs() keeps are ranked with rank_inputs(), and improving_solutions() (with loop_options
+#and encoding_options) runs on the top shortlist of them. only if that is proven infeasible is the shortlist
+#doubled, and so on up to all the inputs kept. time_budget (in milliseconds) covers all the rounds together.
+#if explain is set, an infeasible round also reports its minimal core (see explain_unsat()), and the inputs of the
+#parties it blames move to the front of the inputs still left out, so the widened shortlist gives those parties
+#more to work with (more amounts to match, and room for more outputs under the fragmentation factor).
+#the core only reorders the inputs left out of the shortlist: nothing it blames is relaxed or dropped, and every
+#round is solved under the same rules as the full problem, which keeps a solution found valid for it.
+#yields and returns like improving_solutions(), with the models mapped back to all of problem's inputs and
+#metrics["shortlist"] set to the number of inputs on the shortlist. since the pruning never drops an input that
+#could be used, the last solution is proven optimal if the last round had all the inputs kept.
+#an instrument in loop_options also gets a "shortlist" record at the start of every round.
+def shortlisted_solutions(problem, shortlist, loop_options, time_budget = None, explain = False, **encoding_options):
+  start = time.monotonic()
+  ranked = rank_inputs(problem, prune_inputs(problem))
+  print("Kept %d of %d offered inputs after pruning" % (len(ranked), problem.num_inputs))
+  if len(ranked) == 0:
+    return True #prune_inputs() only drops every input if no perfect CoinJoin is possible
+  size = min(max(1, shortlist), len(ranked))
+  while True:
+    print("Solving with a shortlist of the %d most promising inputs" % size)
+    if loop_options.get("instrument") is not None:
+      loop_options["instrument"]({"event": "shortlist", "shortlist": size, "kept": len(ranked)})
+    remaining = None
+    if time_budget is not None:
+      remaining = time_budget - int((time.monotonic() - start) * 1000)
+      if remaining < 1:
+        return False
+    indices = ranked[:size]
+    restricted = restrict_problem(problem, indices)
+    solutions = improving_solutions(restricted, time_budget = remaining, **loop_options, **encoding_options)
+    found = False
+    try:
+      while True:
+        try:
+          (_, _, metrics) = next(solutions)
+        except StopIteration as done:
+          optimal = done.value
+          break
+        found = True
+        model = expand_model(problem, metrics["model"], indices)
+        (selected_inputs, outputs) = recover_cj_config_from_model(model)
+        yield (selected_inputs, outputs, dict(metrics, model = model, shortlist = size,
+                                              elapsed = time.monotonic() - start))
+    finally:
+      solutions.close()
+    if found or not optimal or size == len(ranked):
+      return optimal and size == len(ranked)
+    print("No perfect CoinJoin with the shortlist, widening it")
+    if explain: #only reorders what the widened shortlist takes next, see above
+      blamed = core_parties(restricted, explain_unsat(restricted, bound = 0, **encoding_options) or [])
+      left_out = ranked[size:]
+      ranked = ranked[:size] + [i for i in left_out if problem.inputs[i][0] in blamed] + \
+                               [i for i in left_out if problem.inputs[i][0] not in blamed]
+    size = min(2 * size, len(ranked))
+
+#the parties that the groups in a core from unsat_core() for problem are about:
+def core_parties(problem, core):
+  parties = set()
+  for name in core:
+    (kind, _, index) = name.partition("[")
+    if kind in ["txfee_cap", "fragmentation"]:
+      parties.add(int(index.rstrip("]")))
+    elif kind == "input":
+      parties.add(problem.inputs[int(index.rstrip("]"))][0])
+  return parties
+
+#engine.py's improving_solutions(), which takes and yields the same, unless shortlist is set: then the search runs on a
+#shortlist of that many offered inputs first, see shortlisted_solutions(). a hint or a session for all of the
+#offered inputs does not fit the shortlist, so they are not used then.
+def improving_solutions(problem, incremental = True, strategy = "linear", portfolio = None, window = None, time_budget = None,
+                        hint = None, warm_start = False, heuristic = False, explain = False, instrument = None, session = None, shortlist = None,
+                        **encoding_options):
+  if shortlist is not None:
+    loop_options = {"incremental": incremental, "strategy": strategy, "portfolio": portfolio, "window": window,
+                    "warm_start": warm_start, "heuristic": heuristic, "instrument": instrument}
+    return (yield from shortlisted_solutions(problem, shortlist, loop_options, time_budget = time_budget, explain = explain,
+                                             **encoding_options))
+  return (yield from solver_engine.improving_solutions(problem, incremental = incremental, strategy = strategy,
+                                                       portfolio = portfolio, window = window, time_budget = time_budget, hint = hint,
+                                                       warm_start = warm_start, heuristic = heuristic, explain = explain,
+                                                       instrument = instrument, session = session, **encoding_options))
+
+#a CoinJoin round whose offers change while the coordinator runs it: parties that fail to respond by the deadline
+#drop out, inputs are withdrawn and late offers arrive. instead of a full re-run for every change, the round keeps
+#a SolverSession (built with encoding_options) and its best solution across re-solves. the session is built for
+#the round as it stands (see offered_problem()): only the inputs on offer, and 3 output slots for every party that
+#still offers any.
+# -inputs withdrawn by a party that still offers others are ruled out in the session with
+#  SolverSession.exclude_inputs(), so the solver keeps the lemmas it has learned
+# -once a party has nothing left on offer (e.g. after drop_parties()), its 3 output slots and its inputs would
+#  only make every solver call search and refute more, which costs far more than encoding the smaller round, so
+#  the session is built again for the next re-solve instead
+# -late offers need input and output slots the encoding does not have, and the amounts, parties and maximum txfee
+#  contributions of the offers are constants of the encoding, so no slots can be set aside for them in advance.
+#  instead the round is re-encoded for the next re-solve, once however many offers arrive before it. the best
+#  solution so far is still a solution with the new offers left unused, so the search starts from it.
+#every re-solve first checks the best solution so far with the departed parties taken out (see repaired_model())
+#in the session, so against the bounds of the round as it stands, which settles the common case of a
+#non-responsive party within one cheap solver call, and then searches on from it as from a hint.
+#if time_budget (in milliseconds) is set, it covers the whole round: every re-solve gets at most what is left of it,
+#re-encoding included, and once it is used up a re-solve keeps the best solution so far without solving.
+class CoinJoinRound:
+  def __init__(self, problem, time_budget = None, **encoding_options):
+    self.problem = problem
+    self.encoding_options = encoding_options
+    self.deadline = time.monotonic() + time_budget / 1000 if time_budget is not None else None
+    self.excluded = set() #indices into problem.inputs of the inputs no longer on offer
+    self.model = None #the last solution yielded, as from read_model(), which may predate later changes to the round
+    self.session = None #built by the next re-solve, see offered_problem()
+    self.session_inputs = None #indices into problem.inputs of the inputs of the session's problem
+    self.session_parties = None #party IDs in problem of the parties of the session's problem, by their IDs there - 1
+
+  #drops the given parties from the round, along with all of their inputs:
+  def drop_parties(self, parties):
+    self.withdraw_inputs([i for (i, (party, _)) in enumerate(self.problem.inputs) if party in parties])
+
+  #takes the inputs at indices (into problem.inputs) off the offer:
+  def withdraw_inputs(self, indices):
+    indices = set(indices) - self.excluded
+    self.excluded |= indices
+    if self.session is None: #they are left out when the session is built
+      return
+    if self.offered_problem()[2] != self.session_parties:
+      self.session.close()
+      self.session = None #built again for the smaller round by the next re-solve
     else:
-      print("------------------")
-      min_outputs = result[0][0]
-      min_anonymity_score = result[0][1]
-      best_model = result[1]
-      (selected_inputs, outputs) = recover_cj_config_from_model(best_model)
-      print("%d inputs, %d outputs with anonymity score %d" % (len(selected_inputs), min_outputs, min_anonymity_score))
-      print("inputs:")
-      print(selected_inputs)
-      print("outputs:")
+      self.session.exclude_inputs(sorted(self.session_inputs.index(i) for i in indices))
+
+  #adds late offers: inputs as a list of (party, satoshis) tuples, and txfees as a set of (party, satoshis) tuples,
+  #the maximum contribution of each new party (numbered on from the last party) or a raised one for a party that
+  #offers more inputs. the new inputs go after the existing ones, so indices into problem.inputs stay valid.
+  #raises ValueError if an input belongs to a party without a maximum contribution.
+  def add_offers(self, inputs, txfees = ()):
+    max_txfees = dict(self.problem.txfees)
+    max_txfees.update(dict(txfees))
+    if sorted(max_txfees.keys()) != list(range(1, len(max_txfees) + 1)):
+      raise ValueError("new parties must be numbered on from party %d" % len(self.problem.parties))
+    if any(party not in max_txfees for (party, _) in inputs):
+      raise ValueError("every party offering inputs needs a maximum txfee contribution")
+    p = self.problem
+    self.problem = CoinJoinProblem("perfect", p.inputs + list(inputs), set(max_txfees.items()),
+                                   min_feerate = p.min_feerate, max_feerate = p.max_feerate,
+                                   min_output_amt = p.min_output_amt, min_output_amt_delta = p.min_output_amt_delta,
+                                   max_party_fragmentation_factor = p.max_party_fragmentation_factor)
+    if self.model is not None:
+      self.model = expand_model(self.problem, self.model, range(0, p.num_inputs))
+    if self.session is not None:
+      self.session.close()
+      self.session = None #built again by the next re-solve
+
+  #the round as it stands: returns (problem, inputs, parties), where problem has only the inputs on offer and only
+  #the parties that still offer any, numbered from 1 in order, inputs lists the indices into self.problem.inputs of
+  #its inputs, and parties the party IDs in self.problem of its parties.
+  def offered_problem(self):
+    p = self.problem
+    inputs = [i for i in range(0, p.num_inputs) if i not in self.excluded]
+    parties = sorted(set(p.inputs[i][0] for i in inputs))
+    number = dict((party, k + 1) for (k, party) in enumerate(parties))
+    max_txfees = dict(p.txfees)
+    problem = CoinJoinProblem("perfect", [(number[p.inputs[i][0]], p.inputs[i][1]) for i in inputs],
+                              set((number[party], max_txfees[party]) for party in parties),
+                              min_feerate = p.min_feerate, max_feerate = p.max_feerate,
+                              min_output_amt = p.min_output_amt, min_output_amt_delta = p.min_output_amt_delta,
+                              max_party_fragmentation_factor = p.max_party_fragmentation_factor)
+    return (problem, inputs, parties)
+
+  #maps a model for the session's problem to the inputs and party IDs of self.problem:
+  def round_model(self, model):
+    party_ids = lambda parties: [self.session_parties[party - 1] if party != -1 else -1 for party in parties]
+    model = expand_model(self.problem, model, self.session_inputs)
+    model["input_party"] = party_ids(model["input_party"])
+    model["output_party"] = party_ids(model["output_party"])
+    return model
+
+  #maps a model for self.problem that only uses inputs on offer to the inputs and party IDs of the session's problem:
+  def session_model(self, model):
+    number = dict((party, k + 1) for (k, party) in enumerate(self.session_parties))
+    number[-1] = -1
+    model = dict(model)
+    model["input_amt"] = [model["input_amt"][i] for i in self.session_inputs]
+    model["input_party"] = [number[model["input_party"][i]] for i in self.session_inputs]
+    model["output_party"] = [number[party] for party in model["output_party"]]
+    return model
+
+  #the best solution so far, with every party that lost a selected input taken out altogether (its inputs and its
+  #outputs), or None if there is no solution yet or nothing left of it. it is only a candidate: with those outputs
+  #gone, outputs of other parties may have lost their anonymity set, and the fees may no longer add up.
+  def repaired_model(self):
+    if self.model is None:
+      return None
+    model = self.model
+    departed = set(model["input_party"][i] for i in self.excluded if model["input_party"][i] != -1)
+    used = set(i for i in range(0, self.problem.num_inputs) if model["input_party"][i] not in [-1] + list(departed))
+    outputs = [(party, amt) for (party, amt) in zip(model["output_party"], model["output_amt"])
+               if party != -1 and party not in departed]
+    if len(departed) == 0:
+      return model
+    if len(outputs) == 0:
+      return None
+    txfee = sum(self.problem.inputs[i][1] for i in used) - sum(amt for (_, amt) in outputs)
+    return make_model(self.problem, used, outputs, txfee, sum(output_scores(outputs)), 3 * len(self.problem.parties))
+
+  #re-solves the round as it now stands, like improving_solutions() with options (but always in the round's
+  #session, so not with a portfolio or the parallel strategy), starting from repaired_model(). if there is no
+  #solution to start from, the heuristic engine (if options turn it on) builds one from the inputs on offer.
+  #yields and returns like improving_solutions(), with the models mapped back to problem's inputs and party IDs,
+  #and keeps the last solution yielded in model for the next re-solve (a re-solve that yields none leaves it be).
+  #with fewer than two parties left on offer, returns (True) at once, since there is no CoinJoin.
+  def improving_solutions(self, **options):
+    if options.get("portfolio") is not None or options.get("strategy") == "parallel":
+      raise ValueError("a CoinJoinRound solves in its own session, without a portfolio or the parallel strategy")
+    heuristic = options.pop("heuristic", False)
+    if self.session is None and (self.deadline is None or self.remaining_budget() >= 1):
+      (problem, self.session_inputs, self.session_parties) = self.offered_problem()
+      if len(self.session_parties) < 2:
+        return True
+      self.session = SolverSession(problem, 3 * len(self.session_parties), **self.encoding_options)
+    if self.deadline is not None:
+      remaining = self.remaining_budget()
+      if remaining < 1:
+        return False #the round's time budget is used up
+      if options.get("time_budget") is not None:
+        remaining = min(remaining, options["time_budget"])
+      options["time_budget"] = remaining
+    hint = self.repaired_model()
+    if hint is not None:
+      hint = self.session_model(hint)
+    elif heuristic:
+      result = heuristic_solution(self.session.problem)
+      if result is not None:
+        hint = result[1]
+    solutions = improving_solutions(self.session.problem, hint = hint, heuristic = False, session = self.session,
+                                    **dict(self.encoding_options, **options))
+    try:
+      while True:
+        try:
+          (_, _, metrics) = next(solutions)
+        except StopIteration as done:
+          return done.value
+        self.model = self.round_model(metrics["model"])
+        (selected_inputs, outputs) = recover_cj_config_from_model(self.model)
+        yield (selected_inputs, outputs, dict(metrics, model = self.model))
+    finally:
+      solutions.close()
+
+  #milliseconds left of the round's time budget (only if it has one):
+  def remaining_budget(self):
+    return int((self.deadline - time.monotonic()) * 1000)
+
+  def close(self):
+    if self.session is not None:
+      self.session.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+#the library entry point behind coinjoin.solve(): solves problem with the optimization loop, or with z3's Optimize
+#if engine is "optimize". options are passed on to optimization_procedure() or native_optimization_procedure().
+def solve(problem, strategy = "linear", engine = "loop", **options):
+  procedure = native_optimization_procedure if engine == "optimize" else optimization_procedure
+  return procedure(problem, strategy = strategy, **options)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Find a good perfect CoinJoin for the example config.")
+  parser.add_argument("--search", choices = ["linear", "binary", "galloping", "parallel"], default = "linear",
+                      help = "how to tighten the objective bounds between solver calls")
+  parser.add_argument("--window", type = int, default = None,
+                      help = "candidate bounds checked at once with --search parallel (default: number of cores)")
+  parser.add_argument("--no-incremental", dest = "incremental", action = "store_false",
+                      help = "re-encode and solve every step from scratch")
+  parser.add_argument("--engine", choices = ["loop", "optimize"], default = "loop",
+                      help = "tighten the bounds step by step, or hand the lexicographic objective to z3's Optimize")
+  parser.add_argument("--symmetry-breaking", action = "store_true",
+                      help = "impose a canonical order on the interchangeable output slots")
+  parser.add_argument("--portfolio", type = int, default = None, metavar = "N",
+                      help = "race N solver configurations in parallel worker processes on every step")
+  parser.add_argument("--time-budget", type = int, default = None, metavar = "MS",
+                      help = "total milliseconds to spend, after which the best solution found so far is used")
+  parser.add_argument("--warm-start", action = "store_true",
+                      help = "start every solver call from the best solution found so far")
+  parser.add_argument("--heuristic", action = "store_true",
+                      help = "build a first solution with the pure-Python heuristic engine")
+  parser.add_argument("--explain", action = "store_true",
+                      help = "if there is no CoinJoin at all, report a minimal set of constraints that conflict")
+  parser.add_argument("--metrics", default = None, metavar = "FILE",
+                      help = "append metrics for every encoding and solver call to FILE as JSON lines (- for stdout)")
+  parser.add_argument("--export-smtlib", default = None, metavar = "DIR",
+                      help = "write every solver call to DIR as an SMT-LIB2 file, with a manifest for replay_smtlib.py")
+  parser.add_argument("--encoding", choices = ["pairwise", "classes"], default = "pairwise",
+                      help = "compare all pairs of output slots, or count outputs per amount class")
+  parser.add_argument("--amount-classes", type = int, default = None,
+                      help = "number of amount classes for --encoding classes (default: enough to be exact)")
+  parser.add_argument("--amounts", choices = ["int", "bounded", "bitvector"], default = "int",
+                      help = "encode amounts as unbounded integers, bounded integers, or bit-blasted bit-vectors")
+  parser.add_argument("--shortlist", type = int, default = None, metavar = "N",
+                      help = "search the N most promising offered inputs first, widening only if that is infeasible")
+  parser.add_argument("--pareto", action = "store_true",
+                      help = "list every CoinJoin that none beats on all of number of outputs, anonymity score and txfee")
+  parser.add_argument("--workers", type = int, default = None, metavar = "N",
+                      help = "worker processes for --pareto (default: number of cores)")
+  args = parser.parse_args()
+
+  if args.pareto:
+    (frontier, proven) = pareto_frontier(example_problem(), workers = args.workers, encoding = args.encoding,
+                                         num_amount_classes = args.amount_classes, amounts = args.amounts,
+                                         symmetry_breaking = args.symmetry_breaking)
+    print("------------------")
+    print("Pareto frontier of %d CoinJoin(s)%s:" % (len(frontier), "" if proven else " (not proven complete)"))
+    for point in frontier:
+      print("%d outputs with anonymity score %d and a txfee of %d sats" %
+            (point["num_outputs"], point["anonymity_score"], point["txfee"]))
+      (_, outputs) = recover_cj_config_from_model(point["model"])
       print(outputs)
-
-  return (min_outputs, min_anonymity_score, best_model)
-
-(min_outputs, min_anonymity_score, model) = optimization_procedure()
-print("------------------")
-if model is None:
-    print("Could not find a CoinJoin solution with less than %d seconds of solver time" % (solver_iteration_timeout / 1000))
+    return
+
+  instrument = JsonLinesWriter(args.metrics) if args.metrics else None
+  if args.export_smtlib is not None:
+    instrument = SmtLibExporter(args.export_smtlib, instrument,
+                                tactic = bitvector_tactic if args.amounts == "bitvector" else None)
+  (min_outputs, min_anonymity_score, model, optimal) = solve(example_problem(), strategy = args.search, engine = args.engine,
+                                                             incremental = args.incremental, encoding = args.encoding,
+                                                             num_amount_classes = args.amount_classes, amounts = args.amounts,
+                                                             symmetry_breaking = args.symmetry_breaking,
+                                                             portfolio = default_portfolio(args.portfolio) if args.portfolio else None,
+                                                             window = args.window, time_budget = args.time_budget,
+                                                             warm_start = args.warm_start, heuristic = args.heuristic,
+                                                             explain = args.explain,
+                                                             instrument = instrument,
+                                                             shortlist = args.shortlist)
+  print("------------------")
+  if model is None:
+    if args.time_budget is not None:
+      print("Could not find a CoinJoin solution within the time budget of %d seconds" % (args.time_budget / 1000))
+    else:
+      print("Could not find a CoinJoin solution with less than %d seconds of solver time" % (solver_iteration_timeout / 1000))
     sys.exit(1)
-else:
-  #randomly shuffle output order, then sort by decreasing amount:
-  (selected_inputs, example_outputs) = recover_cj_config_from_model(model)
-  def uniqueify(what):
-    buf = set()
-    for x in what:
-      buf.add(x)
-    return buf
-  num_contributing_parties = len(uniqueify([x[0] for x in example_outputs]))
-
-  print("Best CoinJoin solution found has %d inputs from %d parties:" % (len(selected_inputs), num_contributing_parties))
-  print(selected_inputs)
-  print("and has %d outputs with anonymity score %d:" % (min_outputs, min_anonymity_score))
-  print(example_outputs)
-  print("\nraw model:\n")
-  print(model)
+  else:
+    #randomly shuffle output order, then sort by decreasing amount:
+    (selected_inputs, example_outputs) = recover_cj_config_from_model(model)
+    def uniqueify(what):
+      buf = set()
+      for x in what:
+        buf.add(x)
+      return buf
+    num_contributing_parties = len(uniqueify([x[0] for x in example_outputs]))
+
+    print("Best CoinJoin solution found has %d inputs from %d parties:" % (len(selected_inputs), num_contributing_parties))
+    print(selected_inputs)
+    print("and has %d outputs with anonymity score %d:" % (min_outputs, min_anonymity_score))
+    print(example_outputs)
+    print("This solution is %s." % ("proven optimal" if optimal else "not proven optimal"))
+    print("\nraw model:\n")
+    print(model)
+
+if __name__ == "__main__":
+  main()
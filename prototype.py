@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
-from pysmt.shortcuts import Symbol, And, Or, Not, Ite, GT, GE, LT, LE, Plus, Minus, Times, Equals, Int, Solver, get_model
+from pysmt.shortcuts import Symbol, And, Or, Not, Implies, Ite, GT, GE, LT, LE, Plus, Minus, Times, Equals, Int, Solver, get_model
 from pysmt.exceptions import SolverReturnedUnknownResultError
 from pysmt.logics import QF_UFLIRA
-from pysmt.typing import INT
+from pysmt.typing import INT, BOOL
+import z3
 from functools import reduce
+from itertools import combinations
 from secrets import randbelow
+import multiprocessing.connection
+import argparse
+import os
 import sys
+import time
+
+import coinjoin
+from coinjoin import CoinJoinProblem
+import engine as solver_engine
+from engine import WorkerCall, bitvector_tactic, bound_domains, build_amount_classes, default_portfolio, optimization_procedure, \
+                   native_optimization_procedure
+from heuristic import make_model
+from instrumentation import JsonLinesWriter, SmtLibExporter
+
+#run as a script, this module is __main__, and the engine should solve with it rather than load it again:
+coinjoin.variants.setdefault("maker-taker", sys.modules[__name__])
 
 #Example CoinJoin config:
 min_feerate = 5 #sats per vbyte target minimum
@@ -25,19 +42,10 @@ example_taker = 1
 #how much? (0 means sweep all)
 example_amt = 0
 
-#auto-calculated constants given the example configuration above: 
-parties = range(1, len(example_txfees) + 1)
-num_inputs = len(example_inputs)
-
-def parse_model_lines(model_lines):
-  ret = dict()
-  for line in model_lines:
-    split = line.split(' := ')
-    k = split[0]
-    v = split[1]
-    ret[k] = int(v)
-
-  return ret
+def example_problem():
+  return CoinJoinProblem("maker-taker", example_inputs, example_txfees, cjfee = example_cjfee, taker = example_taker,
+                         amt = example_amt, min_feerate = min_feerate, max_feerate = max_feerate,
+                         min_output_amt = min_output_amt, min_output_amt_delta = min_output_amt_delta)
 
 def recover_cj_config_from_model(model):
   selected_inputs = list()
@@ -45,18 +53,18 @@ def recover_cj_config_from_model(model):
   input_buf = list()
   output_buf = list()
 
-  for i in range(0, model["max_outputs"]):
-    party = model["output_party[%d]" % i]
-    amt = model["output_amt[%d]" % i]
+  for i in range(0, len(model["output_party"])):
+    party = model["output_party"][i]
+    amt = model["output_amt"][i]
     if party != -1:
       output_buf.append((party, amt))
   while len(output_buf) > 0:
     x = randbelow(len(output_buf))
     outputs.append(output_buf.pop(x))
 
-  for i in range(0, num_inputs):
-    party = model["input_party[%d]" % i]
-    amt = model["input_amt[%d]" % i]
+  for i in range(0, len(model["input_party"])):
+    party = model["input_party"][i]
+    amt = model["input_amt"][i]
     if party != -1:
       input_buf.append((party, amt))
   while len(input_buf) > 0:
@@ -68,13 +76,35 @@ def recover_cj_config_from_model(model):
 def bool_to_int(x):
     return Ite(x, Int(1), Int(0))
 
-def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
+#builds the base encoding for a CoinJoin with up to max_outputs outputs, without any optimization bounds.
+#returns (constraint_groups, symbols), where constraint_groups maps a group name to its list of constraints
+#and symbols holds the variables that bounds and model extraction need to refer to.
+#besides the groups by kind of constraint, every input (input[i]), every per-party rule (txfee[party], cjfee[party], unique_outputs[party])
+#and every config rule (main_cj_amt, min_feerate, max_feerate, min_output_amt_delta) has a group of its own.
+#if symmetry_breaking is set, the interchangeable output slots are additionally forced into a canonical order.
+#encoding picks how the anonymity set and min delta constraints are built:
+# -"pairwise" compares every pair of output slots
+# -"classes" assigns outputs to num_amount_classes amount classes (see build_amount_classes() in engine.py) and counts them.
+#  by default there are just enough classes never to rule out a solution: at most one class per
+#  uniquely-identifiable output (so at most one per party) plus one per pair of remaining outputs.
+#amounts picks how the integer variables (satoshi amounts, fees, counts and party IDs) are encoded:
+# -"int" leaves them unbounded
+# -"bounded" bounds them all explicitly, see bound_domains() in engine.py
+# -"bitvector" bounds them the same way, and the solvers then bit-blast them as fixed-width bit-vectors
+#  (see bitvector_tactic)
+def build_smt_encoding(problem, max_outputs, symmetry_breaking = False, encoding = "pairwise", num_amount_classes = None,
+                       amounts = "int"):
   #constraints:
   input_constraints = set()
+  symmetry_breaking_constraints = set()
   output_constraints = set()
   anonymityset_constraints = set()
   txfee_constraints = set()
   invariants = set()
+  #constraints on a single input, party or config rule, in groups of their own so that unsat_core() can blame them:
+  named_constraints = dict()
+  def add_named(name, constraint):
+    named_constraints.setdefault(name, list()).append(constraint)
 
   #variables:
   total_in = Symbol("total_in", INT) #total satoshis from inputs
@@ -95,12 +125,12 @@ def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
   output_not_unique = dict() #index into outputs -> 1 if output is uniquely identifiable, else 0
   main_cj_amt = Symbol("main_cj_amt", INT) #satoshi size of the outputs in the biggest anonymity set including all parties
 
-  for (party, _) in example_txfees:
+  for (party, _) in problem.txfees:
     party_gives[party] = Symbol("party_gives[%d]" % party, INT)
     party_gets[party] = Symbol("party_gets[%d]" % party, INT)
     party_txfee[party] = Symbol("party_txfee[%d]" % party, INT)
     party_cjfee[party] = Symbol("party_cjfee[%d]" % party, INT)
-  for i in range(0, num_inputs):
+  for i in range(0, problem.num_inputs):
     input_party[i] = Symbol("input_party[%d]" % i, INT)
     input_amt[i] = Symbol("input_amt[%d]" % i, INT)
   for i in range(0, max_outputs):
@@ -111,11 +141,11 @@ def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
   #constraint construction:
 
   #party_txfee and party_cjfee bindings and (for the taker) constraints:
-  for (party, fee_contribution) in example_txfees:
-    if party != example_taker:
-      txfee_constraints.add(Equals(party_txfee[party], Int(fee_contribution)))
+  for (party, fee_contribution) in problem.txfees:
+    if party != problem.taker:
+      add_named("txfee[%d]" % party, Equals(party_txfee[party], Int(fee_contribution)))
     else:
-      other_party_txfees = reduce(lambda x,y: x+y, [x[1] if x[0] != party else 0 for x in example_txfees])
+      other_party_txfees = reduce(lambda x,y: x+y, [x[1] if x[0] != party else 0 for x in problem.txfees])
       txfee_constraints.add(Equals(Minus(party_txfee[party],
                                          party_cjfee[party]),
                                    Minus(party_gives[party],
@@ -123,16 +153,16 @@ def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
       txfee_constraints.add(Equals(txfee,
                                    Plus(party_txfee[party],
                                         Int(other_party_txfees))))
-  for (party, fee) in example_cjfee:
-    if party != example_taker:
-      txfee_constraints.add(Equals(party_cjfee[party], Int(fee)))
+  for (party, fee) in problem.cjfee:
+    if party != problem.taker:
+      add_named("cjfee[%d]" % party, Equals(party_cjfee[party], Int(fee)))
 
   #input_party and input_amt bindings:
-  for i in range(0, num_inputs):
-    input_constraints.add(Equals(input_party[i],
-                                 Int(example_inputs[i][0])))
-    input_constraints.add(Equals(input_amt[i],
-                                 Int(example_inputs[i][1])))
+  for i in range(0, problem.num_inputs):
+    add_named("input[%d]" % i, Equals(input_party[i],
+                                      Int(problem.inputs[i][0])))
+    add_named("input[%d]" % i, Equals(input_amt[i],
+                                      Int(problem.inputs[i][1])))
 
   #add constraints on output_party and output_amt:
   # -either output_party[i] == -1 and output_amt[i] == 0
@@ -142,42 +172,54 @@ def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
     output_is_unused = Equals(output_party[i],
                               Int(-1))
     output_unused.append(output_is_unused)
-    min_delta_satisfied = Or(output_is_unused,
-                             And([Or(Equals(output_amt[i],
-                                            output_amt[j]),
-                                     Or(GE(output_amt[j],
-                                           Plus(output_amt[i],
-                                                Int(min_output_amt_delta))),
-                                        LE(output_amt[j],
-                                           Minus(output_amt[i],
-                                                 Int(min_output_amt_delta)))))\
-                                  for j in filter(lambda j: j != i, range(0, max_outputs))]))
-    output_constraints.add(min_delta_satisfied)
+    if encoding == "pairwise": #the amount classes enforce this themselves
+      min_delta_satisfied = Or(output_is_unused,
+                               And([Or(Equals(output_amt[i],
+                                              output_amt[j]),
+                                       Or(GE(output_amt[j],
+                                             Plus(output_amt[i],
+                                                  Int(problem.min_output_amt_delta))),
+                                          LE(output_amt[j],
+                                             Minus(output_amt[i],
+                                                   Int(problem.min_output_amt_delta)))))\
+                                    for j in filter(lambda j: j != i, range(0, max_outputs))]))
+      add_named("min_output_amt_delta", min_delta_satisfied)
     output_constraints.add(Ite(output_is_unused,
                                Equals(output_amt[i],
                                       Int(0)),
                                GT(output_amt[i],
-                                  Int(max(0, min_output_amt-1)))))
+                                  Int(max(0, problem.min_output_amt-1)))))
+  #output slots are interchangeable (recover_cj_config_from_model() shuffles them anyway), so the solver would
+  #otherwise explore every permutation of each candidate. if requested, sort the slots by decreasing amount
+  #and then by decreasing party, which also puts the unused slots (amount 0, party -1) last:
+  if symmetry_breaking:
+    for i in range(0, max_outputs - 1):
+      symmetry_breaking_constraints.add(Or(GT(output_amt[i],
+                                              output_amt[i + 1]),
+                                           And(Equals(output_amt[i],
+                                                      output_amt[i + 1]),
+                                               GE(output_party[i],
+                                                  output_party[i + 1]))))
   #calculate num_outputs and bind max_outputs:
   output_constraints.add(Equals(num_outputs, Plus([bool_to_int(Not(x)) for x in output_unused])))
   output_constraints.add(Equals(max_outputs_sym, Int(max_outputs)))
 
   #txfee, party_gets, and party_gives calculation/constraints/binding:
-  for party in parties:
+  for party in problem.parties:
     #party_gives and input constraint/invariant
     input_constraints.add(Equals(party_gives[party],
                                  Plus([Int(a)\
-                                       for (p, a) in filter(lambda x: x[0] == party, example_inputs)])))
+                                       for (p, a) in filter(lambda x: x[0] == party, problem.inputs)])))
 
     #txfee calculations:
-    if party != example_taker:
+    if party != problem.taker:
       txfee_constraints.add(Equals(party_gets[party],
                                    Plus(party_cjfee[party],
                                         Minus(party_gives[party],
                                               party_txfee[party]))))
     else:
-      fee_contributions = Plus([party_txfee[p] for p in filter(lambda x: x != example_taker, parties)])
-      cjfees = Plus([party_cjfee[p] for p in filter(lambda x: x != example_taker, parties)])
+      fee_contributions = Plus([party_txfee[p] for p in filter(lambda x: x != problem.taker, problem.parties)])
+      cjfees = Plus([party_cjfee[p] for p in filter(lambda x: x != problem.taker, problem.parties)])
       txfee_constraints.add(Equals(party_gets[party],
                                    Plus(fee_contributions,
                                         Minus(party_gives[party],
@@ -195,44 +237,84 @@ def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
   #first, no matter what, we retain the core CoinJoin with the biggest anonymity set:
   num_outputs_at_main_cj_amt = Plus([bool_to_int(Equals(v, main_cj_amt)) for (k, v) in output_amt.items()])
   anonymityset_constraints.add(Equals(main_cj_amt,
-                                      Int(example_amt) if example_amt != 0 else party_gets[example_taker]))
-  anonymityset_constraints.add(GE(num_outputs_at_main_cj_amt,
-                                  Int(len(parties))))
-
-  #also, each party should only have at most one output not part of any anonymity set:
-  for party in parties:
-    def belongs_and_unique(idx):
-      disequal = [Or(Not(Equals(v,
-                         output_amt[idx])),
-                     Equals(output_party[k],
-                            Int(party)))\
-                  for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]
-      return And(Equals(output_party[idx],
-                        Int(party)),
-                 And(disequal))
-    unique_amt_count = Plus([bool_to_int(belongs_and_unique(k)) for (k, v) in output_amt.items()])
-    anonymityset_constraints.add(LE(unique_amt_count, Int(1)))
-
-  #calculate how many outputs are uniquely identifiable (unused outputs are excluded):
-  for (idx, amt) in output_amt.items():
-    not_unique = Or(Equals(output_party[idx],
-                           Int(-1)),
-                    Or([And(Equals(v,
-                                   amt),
-                            Not(Equals(output_party[k],
-                                       output_party[idx])))\
-                        for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]))
-    anonymityset_constraints.add(Equals(output_not_unique[idx],
-                                        bool_to_int(not_unique)))
-  anonymityset_constraints.add(Equals(num_unique_outputs,
-                                      Minus(max_outputs_sym,
-                                            Plus([not_unique for (_, not_unique) in output_not_unique.items()]))))
-
-  #constrain (if set) the number of uniquely-identifiable outputs
-  #(i.e. those not in an anonymity set with cardinality > 1):
-  if max_unique is not None:
-    anonymityset_constraints.add(LE(num_unique_outputs,
-                                    Int(max_unique)))
+                                      Int(problem.amt) if problem.amt != 0 else party_gets[problem.taker]))
+  add_named("main_cj_amt", GE(num_outputs_at_main_cj_amt,
+                                Int(len(problem.parties))))
+
+  if encoding == "classes":
+    if num_amount_classes is None:
+      num_amount_classes = (max_outputs + len(problem.parties)) // 2
+    (in_class, class_count) = build_amount_classes(problem, output_party, output_amt, num_amount_classes, anonymityset_constraints)
+    #a class is mixed if its outputs belong to more than one party. otherwise all of its outputs belong to its owner
+    #and are uniquely identifiable:
+    class_owner = dict()
+    class_mixed = dict()
+    for c in range(0, num_amount_classes):
+      class_owner[c] = Symbol("class_owner[%d]" % c, INT)
+      class_mixed[c] = Symbol("class_mixed[%d]" % c, BOOL)
+      owner_witnesses = list()
+      other_witnesses = list()
+      for i in range(0, max_outputs):
+        owned = Equals(output_party[i],
+                       class_owner[c])
+        anonymityset_constraints.add(Implies(And(in_class[i][c],
+                                                 Not(class_mixed[c])),
+                                             owned))
+        owner_witnesses.append(And(in_class[i][c], owned))
+        other_witnesses.append(And(in_class[i][c], Not(owned)))
+      anonymityset_constraints.add(Implies(class_mixed[c],
+                                           And(Or(owner_witnesses),
+                                               Or(other_witnesses))))
+
+    #also, each party should only have at most one output not part of any anonymity set:
+    for c in range(0, num_amount_classes):
+      anonymityset_constraints.add(Or(class_mixed[c],
+                                      LE(class_count[c],
+                                         Int(1))))
+    for party in problem.parties:
+      unique_amt_count = Plus([bool_to_int(And(Not(class_mixed[c]),
+                                               Equals(class_count[c],
+                                                      Int(1)),
+                                               Equals(class_owner[c],
+                                                      Int(party))))\
+                               for c in range(0, num_amount_classes)])
+      add_named("unique_outputs[%d]" % party, LE(unique_amt_count, Int(1)))
+
+    #calculate how many outputs are uniquely identifiable:
+    anonymityset_constraints.add(Equals(num_unique_outputs,
+                                        Plus([Ite(class_mixed[c],
+                                                  Int(0),
+                                                  class_count[c])\
+                                              for c in range(0, num_amount_classes)])))
+  else:
+    #also, each party should only have at most one output not part of any anonymity set:
+    for party in problem.parties:
+      def belongs_and_unique(idx):
+        disequal = [Or(Not(Equals(v,
+                           output_amt[idx])),
+                       Equals(output_party[k],
+                              Int(party)))\
+                    for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]
+        return And(Equals(output_party[idx],
+                          Int(party)),
+                   And(disequal))
+      unique_amt_count = Plus([bool_to_int(belongs_and_unique(k)) for (k, v) in output_amt.items()])
+      add_named("unique_outputs[%d]" % party, LE(unique_amt_count, Int(1)))
+
+    #calculate how many outputs are uniquely identifiable (unused outputs are excluded):
+    for (idx, amt) in output_amt.items():
+      not_unique = Or(Equals(output_party[idx],
+                             Int(-1)),
+                      Or([And(Equals(v,
+                                     amt),
+                              Not(Equals(output_party[k],
+                                         output_party[idx])))\
+                          for (k, v) in filter(lambda x: x[0] != idx, output_amt.items())]))
+      anonymityset_constraints.add(Equals(output_not_unique[idx],
+                                          bool_to_int(not_unique)))
+    anonymityset_constraints.add(Equals(num_unique_outputs,
+                                        Minus(max_outputs_sym,
+                                              Plus([not_unique for (_, not_unique) in output_not_unique.items()]))))
 
   #set transaction invariants:
   invariants.add(Equals(total_in, Plus(total_out, txfee)))
@@ -243,78 +325,438 @@ def solve_smt_problem(max_outputs, max_unique = None, timeout = None):
 
   #build txfee calculation constraint: 11 + 68 * num_inputs + 31 * num_outputs
   txfee_constraints.add(Equals(txsize,
-                               Plus(Int(11 + 68 * num_inputs),
+                               Plus(Int(11 + 68 * problem.num_inputs),
                                     Times(Int(31),
                                           num_outputs))))
-  txfee_constraints.add(GE(txfee, Times(txsize, Int(min_feerate))))
-  txfee_constraints.add(LE(txfee, Times(txsize, Int(max_feerate))))
+  add_named("min_feerate", GE(txfee, Times(txsize, Int(problem.min_feerate))))
+  add_named("max_feerate", LE(txfee, Times(txsize, Int(problem.max_feerate))))
+
+  #bound every integer variable, if requested:
+  domain_constraints = list()
+  if amounts != "int":
+    groups = [input_constraints, invariants, txfee_constraints, output_constraints, anonymityset_constraints,
+              symmetry_breaking_constraints] + list(named_constraints.values())
+    domain_constraints = bound_domains(problem, max_outputs, groups)
 
   #finish problem construction:
+  constraint_groups = {"input_constraints": list(input_constraints),
+                       "invariants": list(invariants),
+                       "txfee_constraints": list(txfee_constraints),
+                       "output_constraints": list(output_constraints),
+                       "anonymityset_constraints": list(anonymityset_constraints),
+                       "symmetry_breaking_constraints": list(symmetry_breaking_constraints),
+                       "domain_constraints": domain_constraints}
+  constraint_groups.update(named_constraints)
+  symbols = {"num_outputs": num_outputs,
+             "num_unique_outputs": num_unique_outputs,
+             "txfee": txfee,
+             "input_party": input_party,
+             "input_amt": input_amt,
+             "output_party": output_party,
+             "output_amt": output_amt}
+  return (constraint_groups, symbols)
+
+#builds the constraints for the bounds tightened by the optimization procedure:
+#min_outputs and max_txfee are only used by the Pareto search, see pareto_frontier().
+def bound_constraints(symbols, max_outputs = None, max_unique = None, min_outputs = None, max_txfee = None):
+  bounds = list()
+  #constrain (if set) the number of outputs actually used.
+  #slots are interchangeable, so we may as well require the unused ones to be the trailing slots,
+  #which keeps the problem as small as one built with only max_outputs slots:
+  if max_outputs is not None:
+    bounds.append(LE(symbols["num_outputs"],
+                     Int(max_outputs)))
+    for i in range(max_outputs, len(symbols["output_party"])):
+      bounds.append(Equals(symbols["output_party"][i],
+                           Int(-1)))
+  #constrain (if set) the number of uniquely-identifiable outputs
+  #(i.e. those not in an anonymity set with cardinality > 1):
+  if max_unique is not None:
+    bounds.append(LE(symbols["num_unique_outputs"],
+                     Int(max_unique)))
+  if min_outputs is not None:
+    bounds.append(GE(symbols["num_outputs"],
+                     Int(min_outputs)))
+  if max_txfee is not None:
+    bounds.append(LE(symbols["txfee"],
+                     Int(max_txfee)))
+  return bounds
+
+#what the engine (see engine.py) optimizes: first the fewest uniquely-identifiable outputs, then the fewest outputs.
+#the bound on the objective is called max_unique in the records of the solver calls and in unsat cores.
+objective = "num_unique_outputs"
+objective_bound = "max_unique"
+maximize_objective = False
+
+#the bound on num_unique_outputs the search starts from, and the fewest there could be with num_outputs outputs.
+#each party has at most one uniquely-identifiable output, so start just below that:
+def objective_range(problem, num_outputs):
+  return (len(problem.parties) - 1, 0)
+
+#the main CoinJoin amount alone needs one output per party:
+def fewest_outputs(problem):
+  return len(problem.parties)
+
+#every offered input is spent:
+def min_txfee(problem, num_outputs):
+  return problem.min_feerate * txsize(problem.num_inputs, num_outputs)
+
+def print_solution(result, selected_inputs, outputs):
+  print("%d outputs, of which %d are uniquely identifiable" % (result[0][0], result[0][1]))
+  print(outputs)
+
+#the two-stage pipeline behind engine "decomposed", an alternative to the monolithic encoding of build_smt_encoding(),
+#which decides the output amounts, their owners and their uniqueness all at once:
+# -stage one (denomination_plans()) picks the output amounts: the main CoinJoin amount plus a few more
+#  denominations, derived from what every party gets (party_gets) once it has its output at the main CoinJoin amount
+# -stage two (assign_outputs()) solves a much smaller problem for one plan: how many outputs of each denomination
+#  every party gets, plus at most one change output per party, under the fee and feerate rules. the denominations
+#  are constants, so there are no output slots to compare pairwise.
+#plans are independent of each other, so stage two runs them in parallel, and both stages can be cached.
+
+#what every party gets from the CoinJoin, as the txfee contributions and cjfees in problem say:
+#returns (gets, taker_base), where gets maps the makers to satoshis and the taker gets taker_base - txfee.
+def party_gets(problem):
+  gives = dict((p, sum(a for (q, a) in problem.inputs if q == p)) for p in problem.parties)
+  txfees = dict(problem.txfees)
+  cjfees = dict(problem.cjfee)
+  gets = dict((p, gives[p] - txfees.get(p, 0) + cjfees.get(p, 0)) for p in problem.parties if p != problem.taker)
+  taker_base = gives[problem.taker] + sum(f for (p, f) in txfees.items() if p != problem.taker) - \
+               sum(f for (p, f) in cjfees.items() if p != problem.taker)
+  return (gets, taker_base)
+
+def txsize(num_inputs, num_outputs):
+  return 11 + 68 * num_inputs + 31 * num_outputs
+
+#stage one: enumerates the plans for stage two, as (txfee, main_cj_amt, denominations) tuples, where denominations
+#(in decreasing order, at least min_output_amt_delta apart) include main_cj_amt and up to max_denominations more.
+#the extra denominations are drawn from what the parties have left after their output at main_cj_amt, and the
+#differences between those, so that a party's change can be matched by another party's. what the taker has left
+#depends on the txfee, so it is taken at the minimum txfee for every number of outputs.
+#txfee is None if stage two picks it. when sweeping, main_cj_amt depends on the txfee, so every plan fixes the
+#txfee at the minimum for some number of outputs (and the taker has nothing left).
+#plans with fewer denominations come first, since they leave fewer amounts to tell outputs apart by.
+def denomination_plans(problem, max_denominations = 2):
+  (gets, taker_base) = party_gets(problem)
+  slots = 3 * len(problem.parties)
+  min_txfees = sorted(set(problem.min_feerate * txsize(problem.num_inputs, n) for n in range(len(problem.parties), slots + 1)))
+  txfees = [None] if problem.amt != 0 else min_txfees
+  plans = list()
+  for txfee in txfees:
+    main_cj_amt = problem.amt if problem.amt != 0 else taker_base - txfee
+    if main_cj_amt < problem.min_output_amt or any(g < main_cj_amt for g in gets.values()):
+      continue
+    left = set(g - main_cj_amt for g in gets.values())
+    if txfee is None:
+      left |= set(taker_base - f - main_cj_amt for f in min_txfees)
+    left = set(r for r in left if r >= problem.min_output_amt)
+    candidates = left | set(a - b for a in left for b in left if a - b >= problem.min_output_amt)
+    candidates = sorted(c for c in candidates if abs(c - main_cj_amt) >= problem.min_output_amt_delta)
+    for k in range(0, max_denominations + 1):
+      for extra in combinations(candidates, k):
+        denominations = tuple(sorted((main_cj_amt,) + extra, reverse = True))
+        if all(a - b >= problem.min_output_amt_delta for (a, b) in zip(denominations, denominations[1:])):
+          plans.append((k, (txfee, main_cj_amt, denominations)))
+  return [plan for (_, plan) in sorted(plans, key = lambda x: x[0])]
+
+#stage two: finds the best CoinJoin (fewest uniquely-identifiable outputs, then fewest outputs) that pays every
+#party only in the denominations of plan (as from denomination_plans()), with at least one output at main_cj_amt,
+#plus at most one change output of any amount. a denomination is paid to at least two parties or to none, so only
+#change outputs can be uniquely identifiable, and only if no other party's change has the same amount.
+#returns ([num_outputs, num_unique_outputs], model) with a model as from read_model(), or None if there is none.
+#raises SolverReturnedUnknownResultError if z3 gives up, e.g. after timeout milliseconds.
+def assign_outputs(problem, plan, timeout = None):
+  (fixed_txfee, main_cj_amt, denominations) = plan
+  (gets, taker_base) = party_gets(problem)
+  slots = 3 * len(problem.parties)
   constraints = list()
-  for x in [input_constraints, invariants, txfee_constraints,
-            output_constraints, anonymityset_constraints]:
-    for c in x:
-      constraints.append(c)
-  problem = And(constraints)
-
-  with Solver(name='z3', solver_options={'timeout': solver_iteration_timeout}) as s:
-    try:
-      if s.solve([problem]):
-        model_lines = sorted(str(s.get_model()).replace("'", "").split('\n'))
-        result = ([s.get_py_value(num_outputs), s.get_py_value(num_unique_outputs)], parse_model_lines(model_lines))
-        return result
-      else:
-        return None
-    except SolverReturnedUnknownResultError:
-      return None
-
-def optimization_procedure():
-  max_outputs = 3 * len(parties)
-  min_outputs = max_outputs
-  max_unique = len(parties)
-  max_unique_minimized = False
-  best_model = None
 
-  while True:
-    if not max_unique_minimized:
-      result = solve_smt_problem(max_outputs, max_unique - 1, timeout = solver_iteration_timeout)
+  #variables:
+  txfee = Symbol("txfee", INT)
+  num_outputs = Symbol("num_outputs", INT)
+  num_unique_outputs = Symbol("num_unique_outputs", INT)
+  count = dict() #(party ID, index into denominations) -> number of outputs of that denomination the party gets
+  change = dict() #party ID -> satoshis on the party's change output, or 0 if it has none
+  for p in problem.parties:
+    change[p] = Symbol("change[%d]" % p, INT)
+    for d in range(0, len(denominations)):
+      count[(p, d)] = Symbol("count[%d][%d]" % (p, d), INT)
+      constraints.append(And(GE(count[(p, d)], Int(0)), LE(count[(p, d)], Int(slots))))
+
+  if fixed_txfee is not None:
+    constraints.append(Equals(txfee, Int(fixed_txfee)))
+  main_index = denominations.index(main_cj_amt)
+  for p in problem.parties:
+    #every party is in the main CoinJoin, and gets exactly its share:
+    constraints.append(GE(count[(p, main_index)], Int(1)))
+    paid = Plus([Times(count[(p, d)], Int(a)) for (d, a) in enumerate(denominations)] + [change[p]])
+    constraints.append(Equals(paid, Minus(Int(taker_base), txfee) if p == problem.taker else Int(gets[p])))
+    #change is a real output, at least min_output_amt_delta away from every denomination and every other change:
+    constraints.append(Or(Equals(change[p], Int(0)), GE(change[p], Int(problem.min_output_amt))))
+    for a in denominations:
+      constraints.append(Or(Equals(change[p], Int(0)),
+                            GE(change[p], Int(a + problem.min_output_amt_delta)),
+                            LE(change[p], Int(a - problem.min_output_amt_delta))))
+    for q in problem.parties:
+      if q > p:
+        constraints.append(Or(Equals(change[p], Int(0)), Equals(change[q], Int(0)), Equals(change[p], change[q]),
+                              GE(change[p], Plus(change[q], Int(problem.min_output_amt_delta))),
+                              LE(change[p], Minus(change[q], Int(problem.min_output_amt_delta)))))
+  #a denomination paid to a single party would make all of its outputs uniquely identifiable:
+  for d in range(0, len(denominations)):
+    holders = Plus([bool_to_int(GE(count[(p, d)], Int(1))) for p in problem.parties])
+    constraints.append(Or(Equals(holders, Int(0)), GE(holders, Int(2))))
+
+  has_change = dict((p, GT(change[p], Int(0))) for p in problem.parties)
+  unique = [And(has_change[p], And([Not(Equals(change[p], change[q])) for q in problem.parties if q != p]))
+            for p in problem.parties]
+  constraints.append(Equals(num_outputs, Plus(list(count.values()) + [bool_to_int(has_change[p]) for p in problem.parties])))
+  constraints.append(LE(num_outputs, Int(slots)))
+  constraints.append(Equals(num_unique_outputs, Plus([bool_to_int(u) for u in unique])))
+  size = Plus(Int(11 + 68 * problem.num_inputs), Times(Int(31), num_outputs))
+  constraints.append(GE(txfee, Times(size, Int(problem.min_feerate))))
+  constraints.append(LE(txfee, Times(size, Int(problem.max_feerate))))
+
+  with Solver(name='z3') as s:
+    opt = z3.Optimize(ctx = s.z3.ctx)
+    opt.set(priority = 'lex', timeout = timeout if timeout is not None else solver_iteration_timeout)
+    for c in constraints:
+      opt.add(s.converter.convert(c))
+    opt.minimize(s.converter.convert(num_unique_outputs))
+    opt.minimize(s.converter.convert(num_outputs))
+    res = opt.check()
+    if res == z3.unsat:
+      return None
+    elif res != z3.sat:
+      raise SolverReturnedUnknownResultError
+    z3_model = opt.model()
+    def value(var):
+      return z3_model.eval(s.converter.convert(var), model_completion = True).as_long()
+    outputs = list()
+    for p in problem.parties:
+      for (d, a) in enumerate(denominations):
+        outputs += [(p, a)] * value(count[(p, d)])
+      if value(change[p]) > 0:
+        outputs.append((p, value(change[p])))
+    model = make_model(problem, set(range(0, problem.num_inputs)), outputs, value(txfee), value(num_unique_outputs), slots)
+    return ([model["num_outputs"], model["num_unique_outputs"]], model)
+
+#a key for the exact config of problem, for caching the stages of the pipeline:
+def problem_key(problem):
+  return (tuple(problem.inputs), tuple(sorted(problem.txfees)), tuple(sorted(problem.cjfee)), problem.taker, problem.amt,
+          problem.min_feerate, problem.max_feerate, problem.min_output_amt, problem.min_output_amt_delta)
+
+#runs assign_outputs() and returns (status, result) like portfolio_worker():
+def assignment_worker(problem, plan, timeout):
+  try:
+    result = assign_outputs(problem, plan, timeout = timeout)
+  except SolverReturnedUnknownResultError:
+    return ("unknown", None)
+  return ("sat" if result is not None else "unsat", result)
+
+#runs the two-stage pipeline: the plans from denomination_plans() go through assign_outputs() in up to workers
+#worker processes at once (one per core by default, each a WorkerCall, or all in this process if workers is 1), each
+#with timeout milliseconds, until time_budget (in milliseconds) is used up or the best possible CoinJoin (no
+#uniquely-identifiable outputs, one output per party) turns up.
+#if stage_cache is set to a dict, both stages are looked up in it and stored to it, keyed by problem_key().
+#returns the best ([num_outputs, num_unique_outputs], model) over the plans, or None if none has a solution.
+def decomposed_solve(problem, max_denominations = 2, workers = None, timeout = None, time_budget = None, stage_cache = None):
+  start = time.monotonic()
+  if stage_cache is None:
+    stage_cache = dict()
+  key = problem_key(problem)
+  if (key, max_denominations) not in stage_cache:
+    stage_cache[(key, max_denominations)] = denomination_plans(problem, max_denominations)
+  plans = stage_cache[(key, max_denominations)]
+  print("Stage one: %d denomination plan(s)" % len(plans))
+  ideal = [len(problem.parties), 0]
+  best = None
+
+  def consider(result):
+    nonlocal best
+    if result is not None and (best is None or (result[0][1], result[0][0]) < (best[0][1], best[0][0])):
+      best = result
+      print("Stage two: %d outputs, of which %d are uniquely identifiable" % (result[0][0], result[0][1]))
+
+  def plan_timeout():
+    if time_budget is None:
+      return timeout if timeout is not None else solver_iteration_timeout
+    remaining = time_budget - (time.monotonic() - start) * 1000
+    return int(max(1, min(remaining, timeout if timeout is not None else solver_iteration_timeout)))
+
+  def out_of_time():
+    return time_budget is not None and (time.monotonic() - start) * 1000 >= time_budget
+
+  pending = list()
+  for plan in plans:
+    if (key, plan) in stage_cache:
+      consider(stage_cache[(key, plan)])
     else:
-      result = solve_smt_problem(min_outputs - 1, max_unique, timeout = solver_iteration_timeout)
-
-    if result is None:
-      print("------------------")
-      print("No solution found")
-      if not max_unique_minimized:
-        if best_model is None:
-          return (None, None, None) #we couldn't even solve the initial, most relaxed constraint. bail out.
-        else:
-          max_unique_minimized = True
-          print("Now constraining max_unique to <= %d and attempting to minimize transaction size" % max_unique)
-      else:
+      pending.append(plan)
+  if workers == 1:
+    for plan in pending:
+      if out_of_time() or (best is not None and best[0] == ideal):
+        break
+      (status, result) = assignment_worker(problem, plan, plan_timeout())
+      if status != "unknown":
+        stage_cache[(key, plan)] = result
+      consider(result)
+    return best
+  if workers is None:
+    workers = os.cpu_count()
+  running = dict() #WorkerCall -> its plan
+  try:
+    while len(pending) > 0 or len(running) > 0:
+      while len(pending) > 0 and len(running) < workers:
+        plan = pending.pop(0)
+        running[WorkerCall(assignment_worker, problem, plan, plan_timeout())] = plan
+      wait_time = None if time_budget is None else max(0, time_budget / 1000 - (time.monotonic() - start))
+      ready = multiprocessing.connection.wait([c.connection for c in running], timeout = wait_time)
+      if len(ready) == 0:
+        print("Used up the time budget of %d ms in stage two" % time_budget)
+        break
+      for c in list(running):
+        if c.connection not in ready:
+          continue
+        plan = running.pop(c)
+        (status, result) = c.result()
+        if status != "unknown":
+          stage_cache[(key, plan)] = result
+        consider(result)
+      if best is not None and best[0] == ideal:
         break
+  finally:
+    #stop the workers still running:
+    for c in running:
+      c.cancel()
+  return best
+
+#runs decomposed_solve() and returns the same as optimization_procedure(). a solution from the pipeline is never
+#proven optimal, since its plans leave out most output amounts. if the pipeline finds no CoinJoin, falls back to
+#optimization_procedure() with options and what is left of time_budget.
+def decomposed_optimization_procedure(problem, time_budget = None, max_denominations = 2, workers = None, stage_cache = None,
+                                      **options):
+  start = time.monotonic()
+  result = decomposed_solve(problem, max_denominations = max_denominations, workers = workers, time_budget = time_budget,
+                            stage_cache = stage_cache)
+  if result is None:
+    print("------------------")
+    print("The decomposition found no CoinJoin, falling back to the monolithic encoding")
+    if time_budget is not None:
+      time_budget = max(0, time_budget - int((time.monotonic() - start) * 1000))
+    return optimization_procedure(problem, time_budget = time_budget, **options)
+  return (result[0][0], result[0][1], result[1], False)
+
+#the taker's cost is what its inputs give and its outputs do not get: the txfee, less the txfees of the makers,
+#plus their cjfees. it only differs from the txfee by a constant, so the search minimizes the txfee.
+def taker_cost(problem, model):
+  gives = sum(a for (p, a) in zip(model["input_party"], model["input_amt"]) if p == problem.taker)
+  gets = sum(a for (p, a) in zip(model["output_party"], model["output_amt"]) if p == problem.taker)
+  return gives - gets
+
+#the optimization loop picks a single trade-off: the fewest uniquely-identifiable outputs at all costs, then the
+#fewest outputs. pareto_frontier() instead finds every CoinJoin that no other one beats on all of the number of
+#outputs, the number of uniquely-identifiable outputs and the taker's cost, with engine.pareto_frontier() and
+#options. returns the same as engine.pareto_frontier(), with the "taker_cost" of every point as well.
+def pareto_frontier(problem, **options):
+  (frontier, proven) = solver_engine.pareto_frontier(problem, **options)
+  for point in frontier:
+    point["taker_cost"] = taker_cost(problem, point["model"])
+  return (frontier, proven)
+
+#the library entry point behind coinjoin.solve(): solves problem with the optimization loop, or with z3's Optimize
+#if engine is "optimize", or with the two-stage pipeline if engine is "decomposed". options are passed on to
+#optimization_procedure(), native_optimization_procedure() or decomposed_optimization_procedure().
+def solve(problem, strategy = "linear", engine = "loop", **options):
+  procedures = {"loop": optimization_procedure, "optimize": native_optimization_procedure,
+                "decomposed": decomposed_optimization_procedure}
+  return procedures[engine](problem, strategy = strategy, **options)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Find a good CoinJoin for the example config.")
+  parser.add_argument("--search", choices = ["linear", "binary", "galloping", "parallel"], default = "linear",
+                      help = "how to tighten the objective bounds between solver calls")
+  parser.add_argument("--window", type = int, default = None,
+                      help = "candidate bounds checked at once with --search parallel (default: number of cores)")
+  parser.add_argument("--no-incremental", dest = "incremental", action = "store_false",
+                      help = "re-encode and solve every step from scratch")
+  parser.add_argument("--engine", choices = ["loop", "optimize", "decomposed"], default = "loop",
+                      help = "tighten the bounds step by step, hand the lexicographic objective to z3's Optimize, "
+                             "or pick denominations first and assign them to parties second")
+  parser.add_argument("--denominations", type = int, default = 2, metavar = "N",
+                      help = "denominations besides the main CoinJoin amount to try with --engine decomposed")
+  parser.add_argument("--symmetry-breaking", action = "store_true",
+                      help = "impose a canonical order on the interchangeable output slots")
+  parser.add_argument("--portfolio", type = int, default = None, metavar = "N",
+                      help = "race N solver configurations in parallel worker processes on every step")
+  parser.add_argument("--time-budget", type = int, default = None, metavar = "MS",
+                      help = "total milliseconds to spend, after which the best solution found so far is used")
+  parser.add_argument("--warm-start", action = "store_true",
+                      help = "start every solver call from the best solution found so far")
+  parser.add_argument("--heuristic", action = "store_true",
+                      help = "build a first solution with the pure-Python heuristic engine")
+  parser.add_argument("--explain", action = "store_true",
+                      help = "if there is no CoinJoin at all, report a minimal set of constraints that conflict")
+  parser.add_argument("--metrics", default = None, metavar = "FILE",
+                      help = "append metrics for every encoding and solver call to FILE as JSON lines (- for stdout)")
+  parser.add_argument("--export-smtlib", default = None, metavar = "DIR",
+                      help = "write every solver call to DIR as an SMT-LIB2 file, with a manifest for replay_smtlib.py")
+  parser.add_argument("--encoding", choices = ["pairwise", "classes"], default = "pairwise",
+                      help = "compare all pairs of output slots, or count outputs per amount class")
+  parser.add_argument("--amount-classes", type = int, default = None,
+                      help = "number of amount classes for --encoding classes (default: enough to be exact)")
+  parser.add_argument("--amounts", choices = ["int", "bounded", "bitvector"], default = "int",
+                      help = "encode amounts as unbounded integers, bounded integers, or bit-blasted bit-vectors")
+  parser.add_argument("--pareto", action = "store_true",
+                      help = "list every CoinJoin that none beats on all of number of outputs, uniquely-identifiable outputs and taker cost")
+  parser.add_argument("--workers", type = int, default = None, metavar = "N",
+                      help = "worker processes for --pareto (default: number of cores)")
+  args = parser.parse_args()
+
+  if args.pareto:
+    (frontier, proven) = pareto_frontier(example_problem(), workers = args.workers, encoding = args.encoding,
+                                         num_amount_classes = args.amount_classes, amounts = args.amounts,
+                                         symmetry_breaking = args.symmetry_breaking)
+    print("------------------")
+    print("Pareto frontier of %d CoinJoin(s)%s:" % (len(frontier), "" if proven else " (not proven complete)"))
+    for point in frontier:
+      print("%d outputs, of which %d are uniquely identifiable, with a txfee of %d sats and a taker cost of %d sats" %
+            (point["num_outputs"], point["num_unique_outputs"], point["txfee"], point["taker_cost"]))
+      (_, outputs) = recover_cj_config_from_model(point["model"])
+      print(outputs)
+    return
+
+  instrument = JsonLinesWriter(args.metrics) if args.metrics else None
+  if args.export_smtlib is not None:
+    instrument = SmtLibExporter(args.export_smtlib, instrument,
+                                tactic = bitvector_tactic if args.amounts == "bitvector" else None)
+  engine_options = {"max_denominations": args.denominations} if args.engine == "decomposed" else dict()
+  (min_outputs, max_unique, model, optimal) = solve(example_problem(), strategy = args.search, engine = args.engine,
+                                                    incremental = args.incremental, encoding = args.encoding,
+                                                    num_amount_classes = args.amount_classes, amounts = args.amounts,
+                                                    symmetry_breaking = args.symmetry_breaking,
+                                                    portfolio = default_portfolio(args.portfolio) if args.portfolio else None,
+                                                    window = args.window, time_budget = args.time_budget,
+                                                    warm_start = args.warm_start, heuristic = args.heuristic,
+                                                    explain = args.explain,
+                                                    instrument = instrument,
+                                                    **engine_options)
+  print("------------------")
+  if model is None:
+    if args.time_budget is not None:
+      print("Could not find a CoinJoin solution within the time budget of %d seconds" % (args.time_budget / 1000))
     else:
-      print("------------------")
-      min_outputs = result[0][0]
-      max_unique = result[0][1]
-      best_model = result[1]
-      if max_unique == 0:
-        max_unique_minimized = True
-      print("%d outputs, of which %d are uniquely identifiable" % (min_outputs, max_unique))
-      (_, example_outputs) = recover_cj_config_from_model(best_model)
-      print(example_outputs)
-
-  return (min_outputs, max_unique, best_model)
-
-(min_outputs, max_unique, model) = optimization_procedure()
-print("------------------")
-if model is None:
-    print("Could not find a CoinJoin solution with less than %d seconds of solver time" % (solver_iteration_timeout / 1000))
+      print("Could not find a CoinJoin solution with less than %d seconds of solver time" % (solver_iteration_timeout / 1000))
     sys.exit(1)
-else:
-  #randomly shuffle output order, then sort by decreasing amount:
-  (_, example_outputs) = recover_cj_config_from_model(model)
-
-  print("Best CoinJoin solution found has %d outputs, of which %d are uniquely identifiable:" % (min_outputs, max_unique))
-  print(example_outputs)
-  print("\nraw model:\n")
-  print(model)
+  else:
+    #randomly shuffle output order, then sort by decreasing amount:
+    (_, example_outputs) = recover_cj_config_from_model(model)
+
+    print("Best CoinJoin solution found has %d outputs, of which %d are uniquely identifiable:" % (min_outputs, max_unique))
+    print(example_outputs)
+    print("This solution is %s." % ("proven optimal" if optimal else "not proven optimal"))
+    print("\nraw model:\n")
+    print(model)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#re-runs the solver calls exported with --export-smtlib (see SmtLibExporter in instrumentation.py) against a z3
+#configuration of choice, and compares the results and times with those recorded in the manifest.
+#every directory given is read through its manifest.jsonl, so a corpus of hard instances is just a set of export
+#directories, e.g. from several ./batch.py --export-smtlib runs. calls to Optimize (--engine optimize) are replayed
+#with Optimize, and the rest with a z3 solver running the tactic they were exported with, unless --tactic is given.
+#a replay that gets sat where the recording got unsat (or vice versa) means one of the two solvers is wrong, so it
+#is reported as a mismatch and the exit status is 1.
+import argparse
+import json
+import os
+import sys
+import time
+
+import z3
+
+#reads the manifest of an export directory, as a list of its entries:
+def read_manifest(directory):
+  with open(os.path.join(directory, "manifest.jsonl")) as f:
+    return [json.loads(line) for line in f if line.strip() != ""]
+
+#parses a z3 parameter value given on the command line:
+def parse_value(value):
+  if value in ["true", "false"]:
+    return value == "true"
+  for convert in [int, float]:
+    try:
+      return convert(value)
+    except ValueError:
+      pass
+  return value
+
+#builds a z3 solver from a comma-separated chain of z3 tactic names, or z3's default solver if tactic is None,
+#as make_z3_solver() in engine.py does:
+def make_z3_solver(tactic = None):
+  if tactic is None:
+    return z3.Solver()
+  tactics = [z3.Tactic(name) for name in tactic.split(",")]
+  return (tactics[0] if len(tactics) == 1 else z3.Then(*tactics)).solver()
+
+#replays the script in path with a fresh solver, and returns (result, solve_time), with the result as in the manifest.
+#optimize picks Optimize over a solver running tactic. every check gets timeout milliseconds and the z3 parameters
+#in params (a dict).
+def replay(path, optimize, tactic, timeout, params):
+  solver = z3.Optimize() if optimize else make_z3_solver(tactic)
+  solver.set(timeout = timeout, **params)
+  solver.from_file(path)
+  start = time.perf_counter()
+  res = solver.check()
+  return (str(res), time.perf_counter() - start)
+
+def format_time(seconds):
+  return "%.3f s" % seconds
+
+def main():
+  parser = argparse.ArgumentParser(description = "Replay solver calls exported as SMT-LIB2 and compare their timings.")
+  parser.add_argument("directories", nargs = "+", help = "directories written by --export-smtlib")
+  parser.add_argument("--timeout", type = int, default = 60000, metavar = "MS", help = "time limit of every replayed call")
+  parser.add_argument("--tactic", default = None,
+                      help = "comma-separated chain of z3 tactics to run (default: the one each call was exported with)")
+  parser.add_argument("--set", dest = "params", action = "append", default = list(), metavar = "NAME=VALUE",
+                      help = "set a z3 parameter, e.g. --set random_seed=3 (can be repeated)")
+  parser.add_argument("--steps", default = None, metavar = "RESULT",
+                      help = "only replay the calls recorded with this result (sat, unsat or unknown)")
+  parser.add_argument("--output", default = None, metavar = "FILE", help = "also write the comparison as JSON lines to FILE")
+  args = parser.parse_args()
+
+  params = dict()
+  for param in args.params:
+    (name, _, value) = param.partition("=")
+    params[name] = parse_value(value)
+  output = open(args.output, "w") if args.output is not None else None
+  recorded_total = 0
+  replayed_total = 0
+  ratios = list() #replayed / recorded time of the calls without a hint that got the same definitive result in both
+  mismatches = 0
+  for directory in args.directories:
+    for entry in read_manifest(directory):
+      if args.steps is not None and entry["result"] != args.steps:
+        continue
+      optimize = entry.get("engine") == "optimize"
+      tactic = args.tactic if args.tactic is not None else entry.get("tactic")
+      (result, solve_time) = replay(os.path.join(directory, entry["file"]), optimize, tactic, args.timeout, params)
+      recorded_time = entry["solve_time"]
+      recorded_total += recorded_time
+      replayed_total += solve_time
+      note = ""
+      if "unknown" not in [result, entry["result"]] and result != entry["result"]:
+        mismatches += 1
+        note = "  MISMATCH"
+      elif result == entry["result"] != "unknown" and recorded_time > 0 and not entry.get("hinted"):
+        ratios.append(solve_time / recorded_time)
+      if entry.get("hinted"):
+        note += "  (recorded with a hint)"
+      print("%s: %s in %s, replayed %s in %s%s" % (os.path.join(directory, entry["file"]), entry["result"],
+                                                  format_time(recorded_time), result, format_time(solve_time), note))
+      if output is not None:
+        output.write(json.dumps({"directory": directory, "file": entry["file"], "recorded_result": entry["result"],
+                                 "recorded_time": recorded_time, "result": result, "solve_time": solve_time}) + "\n")
+  if output is not None:
+    output.close()
+
+  print("------------------")
+  print("Recorded %s in total, replayed in %s" % (format_time(recorded_total), format_time(replayed_total)))
+  if len(ratios) > 0:
+    ratios.sort()
+    geometric_mean = 1
+    for ratio in ratios:
+      geometric_mean *= ratio ** (1 / len(ratios))
+    print("Replayed time / recorded time over %d calls with the same result: geometric mean %.2f, median %.2f" %
+          (len(ratios), geometric_mean, ratios[len(ratios) // 2]))
+  if mismatches > 0:
+    print("%d call(s) got a different result" % mismatches)
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
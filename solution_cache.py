@@ -0,0 +1,146 @@
+#a cache of solved CoinJoins, so that repeat configs skip the solver entirely.
+#problems are keyed by a canonical form that does not depend on the party IDs or the order of the inputs, so a
+#config that only relabels the parties or shuffles the inputs of a cached one is a hit as well. models are stored
+#in canonical form too, and mapped back to the caller's party IDs and input order on a hit.
+#only results that are proven optimal (or proven infeasible) are stored, since the next search may do better.
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+from verifier import objective_value, violations
+
+#the model lists holding party IDs, see read_model() in engine.py:
+party_lists = ["input_party", "output_party"]
+
+#returns (canonical, relabel, order), where canonical is a dict describing problem up to party IDs and input order,
+#relabel maps the problem's party IDs to canonical ones (and -1, the ID of unused slots, to itself),
+#and order lists the problem's input indices in canonical order.
+#parties are relabeled in order of their sorted input amounts and fees. parties that tie are interchangeable,
+#so it does not matter which of them gets which ID.
+def canonicalize(problem):
+  def fee(fees, party):
+    return sum(f for (p, f) in fees if p == party) if fees is not None else None
+  def signature(party):
+    return (sorted(a for (p, a) in problem.inputs if p == party), fee(problem.txfees, party),
+            fee(problem.cjfee, party), party == problem.taker)
+  relabel = dict((party, i + 1) for (i, party) in enumerate(sorted(problem.parties, key = signature)))
+  relabel[-1] = -1
+  order = sorted(range(0, problem.num_inputs), key = lambda i: (relabel[problem.inputs[i][0]], problem.inputs[i][1]))
+  canonical = {"variant": problem.variant,
+               "inputs": [[relabel[problem.inputs[i][0]], problem.inputs[i][1]] for i in order],
+               "txfees": sorted([relabel[p], f] for (p, f) in problem.txfees),
+               "cjfee": sorted([relabel[p], f] for (p, f) in problem.cjfee) if problem.cjfee is not None else None,
+               "taker": relabel[problem.taker] if problem.taker is not None else None,
+               "amt": problem.amt,
+               "min_feerate": problem.min_feerate,
+               "max_feerate": problem.max_feerate,
+               "min_output_amt": problem.min_output_amt,
+               "min_output_amt_delta": problem.min_output_amt_delta,
+               "max_party_fragmentation_factor": problem.max_party_fragmentation_factor}
+  return (canonical, relabel, order)
+
+def cache_key(canonical):
+  return hashlib.sha256(json.dumps(canonical, sort_keys = True).encode()).hexdigest()
+
+#maps a model from one labeling to another: party IDs through relabel, and input slot j to slot order[j]
+#(or the other way around, if inverse is set).
+def relabel_model(model, relabel, order, inverse = False):
+  mapped = dict(model)
+  for name in party_lists:
+    mapped[name] = [relabel[p] for p in model[name]]
+  for name in ["input_party", "input_amt"]:
+    values = mapped[name]
+    if inverse:
+      mapped[name] = [None] * len(order)
+      for (j, i) in enumerate(order):
+        mapped[name][i] = values[j]
+    else:
+      mapped[name] = [values[i] for i in order]
+  return mapped
+
+#cheaply re-checks a model from the cache against problem, without a solver: the inputs are the problem's, the
+#CoinJoin passes the verifier (see verifier.py), and the txfee and counts stored with it add up.
+#this guards against stale or corrupted entries rather than re-proving anything.
+def check_model(problem, model, num_outputs, objective):
+  selected_inputs = list()
+  for i in range(0, problem.num_inputs):
+    if model["input_party"][i] == -1 and problem.variant == "perfect":
+      continue #perfect CoinJoins may leave inputs out
+    if (model["input_party"][i], model["input_amt"][i]) != problem.inputs[i]:
+      return False
+    selected_inputs.append(problem.inputs[i])
+  outputs = [(p, a) for (p, a) in zip(model["output_party"], model["output_amt"]) if p != -1]
+  if len(outputs) != num_outputs or sum(a for (_, a) in selected_inputs) - sum(a for (_, a) in outputs) != model["txfee"]:
+    return False
+  return len(violations(problem, selected_inputs, outputs)) == 0 and objective_value(problem, outputs) == objective
+
+#an in-memory LRU of up to max_entries solved problems, backed by one JSON file per problem in the directory path
+#if it is set, so that solutions outlive the process and can be shared between processes.
+class SolutionCache:
+  def __init__(self, max_entries = 1024, path = None):
+    self.max_entries = max_entries
+    self.path = path
+    self.entries = OrderedDict() #key -> entry, least recently used first
+    self.hits = 0
+    self.misses = 0
+    if path is not None:
+      os.makedirs(path, exist_ok = True)
+
+  def entry_path(self, key):
+    return os.path.join(self.path, "%s.json" % key)
+
+  def remember(self, key, entry):
+    self.entries[key] = entry
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last = False)
+
+  def forget(self, key):
+    self.entries.pop(key, None)
+    if self.path is not None and os.path.exists(self.entry_path(key)):
+      os.remove(self.entry_path(key))
+
+  #returns the cached (min_outputs, objective, model, optimal) for problem, as from solve(), or None on a miss.
+  def lookup(self, problem):
+    (canonical, relabel, order) = canonicalize(problem)
+    key = cache_key(canonical)
+    entry = self.entries.get(key)
+    if entry is None and self.path is not None and os.path.exists(self.entry_path(key)):
+      try:
+        with open(self.entry_path(key)) as f:
+          entry = json.load(f)
+      except ValueError:
+        entry = None #a partly written or corrupted file, solve again and overwrite it
+    if entry is None or entry["canonical"] != canonical:
+      self.misses += 1
+      return None
+    self.remember(key, entry)
+    if entry["model"] is None:
+      self.hits += 1
+      return (None, None, None, True)
+    unlabel = dict((v, k) for (k, v) in relabel.items())
+    model = relabel_model(entry["model"], unlabel, order, inverse = True)
+    if not check_model(problem, model, entry["num_outputs"], entry["objective"]):
+      self.forget(key)
+      self.misses += 1
+      return None
+    self.hits += 1
+    return (entry["num_outputs"], entry["objective"], model, True)
+
+  #stores a result as from solve() for problem, if it is proven optimal (or proven infeasible):
+  def store(self, problem, result):
+    (num_outputs, objective, model, optimal) = result
+    if not optimal:
+      return
+    (canonical, relabel, order) = canonicalize(problem)
+    key = cache_key(canonical)
+    entry = {"canonical": canonical, "num_outputs": num_outputs, "objective": objective,
+             "model": relabel_model(model, relabel, order) if model is not None else None}
+    self.remember(key, entry)
+    if self.path is not None:
+      #write to a temporary file first, so that other processes never read half an entry:
+      temporary = "%s.%d.tmp" % (self.entry_path(key), os.getpid())
+      with open(temporary, "w") as f:
+        json.dump(entry, f)
+      os.replace(temporary, self.entry_path(key))
@@ -0,0 +1,49 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import batch
+from coinjoin import CoinJoinProblem
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "batch.py")
+
+def run_batch(jobs, *args):
+  return subprocess.run([sys.executable, script] + list(args), input = "".join(json.dumps(job) + "\n" for job in jobs),
+                        capture_output = True, text = True, timeout = 300)
+
+def test_batch_solves_every_job():
+  jobs = [{"id": "ok", "variant": "perfect", "inputs": [[1, 100000], [2, 100000]], "txfees": [[1, 1000], [2, 1000]]},
+          {"id": "none", "variant": "perfect", "inputs": [[1, 25000], [2, 25000]], "txfees": [[1, 1000], [2, 1000]]},
+          {"id": "bad", "variant": "no-such-variant", "inputs": [], "txfees": []}]
+  finished = run_batch(jobs, "--workers", "2")
+  assert finished.returncode == 0
+  results = dict((result["id"], result) for result in map(json.loads, finished.stdout.splitlines()))
+  assert results["ok"]["status"] == "optimal" and len(results["ok"]["outputs"]) == results["ok"]["num_outputs"]
+  assert results["none"]["status"] == "infeasible"
+  assert results["bad"]["status"] == "error"
+
+#metrics on stdout would be mixed into the results:
+def test_batch_rejects_metrics_on_stdout():
+  assert run_batch([], "--metrics", "-").returncode != 0
+
+#stands in for coinjoin.improving_solutions(): finds one solution, then never finishes.
+def stuck_after_one_solution(problem, **options):
+  model = {"num_outputs": 2, "anonymity_score": 2, "txfee": 2000}
+  yield ([(1, 100000), (2, 100000)], [(1, 99000), (2, 99000)], {"model": model})
+  time.sleep(60)
+  return True
+
+#a job killed past its deadline used to drop the solution it had already found:
+def test_killed_job_keeps_its_last_solution(monkeypatch):
+  monkeypatch.setattr(batch, "improving_solutions", stuck_after_one_solution)
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+  job = batch.Job("stuck", problem, dict(), 0, 500)
+  while time.monotonic() < job.kill_at:
+    if job.connection.poll(0.05):
+      assert not job.receive()
+  result = job.result()
+  assert result["status"] == "feasible" and "error" in result
+  assert result["outputs"] == [(1, 99000), (2, 99000)]
+  assert job.solved is None #never cached, since it is not proven optimal
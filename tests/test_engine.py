@@ -0,0 +1,62 @@
+from coinjoin import CoinJoinProblem, load_variant, solve
+from engine import pareto_frontier, search_bound
+from verifier import objective_value, violations
+
+#runs search_bound() for a minimized objective, where status(bound, retry) answers the bounds: a satisfied bound is
+#met exactly. returns its (best, settled) and the (bound, retry) pairs it tried, in order.
+def run_search(status, best, limit, strategy, retry = False):
+  tried = list()
+  def try_bound(bound, retried):
+    tried.append((bound, retried))
+    answer = status(bound, retried)
+    return ([0, bound] if answer == "sat" else None, answer)
+    yield #a generator, like the callers' try_bound()
+  search = search_bound(try_bound, lambda result: result[1], best, limit, strategy, retry = retry)
+  try:
+    while True:
+      next(search)
+  except StopIteration as done:
+    (best, _, settled) = done.value
+  return (best, settled, tried)
+
+#bounds of 3 and up are satisfiable, and the first try of bound 4 times out:
+def timeout_at_4(bound, retry):
+  if bound == 4 and not retry:
+    return "unknown"
+  return "sat" if bound >= 3 else "unsat"
+
+#a timeout used to count as a refutation, so the search stopped short of the optimum and never tried the bound again:
+def test_timeout_is_retried_rather_than_refuted():
+  (best, settled, tried) = run_search(timeout_at_4, 8, 0, "binary", retry = True)
+  assert (best, settled) == (3, True)
+  assert tried.count((4, True)) == 1
+
+def test_timeout_without_retry_leaves_the_search_unsettled():
+  (best, settled, tried) = run_search(timeout_at_4, 8, 0, "binary")
+  assert (best, settled) == (5, False)
+  assert all(bound > 4 for (bound, _) in tried if bound != 4)
+
+def test_search_settles_without_timeouts():
+  for strategy in ["linear", "binary", "galloping"]:
+    (best, settled, _) = run_search(lambda bound, retry: "sat" if bound >= 3 else "unsat", 8, 0, strategy)
+    assert (best, settled) == (3, True)
+
+#every point of the Pareto frontier is a valid CoinJoin with the numbers it claims, and none beats another on all
+#of the number of outputs, the anonymity score and the txfee:
+def test_pareto_frontier_points_are_valid_and_undominated():
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+  (frontier, proven) = pareto_frontier(problem, workers = 1, symmetry_breaking = True)
+  assert proven and len(frontier) > 1
+  prototype = load_variant("perfect")
+  for point in frontier:
+    (selected_inputs, outputs) = prototype.recover_cj_config_from_model(point["model"])
+    assert violations(problem, selected_inputs, outputs) == []
+    assert (len(outputs), objective_value(problem, outputs)) == (point["num_outputs"], point["anonymity_score"])
+    assert sum(a for (_, a) in selected_inputs) - sum(a for (_, a) in outputs) == point["txfee"]
+  key = lambda point: (point["num_outputs"], -point["anonymity_score"], point["txfee"])
+  for a in frontier:
+    for b in frontier:
+      assert a is b or not all(x <= y for (x, y) in zip(key(a), key(b)))
+  #the optimization loop's optimum is on the frontier:
+  (num_outputs, anonymity_score, _, _) = solve(problem, heuristic = False, symmetry_breaking = True)
+  assert (num_outputs, anonymity_score) in [(point["num_outputs"], point["anonymity_score"]) for point in frontier]
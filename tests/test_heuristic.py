@@ -0,0 +1,24 @@
+from coinjoin import load_variant
+from heuristic import maker_taker_solution, perfect_solution
+from verifier import objective_value, violations
+
+#the CoinJoin of a model as from read_model(), as (selected_inputs, outputs):
+def coinjoin_of(model):
+  selected_inputs = [(p, a) for (p, a) in zip(model["input_party"], model["input_amt"]) if p != -1]
+  outputs = [(p, a) for (p, a) in zip(model["output_party"], model["output_amt"]) if p != -1]
+  return (selected_inputs, outputs)
+
+#checked without heuristic_solution(), which would drop a candidate that breaks a rule:
+def test_maker_taker_heuristic_passes_verifier():
+  problem = load_variant("maker-taker").example_problem()
+  (_, model) = maker_taker_solution(problem)
+  (selected_inputs, outputs) = coinjoin_of(model)
+  assert violations(problem, selected_inputs, outputs) == []
+  assert objective_value(problem, outputs) == model["num_unique_outputs"]
+
+def test_perfect_heuristic_passes_verifier():
+  problem = load_variant("perfect").example_problem()
+  (_, model) = perfect_solution(problem)
+  (selected_inputs, outputs) = coinjoin_of(model)
+  assert violations(problem, selected_inputs, outputs) == []
+  assert objective_value(problem, outputs) == model["anonymity_score"]
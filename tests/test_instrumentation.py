@@ -0,0 +1,36 @@
+from coinjoin import CoinJoinProblem
+from engine import SolverSession, solve_smt_problem
+from instrumentation import SmtLibExporter
+from replay_smtlib import read_manifest, replay
+
+def small_problem():
+  return CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+
+#the same check, asked of a session three times, used to report the counts of all the checks so far:
+def test_statistics_are_per_call():
+  records = list()
+  with SolverSession(small_problem(), 6, instrument = records.append) as session:
+    for _ in range(0, 3):
+      assert session.solve(6, 2) is not None
+  statistics = [record["statistics"] for record in records if record["event"] == "solve"]
+  assert len(statistics) == 3
+  assert [s["num_checks"] for s in statistics] == [1, 1, 1]
+  #a count of the calls so far would never go down, but the later calls reuse what the first one learned:
+  assert statistics[1]["rlimit_count"] < statistics[0]["rlimit_count"]
+
+#exports the solver call for min_anonymity_score bound on small_problem() to directory:
+def export(directory, bound):
+  with SmtLibExporter(str(directory)) as exporter:
+    return solve_smt_problem(small_problem(), 6, bound, instrument = exporter)
+
+#a second export into the same directory used to start again at step-0001.smt2, so the first manifest line named
+#the second export's script:
+def test_exports_to_the_same_directory_add_up(tmp_path):
+  assert export(tmp_path, 2) is not None
+  assert export(tmp_path, 19) is None #two parties with three outputs each score at most 18
+  entries = read_manifest(str(tmp_path))
+  assert [(entry["step"], entry["file"], entry["result"]) for entry in entries] == \
+         [(1, "step-0001.smt2", "sat"), (2, "step-0002.smt2", "unsat")]
+  for entry in entries:
+    (result, _) = replay(str(tmp_path / entry["file"]), False, None, 60000, dict())
+    assert result == entry["result"]
@@ -0,0 +1,29 @@
+from coinjoin import CoinJoinProblem, load_variant, solve
+from verifier import objective_value, violations
+
+prototype = load_variant("maker-taker")
+
+def three_party_problem():
+  return CoinJoinProblem("maker-taker", [(1, 100000000), (2, 130000000), (3, 110000000)], {(1, 0), (2, 17), (3, 0)},
+                         cjfee = {(1, 0), (2, 28), (3, 5)}, taker = 1)
+
+#the amount classes encoding counts outputs per class instead of comparing all pairs of output slots, and should
+#find the same optimum:
+def test_classes_encoding_matches_pairwise():
+  problem = three_party_problem()
+  pairwise = solve(problem, strategy = "binary", symmetry_breaking = True)
+  classes = solve(problem, strategy = "binary", symmetry_breaking = True, encoding = "classes")
+  assert pairwise[3] and classes[3]
+  assert classes[:2] == pairwise[:2]
+  (selected_inputs, outputs) = prototype.recover_cj_config_from_model(classes[2])
+  assert violations(problem, selected_inputs, outputs) == []
+
+#the two-stage pipeline builds its CoinJoins outside the monolithic encoding, so nothing but the verifier checks
+#that they follow the same rules:
+def test_decomposed_solution_passes_verifier():
+  problem = three_party_problem()
+  ([num_outputs, num_unique_outputs], model) = prototype.decomposed_solve(problem, workers = 1)
+  (selected_inputs, outputs) = prototype.recover_cj_config_from_model(model)
+  assert violations(problem, selected_inputs, outputs) == []
+  assert (len(outputs), objective_value(problem, outputs)) == (num_outputs, num_unique_outputs)
+  assert num_unique_outputs >= solve(problem, strategy = "binary", symmetry_breaking = True)[1]
@@ -0,0 +1,148 @@
+import time
+
+from coinjoin import CoinJoinProblem, load_variant, solve
+from verifier import violations
+
+prototype = load_variant("perfect")
+
+#two 25000 sat inputs cannot fund any perfect CoinJoin with outputs of at least 30000 sats. the encoding used to
+#only require outputs above min(0, min_output_amt - 1), and found one with outputs of a few thousand sats.
+def test_perfect_outputs_respect_min_output_amt():
+  problem = CoinJoinProblem("perfect", [(1, 25000), (2, 25000)], {(1, 1000), (2, 1000)})
+  assert solve(problem, heuristic = False) == (None, None, None, True)
+
+#fees can shift satoshis between parties, so party 1 can get a 30000 sat output for its 28000 sat input. pruning
+#used to drop its input, then party 2's for lack of anyone to mix with, and report the problem as infeasible.
+def test_pruning_keeps_inputs_that_fees_make_usable():
+  problem = CoinJoinProblem("perfect", [(1, 28000), (2, 34000)], {(1, 1000), (2, 5000)})
+  assert prototype.prune_inputs(problem) == [0, 1]
+  (_, _, model, optimal) = solve(problem, heuristic = False, shortlist = 1)
+  assert model is not None and optimal
+  (selected_inputs, outputs) = prototype.recover_cj_config_from_model(model)
+  assert violations(problem, selected_inputs, outputs) == []
+
+#spending small inputs on the txfee alone is no CoinJoin:
+def test_perfect_coinjoin_needs_outputs():
+  problem = CoinJoinProblem("perfect", [(1, 500), (2, 300)], {(1, 1000), (2, 1000)})
+  assert prototype.prune_inputs(problem) == []
+  assert solve(problem, heuristic = False) == (None, None, None, True)
+  assert [rule for (rule, _) in violations(problem, [(1, 500), (2, 300)], [])] == ["outputs"]
+
+def four_party_problem():
+  return CoinJoinProblem("perfect", [(p, 100000 + 10000 * p) for p in range(1, 5)], {(p, 1000) for p in range(1, 5)})
+
+#no single input makes a CoinJoin, so the shortlist of one is widened until a round finds one:
+def test_shortlist_widens_until_feasible():
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+  records = list()
+  solutions = list(prototype.shortlisted_solutions(problem, 1, {"instrument": records.append}))
+  assert [record["shortlist"] for record in records if record["event"] == "shortlist"] == [1, 2]
+  assert len(solutions) > 0 and all(metrics["shortlist"] == 2 for (_, _, metrics) in solutions)
+  (selected_inputs, outputs, metrics) = solutions[-1]
+  assert len(metrics["model"]["input_party"]) == problem.num_inputs
+  assert violations(problem, selected_inputs, outputs) == []
+
+#stands in for improving_solutions(): every round takes 50 ms and finds nothing, so the shortlist is widened.
+def infeasible_rounds(budgets):
+  def improving_solutions(problem, time_budget = None, **options):
+    budgets.append(time_budget)
+    time.sleep(0.05)
+    return True
+    yield
+  return improving_solutions
+
+#every round gets what the rounds before it left of the budget, not the whole budget again:
+def test_shortlist_rounds_share_the_time_budget(monkeypatch):
+  budgets = list()
+  monkeypatch.setattr(prototype, "improving_solutions", infeasible_rounds(budgets))
+  solutions = prototype.shortlisted_solutions(four_party_problem(), 1, dict(), time_budget = 10000)
+  assert list(solutions) == []
+  assert len(budgets) == 3 #shortlists of 1, 2 and 4 inputs
+  assert budgets[0] <= 10000 and all(later <= earlier - 50 for (earlier, later) in zip(budgets, budgets[1:]))
+
+def test_shortlist_stops_once_the_time_budget_is_used_up(monkeypatch):
+  budgets = list()
+  monkeypatch.setattr(prototype, "improving_solutions", infeasible_rounds(budgets))
+  solutions = prototype.shortlisted_solutions(four_party_problem(), 1, dict(), time_budget = 80)
+  try:
+    while True:
+      next(solutions)
+  except StopIteration as done:
+    assert done.value is False
+  assert len(budgets) == 2
+
+#the amount classes encoding counts outputs per class instead of comparing all pairs of output slots, and should
+#find the same optimum:
+def test_classes_encoding_matches_pairwise():
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+  pairwise = solve(problem, heuristic = False, symmetry_breaking = True)
+  classes = solve(problem, heuristic = False, symmetry_breaking = True, encoding = "classes")
+  assert pairwise[3] and classes[3]
+  assert classes[:2] == pairwise[:2] == (6, 18)
+  (selected_inputs, outputs) = prototype.recover_cj_config_from_model(classes[2])
+  assert violations(problem, selected_inputs, outputs) == []
+
+#a round of 1000 sat maximum txfee contributions, with the fees and amounts loose enough for many even splits:
+def round_problem(inputs):
+  return CoinJoinProblem("perfect", inputs, {(party, 1000) for (party, _) in inputs},
+                         min_feerate = 1, max_feerate = 1000, min_output_amt = 1, min_output_amt_delta = 1)
+
+#runs one re-solve of round to the end, and returns the solutions yielded and whether the last one is proven optimal:
+def resolve(round, **options):
+  solutions = list()
+  resolving = round.improving_solutions(**options)
+  while True:
+    try:
+      solutions.append(next(resolving))
+    except StopIteration as done:
+      return (solutions, done.value)
+
+#the re-solve after a party drops out is encoded for the two parties left, with 6 output slots. in a session with
+#9 slots and the dropped party's input only ruled out, it took minutes instead of a fraction of a second.
+def test_round_re_solves_without_the_dropped_party():
+  problem = round_problem([(1, 100000), (2, 100000), (3, 100000)])
+  with prototype.CoinJoinRound(problem) as round:
+    (solutions, _) = resolve(round, time_budget = 2000, heuristic = True)
+    assert len(solutions) > 0
+    round.drop_parties({3})
+    (solutions, proven) = resolve(round)
+    assert round.session.max_outputs == 6 and proven
+  (selected_inputs, outputs, metrics) = solutions[-1]
+  assert metrics["model"] is round.model and round.model["input_party"] == [1, 2, -1]
+  assert violations(problem, selected_inputs, outputs) == []
+
+#a party that still offers an input after withdrawing another keeps its output slots, so the session is kept:
+def test_round_keeps_its_session_when_inputs_are_withdrawn():
+  problem = round_problem([(1, 50000), (1, 50000), (2, 100000)])
+  with prototype.CoinJoinRound(problem, symmetry_breaking = True) as round:
+    resolve(round)
+    session = round.session
+    round.withdraw_inputs([1])
+    (solutions, proven) = resolve(round)
+    assert round.session is session and proven
+  (selected_inputs, outputs, _) = solutions[-1]
+  assert round.model["input_party"][1] == -1
+  assert violations(problem, selected_inputs, outputs) == []
+
+#the solution before the late offer is still one with the offer left unused, so the search starts from it:
+def test_round_takes_late_offers():
+  with prototype.CoinJoinRound(round_problem([(1, 100000), (2, 100000)]), symmetry_breaking = True) as round:
+    resolve(round)
+    before = round.model
+    round.add_offers([(3, 100000)], {(3, 1000)})
+    (solutions, _) = resolve(round, time_budget = 5000)
+    assert solutions[0][2]["anonymity_score"] >= before["anonymity_score"]
+  (selected_inputs, outputs, _) = solutions[-1]
+  assert len(round.model["input_party"]) == 3
+  assert violations(round.problem, selected_inputs, outputs) == []
+
+#a re-solve that yields nothing, here for lack of time budget, leaves the last solution be:
+def test_round_keeps_its_model_without_a_new_solution():
+  with prototype.CoinJoinRound(round_problem([(1, 100000), (2, 100000), (3, 100000)]), time_budget = 1000) as round:
+    (solutions, _) = resolve(round, heuristic = True)
+    model = round.model
+    assert len(solutions) > 0 and model is not None
+    round.drop_parties({3})
+    time.sleep(max(0, round.remaining_budget() / 1000))
+    assert resolve(round) == ([], False)
+    assert round.model is model
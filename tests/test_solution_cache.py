@@ -0,0 +1,28 @@
+from coinjoin import CoinJoinProblem, load_variant, solve
+from solution_cache import SolutionCache
+from verifier import violations
+
+#a config that only swaps the party IDs (which always run from 1) and the order of the inputs of a cached one is
+#a hit, and the cached model comes back in the caller's party IDs:
+def test_lookup_maps_relabeled_parties_back():
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 150000)], {(1, 1000), (2, 2000)}, min_output_amt = 5000)
+  relabeled = CoinJoinProblem("perfect", [(1, 150000), (2, 100000)], {(2, 1000), (1, 2000)}, min_output_amt = 5000)
+  cache = SolutionCache()
+  result = solve(problem, heuristic = False)
+  assert result[2] is not None and result[3]
+  cache.store(problem, result)
+  hit = cache.lookup(relabeled)
+  assert hit is not None and cache.hits == 1
+  (num_outputs, objective, model, optimal) = hit
+  assert (num_outputs, objective, optimal) == (result[0], result[1], True)
+  (selected_inputs, outputs) = load_variant("perfect").recover_cj_config_from_model(model)
+  assert sorted(selected_inputs) == [(1, 150000), (2, 100000)]
+  assert violations(relabeled, selected_inputs, outputs) == []
+
+def test_lookup_misses_a_different_problem():
+  cache = SolutionCache()
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 150000)], {(1, 1000), (2, 2000)}, min_output_amt = 5000)
+  cache.store(problem, solve(problem, heuristic = False))
+  assert cache.lookup(CoinJoinProblem("perfect", [(1, 100000), (2, 160000)], {(1, 1000), (2, 2000)},
+                                      min_output_amt = 5000)) is None
+  assert cache.misses == 1
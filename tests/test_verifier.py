@@ -0,0 +1,26 @@
+from coinjoin import CoinJoinProblem, load_variant, solve
+from verifier import violations
+
+#the solver's CoinJoin for problem, as (selected_inputs, outputs):
+def solver_coinjoin(problem):
+  (_, _, model, optimal) = solve(problem, heuristic = False)
+  assert optimal
+  if model is None:
+    return None
+  return load_variant(problem.variant).recover_cj_config_from_model(model)
+
+def test_perfect_solver_output_passes_verifier():
+  problem = CoinJoinProblem("perfect", [(1, 25000), (2, 25000)], {(1, 1000), (2, 1000)}, min_output_amt = 5000)
+  (selected_inputs, outputs) = solver_coinjoin(problem)
+  assert all(a >= 5000 for (_, a) in outputs)
+  assert violations(problem, selected_inputs, outputs) == []
+
+def test_verifier_accepts_a_valid_coinjoin():
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+  assert violations(problem, [(1, 100000), (2, 100000)], [(1, 99000), (2, 99000)]) == []
+
+#the same txfee, but party 2 pays 500 sats more of it than its cap, and the outputs no longer share an amount:
+def test_verifier_rejects_an_invalid_coinjoin():
+  problem = CoinJoinProblem("perfect", [(1, 100000), (2, 100000)], {(1, 1000), (2, 1000)})
+  found = violations(problem, [(1, 100000), (2, 100000)], [(1, 99500), (2, 98500)])
+  assert sorted(set(rule for (rule, _) in found)) == ["min_output_amt_delta", "no_unique_outputs", "txfee_cap[2]"]
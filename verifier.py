@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#checks a concrete CoinJoin against every rule that build_smt_encoding() in the prototypes imposes, in pure Python
+#and without pysmt or z3, so that a participant can check a proposed transaction before signing it and a coordinator
+#can check cached or heuristic solutions without a solver.
+#a CoinJoin is given as (selected_inputs, outputs), as from recover_cj_config_from_model() in the prototypes: lists
+#of (party, satoshis) tuples in any order. the txfee is what the inputs give and the outputs do not take.
+#outputs are grouped by amount (and by amount and party) rather than compared pairwise, and the only sort is the
+#one of the distinct amounts for the min delta rule, so checking takes O(n log n) for n inputs and outputs.
+#the rules are reported under the names of the constraint groups they stand for (see unsat_core() in
+#engine.py), plus "inputs", "outputs", "max_outputs" and "min_output_amt" for the rules that hold by construction
+#of the encoding, and "gets[party]" for what a maker/taker party gets given its inputs and the txfees and cjfees.
+from collections import Counter
+import argparse
+import json
+import sys
+
+from coinjoin import make_problem
+
+def txsize(num_used_inputs, num_outputs):
+  return 11 + 68 * num_used_inputs + 31 * num_outputs
+
+#how many outputs of other parties share each output's amount, for outputs as a list of (party, satoshis) tuples:
+def output_scores(outputs):
+  amt_count = Counter(a for (_, a) in outputs)
+  party_amt_count = Counter(outputs)
+  return [amt_count[a] - party_amt_count[(p, a)] for (p, a) in outputs]
+
+def amounts_spaced(outputs, min_output_amt_delta):
+  amounts = sorted(set(a for (_, a) in outputs))
+  return all(b - a >= min_output_amt_delta for (a, b) in zip(amounts, amounts[1:]))
+
+#the value of the objective the variant of problem optimizes for outputs: the number of uniquely-identifiable outputs
+#for "maker-taker" and the anonymity score for "perfect".
+def objective_value(problem, outputs):
+  scores = output_scores(outputs)
+  if problem.variant == "perfect":
+    return sum(scores)
+  return len([s for s in scores if s == 0])
+
+#returns the rules the CoinJoin breaks for problem, as a list of (rule, message) tuples, which is empty if it is valid.
+def violations(problem, selected_inputs, outputs):
+  found = list()
+  def violated(rule, message, *args):
+    found.append((rule, message % args))
+
+  #inputs: a perfect CoinJoin may leave inputs out, a maker/taker CoinJoin spends them all.
+  offered = Counter(problem.inputs)
+  selected = Counter(selected_inputs)
+  unknown = selected - offered
+  if problem.variant != "perfect":
+    missing = offered - selected
+    if len(missing) > 0:
+      violated("inputs", "offered inputs are not spent: %s", sorted(missing.elements()))
+  if len(unknown) > 0:
+    violated("inputs", "inputs were not offered (or are spent twice): %s", sorted(unknown.elements()))
+
+  #outputs:
+  parties = set(problem.parties)
+  slots = 3 * len(problem.parties)
+  if len(outputs) == 0:
+    violated("outputs", "there are no outputs, so the inputs only pay the txfee")
+  if len(outputs) > slots:
+    violated("max_outputs", "%d outputs, more than the %d output slots", len(outputs), slots)
+  for (p, a) in outputs:
+    if p not in parties:
+      violated("outputs", "output of %d sats belongs to unknown party %r", a, p)
+    if a < problem.min_output_amt:
+      violated("min_output_amt", "output of %d sats to party %r is below %d sats", a, p, problem.min_output_amt)
+  if not amounts_spaced(outputs, problem.min_output_amt_delta):
+    violated("min_output_amt_delta", "two output amounts are less than %d sats apart", problem.min_output_amt_delta)
+
+  #fees and feerate:
+  txfee = sum(a for (_, a) in selected_inputs) - sum(a for (_, a) in outputs)
+  size = txsize(len(selected_inputs), len(outputs))
+  if txfee < problem.min_feerate * size:
+    violated("min_feerate", "txfee of %d sats is below %d sats/vbyte for %d vbytes", txfee, problem.min_feerate, size)
+  if txfee > problem.max_feerate * size:
+    violated("max_feerate", "txfee of %d sats is above %d sats/vbyte for %d vbytes", txfee, problem.max_feerate, size)
+  gives = Counter()
+  num_inputs = Counter()
+  for (p, a) in selected_inputs:
+    gives[p] += a
+    num_inputs[p] += 1
+  gets = Counter()
+  num_outputs = Counter()
+  for (p, a) in outputs:
+    gets[p] += a
+    num_outputs[p] += 1
+  scores = output_scores(outputs)
+
+  if problem.variant == "perfect":
+    #the cap is the full maximum txfee contribution, as in the encoding, not scaled to the inputs used (see the
+    #perfect CoinJoin README):
+    for (p, cap) in sorted(problem.txfees):
+      if gives[p] - gets[p] > cap:
+        violated("txfee_cap[%d]" % p, "party %d pays %d sats towards the txfee, more than its cap of %d sats",
+                 p, gives[p] - gets[p], cap)
+      if num_outputs[p] > problem.max_party_fragmentation_factor * num_inputs[p]:
+        violated("fragmentation[%d]" % p, "party %d gets %d outputs for %d inputs, more than %d per input",
+                 p, num_outputs[p], num_inputs[p], problem.max_party_fragmentation_factor)
+    for ((p, a), score) in zip(outputs, scores):
+      if score == 0:
+        violated("no_unique_outputs", "output of %d sats to party %r is uniquely identifiable", a, p)
+  else:
+    txfees = dict(problem.txfees)
+    cjfees = dict(problem.cjfee)
+    for p in problem.parties:
+      if p != problem.taker:
+        expected = gives[p] - txfees.get(p, 0) + cjfees.get(p, 0)
+      else:
+        expected = gives[p] + sum(f for (q, f) in txfees.items() if q != p) - \
+                   sum(f for (q, f) in cjfees.items() if q != p) - txfee
+      if gets[p] != expected:
+        violated("gets[%d]" % p, "party %d gets %d sats, but its inputs and fees entitle it to %d sats", p, gets[p], expected)
+    main_cj_amt = problem.amt if problem.amt != 0 else gets[problem.taker]
+    at_main_cj_amt = len([a for (_, a) in outputs if a == main_cj_amt])
+    if at_main_cj_amt < len(problem.parties):
+      violated("main_cj_amt", "%d outputs of the main CoinJoin amount of %d sats, fewer than the %d parties",
+               at_main_cj_amt, main_cj_amt, len(problem.parties))
+    unique = Counter(p for ((p, _), score) in zip(outputs, scores) if score == 0)
+    for (p, n) in sorted(unique.items()):
+      if n > 1:
+        violated("unique_outputs[%d]" % p, "party %d has %d uniquely-identifiable outputs, more than one", p, n)
+  return found
+
+def main():
+  parser = argparse.ArgumentParser(description = "Check a proposed CoinJoin against the rules of its config.")
+  parser.add_argument("config", help = "the CoinJoin config, as a job for batch.py")
+  parser.add_argument("result", nargs = "?", default = "-",
+                      help = "the proposed CoinJoin, as a result line from batch.py with its inputs and outputs (default: stdin)")
+  args = parser.parse_args()
+
+  with open(args.config) as f:
+    problem = make_problem(json.load(f))
+  if args.result == "-":
+    result = json.load(sys.stdin)
+  else:
+    with open(args.result) as f:
+      result = json.load(f)
+  selected_inputs = [(p, a) for (p, a) in result["inputs"]]
+  outputs = [(p, a) for (p, a) in result["outputs"]]
+  found = violations(problem, selected_inputs, outputs)
+  for (rule, message) in found:
+    print("%s: %s" % (rule, message))
+  if len(found) > 0:
+    sys.exit(1)
+  if problem.variant == "perfect":
+    print("Valid CoinJoin with %d outputs and anonymity score %d" % (len(outputs), objective_value(problem, outputs)))
+  else:
+    print("Valid CoinJoin with %d outputs, of which %d are uniquely identifiable" % (len(outputs),
+                                                                                  objective_value(problem, outputs)))
+
+if __name__ == "__main__":
+  main()